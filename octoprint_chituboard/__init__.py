@@ -7,13 +7,17 @@ import os, sys
 import logging
 import re
 import flask
+from functools import partial
 
 # ~ from .chitu_comm import chitu_comm
 # ~ from .flash_drive_emu import flash_drive_emu
-from .sla_analyser import sla_AnalysisQueue
+from .analysis_cache import AnalysisCache
+from .thumbnail_cache import ThumbnailCache
+from .analysis_worker import AnalysisWorker, analyse_envelope, encode_result
 # ~ from .sla_estimator import SLAPrintTimeEstimator
-from .sla_printer import Sla_printer, gcode_modifier
-from .sla_ui import *
+# sla_analyser and sla_printer pull in most of octoprint.printer, they are
+# imported by the factory hooks so analysis workers don't load them
+from .gcode_hooks import classify_received, gcode_modifier, parse_M4000
 
 import octoprint.plugin
 import octoprint.util
@@ -43,7 +47,8 @@ class Chituboard(   octoprint.plugin.SettingsPlugin,
 					octoprint.plugin.WizardPlugin,
 					octoprint.plugin.StartupPlugin,
 					octoprint.plugin.EventHandlerPlugin,
-					octoprint.plugin.ShutdownPlugin
+					octoprint.plugin.ShutdownPlugin,
+					octoprint.plugin.BlueprintPlugin
 					):
 
 	firmware_version = "V4.13" # firmware version on my printer
@@ -53,6 +58,10 @@ class Chituboard(   octoprint.plugin.SettingsPlugin,
 		super(Chituboard, self).__init__(**kwargs)
 		self._initialized = False
 		self.gcode_modifier = gcode_modifier()
+		self._analysis_worker = AnalysisWorker()
+		self._analysis_cache = None
+		self._thumbnail_cache = None
+		self.sla_printer = None
 		self._logged_replacement = {}
 		self._logger = logging.getLogger("octoprint.plugins.Chituboard")
 		# ~ self._conn_settings = {
@@ -78,6 +87,17 @@ class Chituboard(   octoprint.plugin.SettingsPlugin,
 		self._initialized = True
 
 
+	def initialize(self):
+		self._analysis_cache = AnalysisCache(
+			os.path.join(self.get_plugin_data_folder(), "analysis_cache"),
+			max_bytes = int(self._settings.get_float(["analysisCacheSize"]) * 1024 * 1024))
+		self._thumbnail_cache = ThumbnailCache(
+			os.path.join(self.get_plugin_data_folder(), "thumbnails"),
+			self._analysis_cache.key_for,
+			max_bytes = int(self._settings.get_float(["thumbnailCacheSize"]) * 1024 * 1024))
+		self.gcode_modifier.poll_scheduler.enabled = self._settings.get_boolean(["adaptivePolling"])
+		self._apply_upload_settings()
+
 	##############################################
 	#		 allowed file extesions part		#
 	##############################################
@@ -151,13 +171,22 @@ class Chituboard(   octoprint.plugin.SettingsPlugin,
 		# get current layer number and total layer count
 		# and convert to string
 		result = "-"
+		progress = None
 		if self._printer._sliced_model_file and self._printer.is_printing():
-			
+			position = self._printer.get_layer_position()
 			result = "{}/{}".format(
-				self._printer.get_current_layer(),
+				position.index + 1 if position else "-",
 				self._printer._sliced_model_file.layer_count
 			)
-		return flask.jsonify(layerString = result)
+			if position:
+				progress = dict(
+					layer = position.index + 1,
+					progress = position.progress,
+					start = position.start,
+					end = position.end)
+		cache_stats = self._analysis_cache.stats() if self._analysis_cache else None
+		return flask.jsonify(layerString = result, layerProgress = progress, analysisCache = cache_stats,
+			pollStats = self.gcode_modifier.poll_scheduler.stats())
 	
 	##############################################
 	#              Progress plugin               #
@@ -180,7 +209,17 @@ class Chituboard(   octoprint.plugin.SettingsPlugin,
 	##############################################	
 	
 	def register_custom_events(*args, **kwargs):
-		return ["layer_change"]
+		return ["layer_change", "upload_progress"]
+
+	def on_event(self, event, payload):
+		scheduler = self.gcode_modifier.poll_scheduler
+		if event == Events.PRINT_STARTED:
+			# space the status polls by the layer times of the file
+			scheduler.reset(self._printer.get_layer_durations())
+		elif event in (Events.PRINT_DONE, Events.PRINT_FAILED, Events.PRINT_CANCELLED):
+			if scheduler.active:
+				self._logger.info("Status polls of the print: %s" % scheduler.stats())
+			scheduler.stop()
 
 	##############################################
 	#			   CLI commands                  #
@@ -189,38 +228,22 @@ class Chituboard(   octoprint.plugin.SettingsPlugin,
 		import click
 		@click.command(name="sla_analysis")
 		@click.argument("name", default=None)
-		def sla_analysis(name):
+		@click.option("--result-fd", type=int, default=None,
+			help="Write the JSON result to this file descriptor instead of stdout")
+		@click.option("--full", is_flag=True, default=False,
+			help="Decode every layer to measure volume, bounding box and per layer area")
+		def sla_analysis(name, result_fd, full):
 			"""
 			Analyze files created in chitubox, photon workshop and Lychee.
-			Will be used in analysis queue
+			Prints a versioned JSON result envelope with per phase timings.
 			"""
-			import time, yaml
-			from pathlib import Path
-			from octoprint.util import monotonic_time
-			start_time = monotonic_time()
-			from .file_formats.utils import get_file_format
 			if os.path.isabs(name):
-				file_format = get_file_format(name)
-				sliced_model_file = file_format.read(Path(name))
-				click.echo("DONE:{}s".format(monotonic_time() - start_time))
-				click.echo("RESULTS:")
-				result = {
-					"filename": sliced_model_file.filename,
-					"path": name,
-					"bed_size_mm": list(sliced_model_file.bed_size_mm),
-					"height_mm": round(sliced_model_file.height_mm, 4),
-					"layer_count": sliced_model_file.layer_count,
-					"layer_height_mm": round(sliced_model_file.layer_height_mm, 4),
-					"resolution": list(sliced_model_file.resolution),
-					"print_time_secs": sliced_model_file.print_time_secs,
-					"total_time": sliced_model_file.print_time_secs/60,
-					"volume": sliced_model_file.volume,
-					#"end byte offset by layer": sliced_model_file.end_byte_offset_by_layer,
-					"printer name": sliced_model_file.printer_name,
-					"printing_area": sliced_model_file.printing_area,
-					"dimensions": sliced_model_file.dimensions,
-					}
-				click.echo(yaml.safe_dump(result,default_flow_style=False, indent=2, allow_unicode=False))
+				data = encode_result(analyse_envelope(name, full_model=full))
+				if result_fd is None:
+					click.echo(data)
+				else:
+					with os.fdopen(result_fd, "wb") as out:
+						out.write(data)
 			else:
 				click.echo("ERROR: not absolute path, nothing to analyse")
 				sys.exit(0)	
@@ -248,7 +271,11 @@ class Chituboard(   octoprint.plugin.SettingsPlugin,
 			tempSensorPrinter = None,#1wire/ntc
 			tempSensorBed = None,#1wire/ntc
 			helloCommand = "M4002",
-			pauseCommand = "M25")
+			pauseCommand = "M25",
+			adaptivePolling = True, #space status polls by the layer times
+			uploadWindow = 4, #packets in flight when uploading over the UART
+			analysisCacheSize = 50,#MB
+			thumbnailCacheSize = 20)#MB
 			
 	def get_settings_version(self):
 		return 1
@@ -257,6 +284,15 @@ class Chituboard(   octoprint.plugin.SettingsPlugin,
 		# ~ allowedExten = self.settings(
 		# ~ octoprint.plugin.SettingsPlugin.on_settings_save(self, data)
 		# ~ allowedExten = 
+
+	def on_settings_save(self, data):
+		octoprint.plugin.SettingsPlugin.on_settings_save(self, data)
+		if self._analysis_cache is not None:
+			self._analysis_cache.max_bytes = int(self._settings.get_float(["analysisCacheSize"]) * 1024 * 1024)
+		if self._thumbnail_cache is not None:
+			self._thumbnail_cache.max_bytes = int(self._settings.get_float(["thumbnailCacheSize"]) * 1024 * 1024)
+		self.gcode_modifier.poll_scheduler.enabled = self._settings.get_boolean(["adaptivePolling"])
+		self._apply_upload_settings()
 			
 	def on_settings_initialized(self):
 		
@@ -267,6 +303,8 @@ class Chituboard(   octoprint.plugin.SettingsPlugin,
 
 	def on_after_startup(self):
 		self._logger.info("Octoprint-Chituboard plugin startup")
+		# warm up the analysis worker so the first upload doesn't wait for it
+		self._analysis_worker.start()
 		#self._initialize()
 
 	##############################################
@@ -286,11 +324,52 @@ class Chituboard(   octoprint.plugin.SettingsPlugin,
 	#def on_shutdown(self):
 		#self.Chitu_comm.shutdownService()
 
+	def on_shutdown(self):
+		self._analysis_worker.stop()
+		if self._thumbnail_cache is not None:
+			self._thumbnail_cache.stop()
+
 	##############################################
 	#			   File analysis				#
 	##############################################
-	def get_sla_analysis_factory(*args, **kwargs):
-		return dict(sla_bin=sla_AnalysisQueue)
+	def get_sla_analysis_factory(self, *args, **kwargs):
+		from .sla_analyser import sla_AnalysisQueue
+
+		return dict(sla_bin=partial(sla_AnalysisQueue, worker=self._analysis_worker,
+			# the caches are created in initialize(), which runs after this hook
+			cache=lambda: self._analysis_cache, thumbnails=lambda: self._thumbnail_cache))
+
+	##############################################
+	#			   Thumbnails					#
+	##############################################
+	@octoprint.plugin.BlueprintPlugin.route("/thumbnail/<path:filename>", methods=["GET"])
+	def get_thumbnail(self, filename):
+		"""
+		Serves the preview image of an uploaded file. The content
+		fingerprint is the ETag, so browsers revalidate with a 304.
+		"""
+		if self._thumbnail_cache is None:
+			flask.abort(404)
+		try:
+			path_on_disk = self._file_manager.path_on_disk(octoprint.filemanager.FileDestinations.LOCAL, filename)
+		except Exception:
+			flask.abort(404)
+		thumbnail = self._thumbnail_cache.get(path_on_disk)
+		if thumbnail is None:
+			flask.abort(404)
+		key, thumbnail_path = thumbnail
+		with open(thumbnail_path, "rb") as thumbnail_file:
+			response = flask.make_response(thumbnail_file.read())
+		response.mimetype = "image/png"
+		response.set_etag(key)
+		response.last_modified = os.path.getmtime(path_on_disk)
+		response.cache_control.private = True
+		response.cache_control.max_age = 0
+		response.cache_control.must_revalidate = True
+		return response.make_conditional(flask.request)
+
+	def is_blueprint_csrf_protected(self):
+		return True
 
 
 	##############################################
@@ -298,10 +377,20 @@ class Chituboard(   octoprint.plugin.SettingsPlugin,
 	##############################################
 	def get_sla_printer_factory(self,components):
 		"""
-		Replace octoprint standard.py with new version
+		Replace octoprint standard.py with new version. The hook runs before
+		initialize(), so settings are applied to the printer from there.
 		"""
-		self.sla_printer = Sla_printer(components["file_manager"],components["analysis_queue"],components["printer_profile_manager"])
+		from .sla_printer import Sla_printer
+
+		self.sla_printer = Sla_printer(components["file_manager"],components["analysis_queue"],components["printer_profile_manager"], analysis_cache=lambda: self._analysis_cache)
 		return self.sla_printer
+
+	def _apply_upload_settings(self):
+		if self.sla_printer is None:
+			return
+		# without the Pi as flash drive, files go to the printer's storage over the UART
+		self.sla_printer.uart_upload = not self._settings.get_boolean(["workAsFlashDrive"])
+		self.sla_printer.upload_window = max(self._settings.get_int(["uploadWindow"]), 1)
 		
 			
 	##############################################
@@ -321,29 +410,32 @@ class Chituboard(   octoprint.plugin.SettingsPlugin,
 	regex_float_pattern = r"[-+]?[0-9]*\.?[0-9]+"
 	regex_positive_float_pattern = r"[+]?[0-9]*\.?[0-9]+"
 	regex_int_pattern = r"\d+"
-	parse_M4000 = {
-		"floatB": re.compile(r"(^|[^A-Za-z])[Bb]:\s*(?P<actual>%s)(\s*\/?\s*(?P<target>%s))" %
-						 (regex_float_pattern, regex_float_pattern)),
-		"floatD": re.compile(r"(^|[^A-Za-z])[Dd]:\s*(?P<current>%s)(\s*\/?\s*(?P<total>%s))(\s*\/?\s*(?P<pause>%s))" %
-						 (regex_float_pattern, regex_float_pattern, regex_int_pattern)),
-		"floatE": re.compile(r"(^|[^A-Za-z])[Ee](?P<value>%s)" % regex_float_pattern),
-		"floatX": re.compile(r"(^|[^A-Za-z])[Xx]:(?P<value>%s)" % regex_float_pattern),
-		"floatY": re.compile(r"(^|[^A-Za-z])[Yy]:(?P<value>%s)" % regex_float_pattern),
-		"floatZ": re.compile(r"(^|[^A-Za-z])[Zz]:(?P<value>%s)" % regex_float_pattern),
-		"intN": re.compile(r"(^|[^A-Za-z])[Nn](?P<value>%s)" % regex_int_pattern),
-		"intS": re.compile(r"(^|[^A-Za-z])[Ss](?P<value>%s)" % regex_int_pattern),
-		"intT": re.compile(r"(^|[^A-Za-z])[Tt](?P<value>%s)" % regex_int_pattern),
-		}
+	parse_M4000 = parse_M4000
 	"""Regexes for parsing M4000 parameters. Due to inconsistencies between printers"""
 		
 	def get_gcode_receive_modifier(self, comm_instance, line, *args, **kwargs):
-		line = self._rewrite_wait_to_busy(line)
-		line = self._rewrite_identifier(line)
-		line, end_msg = self._rewrite_print_finished(line)
-		line = self._rewrite_start(line)
-		line = self._rewrite_m4000_response(line)
-		line = self._rewrite_m114_response(line)
-		line = self._rewrite_error(line)
+		# one regex search decides which rewrite applies, the rewrites
+		# still check the line themselves
+		kind = classify_received(line)
+		if kind is None:
+			return line
+		end_msg = False
+		if kind == "m4000":
+			self.gcode_modifier.poll_scheduler.reply_received("temperature_poll")
+			line = self._rewrite_m4000_response(line)
+		elif kind == "sd_byte":
+			self._track_layer(line)
+			line, end_msg = self._rewrite_print_finished(line)
+		elif kind == "wait":
+			line = self._rewrite_wait_to_busy(line)
+		elif kind == "identifier":
+			line = self._rewrite_identifier(line)
+		elif kind == "start":
+			line = self._rewrite_start(line)
+		elif kind == "m114":
+			line = self._rewrite_m114_response(line)
+		elif kind == "error":
+			line = self._rewrite_error(line)
 		if end_msg == True:
 			try:
 				# for some reason the printer doesn't properly 
@@ -353,6 +445,20 @@ class Chituboard(   octoprint.plugin.SettingsPlugin,
 				self._logger.exception("Error while changing state")
 		return line
 	
+	def _track_layer(self, line):
+		"""
+		Passes the layer of an M27 reply to the poll scheduler
+		"""
+		scheduler = self.gcode_modifier.poll_scheduler
+		scheduler.reply_received("sd_status_poll")
+		if not scheduler.active:
+			return
+		match = self.regex_sdPrintingByte.search(line)
+		if match:
+			position = self._printer.locate_layer(int(match.group("current")))
+			if position:
+				scheduler.layer_seen(position.index)
+
 	def _rewrite_m4000_response(self,line):
 		"""
 		convert M4000 response to M105 report temp response
@@ -360,10 +466,7 @@ class Chituboard(   octoprint.plugin.SettingsPlugin,
 		"""
 		rewritten = None
 		matchB = self.parse_M4000["floatB"].search(line)
-		matchD = self.parse_M4000["floatD"].search(line)
-		matchX = self.parse_M4000["floatX"].search(line)
-		matchY = self.parse_M4000["floatY"].search(line)
-		matchZ = self.parse_M4000["floatZ"].search(line)
+		matchD = self._printer.is_pausing() and self.parse_M4000["floatD"].search(line)
 		
 		if matchB:
 			try:
@@ -374,7 +477,7 @@ class Chituboard(   octoprint.plugin.SettingsPlugin,
 				self._logger.info("Error parsing M400 response ", type(inst), inst)
 			else:
 				rewritten = line.replace(matchB.group(0), " T:0 /0 B:{} /{}\r\n".format(actual,target))
-		if matchD and self._printer.is_pausing():
+		if matchD:
 			try:
 				current = int(matchD.group('current'))
 				total = int(matchD.group('total'))
@@ -386,9 +489,9 @@ class Chituboard(   octoprint.plugin.SettingsPlugin,
 				# printer is now paused
 					self._printer._comm._record_pause_data = True
 					self._printer._comm._changeState(self._printer._comm.STATE_PAUSED)
-					Xpos = matchX.group("value")
-					Ypos = matchY.group("value")
-					Zpos = matchZ.group("value")
+					Xpos = self.parse_M4000["floatX"].search(line).group("value")
+					Ypos = self.parse_M4000["floatY"].search(line).group("value")
+					Zpos = self.parse_M4000["floatZ"].search(line).group("value")
 					self._logger.info("printer paused from parse M4000")
 					rewritten = "ok X:{} Y:{} Z:{} E:0.000000".format(Xpos, Ypos, Zpos)
 					
@@ -0,0 +1,167 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+import collections
+import hashlib
+import json
+import logging
+import os
+import threading
+from pathlib import Path
+
+# Bump when the layout of the cache entries changes, old entries are
+# then treated as misses and evicted over time
+CACHE_SCHEMA_VERSION = 1
+# bytes from the start of the file hashed together with the layer table,
+# large enough to cover the header, print parameters and machine name of
+# every supported format
+HEADER_BYTES = 4096
+# paths whose fingerprint is remembered between calls
+MAX_REMEMBERED_KEYS = 256
+
+
+def fingerprint(path):
+	"""
+	Content key of a sliced file: its size and a hash of the header and
+	the layer definition table. Copies of a file under another name get
+	the same key, the layer images themselves are never read.
+	"""
+	from .file_formats.utils import get_file_format
+
+	file_format = get_file_format(path)
+	size = os.path.getsize(path)
+	digest = hashlib.blake2b(digest_size=16)
+	with file_format.open(Path(path)) as model:
+		digest.update(model.buffer[:HEADER_BYTES])
+		digest.update(model.layer_defs.tobytes())
+	return "{:x}-{}".format(size, digest.hexdigest())
+
+
+def evict_lru(folder, max_bytes, suffix):
+	"""
+	Removes the files ending in suffix with the oldest mtime until the
+	rest fit into max_bytes. Cache hits bump the mtime.
+	"""
+	entries = []
+	for name in os.listdir(folder):
+		if not name.endswith(suffix):
+			continue
+		try:
+			stat = os.stat(os.path.join(folder, name))
+		except OSError:
+			continue
+		entries.append((stat.st_mtime, stat.st_size, name))
+	total = sum(size for _, size, _ in entries)
+	for _, size, name in sorted(entries):
+		if total <= max_bytes:
+			break
+		try:
+			os.remove(os.path.join(folder, name))
+		except OSError:
+			continue
+		total -= size
+
+
+class AnalysisCache():
+	"""
+	Persistent analysis results keyed by file content. One JSON file per
+	entry is kept in folder, the least recently used entries are removed
+	once the folder grows beyond max_bytes.
+	"""
+
+	def __init__(self, folder, max_bytes=50 * 1024 * 1024):
+		self._logger = logging.getLogger(__name__)
+		self._folder = folder
+		self.max_bytes = max_bytes
+		self._lock = threading.RLock()
+		# path -> (size, mtime, key) of the most recently used paths, skips
+		# hashing files seen before
+		self._keys = collections.OrderedDict()
+		self.hits = 0
+		self.misses = 0
+		self.bytes_saved = 0
+		if not os.path.isdir(folder):
+			os.makedirs(folder)
+
+	def _entry_path(self, key):
+		return os.path.join(self._folder, key + ".json")
+
+	def key_for(self, path):
+		"""
+		Fingerprint of path or None if it is no readable sliced file
+		"""
+		try:
+			stat = os.stat(path)
+		except OSError:
+			return None
+		stat_key = (stat.st_size, stat.st_mtime_ns)
+		with self._lock:
+			known = self._keys.get(str(path))
+			if known is not None and known[:2] == stat_key:
+				self._keys.move_to_end(str(path))
+				return known[2]
+		try:
+			key = fingerprint(path)
+		except Exception as inst:
+			self._logger.debug("Could not fingerprint {}: {}".format(path, inst))
+			return None
+		with self._lock:
+			self._keys[str(path)] = stat_key + (key,)
+			self._keys.move_to_end(str(path))
+			while len(self._keys) > MAX_REMEMBERED_KEYS:
+				self._keys.popitem(last=False)
+		return key
+
+	def get(self, path):
+		"""
+		Returns the cached analysis result for path, with path and
+		filename set to the file asked for, or None on a miss
+		"""
+		key = self.key_for(path)
+		if key is None:
+			return None
+		entry_path = self._entry_path(key)
+		with self._lock:
+			try:
+				with open(entry_path, "r") as entry_file:
+					entry = json.load(entry_file)
+				if entry.get("schema") != CACHE_SCHEMA_VERSION:
+					raise ValueError("cache schema {!r}".format(entry.get("schema")))
+				os.utime(entry_path)
+			except (OSError, ValueError):
+				self.misses += 1
+				return None
+			self.hits += 1
+			self.bytes_saved += entry.get("size", 0)
+		result = entry["result"]
+		result["path"] = str(path)
+		result["filename"] = os.path.basename(str(path))
+		return result
+
+	def put(self, path, result):
+		key = self.key_for(path)
+		if key is None:
+			return
+		entry = {
+			"schema": CACHE_SCHEMA_VERSION,
+			"size": os.path.getsize(path),
+			"result": result,
+		}
+		entry_path = self._entry_path(key)
+		tmp_path = entry_path + ".tmp"
+		with self._lock:
+			try:
+				with open(tmp_path, "w") as entry_file:
+					json.dump(entry, entry_file, separators=(",", ":"))
+				os.replace(tmp_path, entry_path)
+			except (OSError, TypeError, ValueError) as inst:
+				self._logger.warning("Could not cache analysis of {}: {}".format(path, inst))
+				return
+			evict_lru(self._folder, self.max_bytes, ".json")
+
+	def stats(self):
+		with self._lock:
+			return dict(
+				hits = self.hits,
+				misses = self.misses,
+				bytesSaved = self.bytes_saved)
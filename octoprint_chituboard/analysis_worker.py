@@ -0,0 +1,208 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+import json
+import logging
+import multiprocessing
+import threading
+import time
+from pathlib import Path
+
+# Bump when fields of the result envelope are renamed or removed
+RESULT_SCHEMA_VERSION = 1
+
+
+class ResultSchemaError(ValueError):
+	pass
+
+
+def analyse_file(path, timings=None, full_model=False):
+	"""
+	Reads a sliced file and returns the analysis result dict shared by
+	the analysis worker and the sla_analysis CLI command. Seconds spent
+	per phase are added to timings if given.
+
+	With full_model every layer is decoded (see
+	file_formats.model_analysis) and the measured volume, bounding box
+	and per layer table are added under "model".
+	"""
+	from .file_formats.utils import get_file_format
+
+	file_format = get_file_format(path)
+	sliced_model_file = file_format.read(Path(path), timings=timings)
+	result = analysis_result(sliced_model_file, path)
+	if full_model:
+		from .file_formats.model_analysis import analyse_model
+
+		start = time.perf_counter()
+		result["model"] = analyse_model(Path(path)).to_dict(with_layers=True)
+		if timings is not None:
+			timings["full_model"] = time.perf_counter() - start
+	return result
+
+
+def analysis_result(sliced_model_file, path):
+	"""
+	Result dict of an already read sliced file, holds everything
+	SlicedModelFile.from_analysis needs to rebuild it
+	"""
+	layer_defs = sliced_model_file.layer_defs
+	return {
+		"filename": sliced_model_file.filename,
+		"path": str(path),
+		"bed_size_mm": list(sliced_model_file.bed_size_mm),
+		"height_mm": round(sliced_model_file.height_mm, 4),
+		"layer_count": sliced_model_file.layer_count,
+		"layer_height_mm": round(sliced_model_file.layer_height_mm, 4),
+		"resolution": list(sliced_model_file.resolution),
+		"print_time_secs": sliced_model_file.print_time_secs,
+		"total_time": sliced_model_file.print_time_secs/60,
+		"volume": sliced_model_file.volume,
+		"slicer_version": sliced_model_file.slicer_version,
+		"printer_name": sliced_model_file.printer_name,
+		"printing_area": sliced_model_file.printing_area,
+		"dimensions": sliced_model_file.dimensions,
+		"end_byte_offset_by_layer": [int(x) for x in sliced_model_file.end_byte_offset_by_layer],
+		"start_byte_offset_by_layer":
+			None if layer_defs is None else layer_defs["image_offset"].tolist(),
+		}
+
+
+def analyse_envelope(path, full_model=False):
+	"""
+	Runs analyse_file and wraps the outcome in the versioned envelope
+
+		{"schema": 1, "path": ..., "result": {...}, "timings": {...}}
+
+	with "error" instead of "result" if the file could not be read.
+	"""
+	timings = {}
+	envelope = {"schema": RESULT_SCHEMA_VERSION, "path": path}
+	start = time.perf_counter()
+	try:
+		envelope["result"] = analyse_file(path, timings=timings, full_model=full_model)
+	except Exception as inst:
+		envelope["error"] = "{}: {}".format(type(inst).__name__, inst)
+	timings["total"] = time.perf_counter() - start
+	envelope["timings"] = {k: round(v, 6) for k, v in timings.items()}
+	return envelope
+
+
+def encode_result(envelope) -> bytes:
+	return json.dumps(envelope, separators=(",", ":"), default=_json_default).encode("utf-8")
+
+
+def decode_result(data) -> dict:
+	"""
+	Parses an encoded envelope, raises ResultSchemaError if it was
+	written by an incompatible version
+	"""
+	envelope = json.loads(data)
+	if not isinstance(envelope, dict) or envelope.get("schema") != RESULT_SCHEMA_VERSION:
+		raise ResultSchemaError("Unsupported analysis result schema {!r}".format(
+			envelope.get("schema") if isinstance(envelope, dict) else None))
+	return envelope
+
+
+def _json_default(value):
+	# numpy scalars that slip through from the file readers
+	if hasattr(value, "item"):
+		return value.item()
+	if hasattr(value, "tolist"):
+		return value.tolist()
+	raise TypeError("{!r} is not JSON serializable".format(value))
+
+
+def _worker_main(conn):
+	"""
+	Worker process loop, jobs are taken from the pipe until None is
+	received. Format modules (and numpy) are imported by the first job
+	that needs them and stay loaded.
+	"""
+	while True:
+		try:
+			path = conn.recv()
+		except EOFError:
+			break
+		if path is None:
+			break
+		conn.send_bytes(encode_result(analyse_envelope(path)))
+	conn.close()
+
+
+class AnalysisCancelled(Exception):
+	pass
+
+
+class AnalysisWorker():
+	"""
+	Long lived process running the file analysis, so each uploaded file
+	doesn't have to pay for starting a new interpreter and importing
+	OctoPrint. Aborting a job terminates the process, a new one is
+	started with the next job.
+	"""
+
+	def __init__(self, poll_interval=0.1):
+		self._logger = logging.getLogger(__name__)
+		self._poll_interval = poll_interval
+		self._context = multiprocessing.get_context("spawn")
+		self._process = None
+		self._conn = None
+		self._lock = threading.RLock()
+
+	def start(self):
+		with self._lock:
+			if self._process is not None and self._process.is_alive():
+				return
+			self._conn, child_conn = self._context.Pipe()
+			self._process = self._context.Process(
+				target=_worker_main, args=(child_conn,), name="chituboard-analysis", daemon=True)
+			self._process.start()
+			child_conn.close()
+			self._logger.info("Started analysis worker pid {}".format(self._process.pid))
+
+	def stop(self, timeout=5):
+		with self._lock:
+			if self._process is None:
+				return
+			try:
+				self._conn.send(None)
+			except (OSError, ValueError):
+				pass
+			self._process.join(timeout)
+			self._kill()
+
+	def _kill(self):
+		if self._process is not None and self._process.is_alive():
+			self._process.terminate()
+			self._process.join()
+		if self._conn is not None:
+			self._conn.close()
+		self._process = None
+		self._conn = None
+
+	def analyse(self, path, is_aborted=lambda: False):
+		"""
+		Runs one analysis in the worker and blocks until it is done,
+		returning the decoded result envelope. Raises AnalysisCancelled
+		if is_aborted() turns true meanwhile.
+		"""
+		with self._lock:
+			self.start()
+			self._conn.send(path)
+			try:
+				while not self._conn.poll(self._poll_interval):
+					if is_aborted():
+						self._logger.info("Aborting analysis of {}".format(path))
+						self._kill()
+						raise AnalysisCancelled()
+					if not self._process.is_alive():
+						raise EOFError()
+				data = self._conn.recv_bytes()
+			except (EOFError, OSError):
+				self._kill()
+				raise RuntimeError("Analysis worker died while analysing {}".format(path))
+		envelope = decode_result(data)
+		if "error" in envelope:
+			raise RuntimeError(envelope["error"])
+		return envelope
@@ -1,28 +1,220 @@
 # coding=utf-8
-#from socket import *
+import asyncio
 import socket
-import netifaces as ni
-from uuid import getnode as get_mac
 from octoprint.filemanager.destinations import FileDestinations
 import octoprint.filemanager
-import multiprocessing
-import struct
 
 import octoprint.util
 import logging
+import re
 import threading
-import select
-#https://docs.python.org/3/library/socket.html
+import time
+
+from .uart_upload import parse_packet
+#https://docs.python.org/3/library/asyncio-protocol.html#datagram-protocols
 
 PRINTERNAME = "Mars 2"
+PORT = 3000
+
+# packets ahead of a gap that are kept in memory until the gap is filled
+MAX_PENDING_PACKETS = 256
+# write buffer of the uploaded file
+WRITE_BUFFER_SIZE = 1 << 20
+COMMAND = re.compile(rb"(M\d+)(?:\s|$)")
+
+
+class UploadStats():
+
+    def __init__(self):
+        self.started = time.monotonic()
+        self.finished = None
+        self.bytes = 0
+        self.packets = 0
+        self.duplicates = 0
+        self.out_of_order = 0
+        self.checksum_errors = 0
+
+    @property
+    def elapsed(self):
+        return (self.finished or time.monotonic()) - self.started
+
+    def as_dict(self):
+        elapsed = self.elapsed
+        return dict(
+            bytes=self.bytes,
+            packets=self.packets,
+            duplicates=self.duplicates,
+            outOfOrder=self.out_of_order,
+            checksumErrors=self.checksum_errors,
+            elapsed=elapsed,
+            bytesPerSec=self.bytes / elapsed if elapsed > 0 else 0.0)
+
+
+class ChituUpload():
+    """
+    File being received from Chitubox. Packets carry their file offset,
+    the ones arriving ahead of a gap wait in memory until it is filled so
+    the file is always written front to back through a large buffer.
+    """
+
+    def __init__(self, name, path):
+        self.name = name
+        self.path = path
+        self.file = open(path, "wb", buffering=WRITE_BUFFER_SIZE)
+        self.position = 0   # bytes written without a gap
+        self.pending = {}   # offset -> data of packets past position
+        self.stats = UploadStats()
+
+    def add(self, offset, data):
+        """
+        Stores one packet, returns False if it is too far ahead to keep
+        """
+        self.stats.packets += 1
+        if offset < self.position or offset in self.pending:
+            self.stats.duplicates += 1
+            return True
+        if offset > self.position:
+            if len(self.pending) >= MAX_PENDING_PACKETS:
+                return False
+            self.stats.out_of_order += 1
+            self.pending[offset] = data
+            return True
+        self._write(data)
+        while self.position in self.pending:
+            self._write(self.pending.pop(self.position))
+        return True
+
+    def _write(self, data):
+        self.file.write(data)
+        self.position += len(data)
+        self.stats.bytes += len(data)
+
+    def close(self):
+        self.file.close()
+        self.stats.finished = time.monotonic()
+
+
+class ChituUploadProtocol(asyncio.DatagramProtocol):
+    """
+    Answers Chitubox like a networked printer: discovery (M99999), printer
+    info (M4001), file upload (M28, packets, M4012 progress query, M29) and
+    print start (M6030).
+    """
+
+    def __init__(self, comm):
+        self.comm = comm
+        self.transport = None
+        self.upload = None
+        self.last_upload = None
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def error_received(self, exc):
+        self.comm._logger.info("Chitubox receiver socket error: {}".format(exc))
+
+    def datagram_received(self, data, addr):
+        match = COMMAND.match(data)
+        if self.upload is not None:
+            packet = parse_packet(data)
+            # damaged packets get a resend unless they look like a command
+            if packet is not None or match is None:
+                self.packet_received(packet, addr)
+                return
+        handler = self.commands.get(match.group(1).decode("ascii")) if match else None
+        if handler is None:
+            self.comm._logger.debug("Ignoring Chitubox message {!r}".format(data[:32]))
+            return
+        handler(self, data.decode("latin-1").strip(), addr)
+
+    def reply(self, answer, addr):
+        self.transport.sendto(answer.encode("utf-8"), addr)
+
+    def packet_received(self, packet, addr):
+        upload = self.upload
+        if packet is None:
+            upload.stats.checksum_errors += 1
+            self.reply("resend {}".format(upload.position), addr)
+            return
+        if not upload.add(packet[1], packet[0]):
+            self.reply("resend {}".format(upload.position), addr)
+            return
+        self.reply("ok", addr)
+
+    def on_discovery(self, command, addr):
+        comm = self.comm
+        self.reply("ok MAC:{} IP:{} VER:{} ID:{} NAME:{}".format(
+            comm.mac, comm.ip, comm.version, comm.id, comm.name), addr)
+
+    def on_info(self, command, addr):
+        #ok X:0.012500 Y:0.012500 Z:0.000625 E:0.001340 T:0/0/0/155/1 U:'GBK' B:1
+        self.reply("ok X:0.012500 Y:0.012500 Z:" + self.comm.z_step_hight +
+            " E:0.001340 T:0/0/0/155/1 U:'GBK' B:1", addr)
+
+    def on_upload_start(self, command, addr):
+        name = command[3:].strip()
+        if self.upload is not None:
+            self.finish_upload()
+        path = self.comm.sup._settings.global_get_basefolder("watched") + "/" + name
+        try:
+            self.upload = ChituUpload(name, path)
+        except OSError as e:
+            self.comm._logger.info("cant write to file {}: {}".format(path, e))
+            self.reply("Error:can't open file", addr)
+            return
+        self.comm._logger.info("start file upload of {}".format(name))
+        self.reply("ok", addr)
+
+    def on_upload_progress(self, command, addr):
+        position = self.upload.position if self.upload is not None else 0
+        self.reply("ok {}/1".format(position), addr)
+
+    def on_upload_end(self, command, addr):
+        if self.upload is not None:
+            self.finish_upload()
+        self.reply("ok", addr)
+
+    def finish_upload(self):
+        upload, self.upload = self.upload, None
+        upload.close()
+        if upload.pending:
+            self.comm._logger.info("upload of {} ended with {} packets missing before byte {}".format(
+                upload.name, len(upload.pending), max(upload.pending)))
+        stats = upload.stats.as_dict()
+        self.comm._logger.info(
+            "end file upload of {}: {bytes} bytes in {elapsed:.1f} s, {kbs:.1f} kB/s, "
+            "{checksumErrors} bad packets, {outOfOrder} out of order, {duplicates} duplicates".format(
+                upload.path, kbs=stats["bytesPerSec"] / 1024, **stats))
+        self.comm.nameLastUploadedFile = upload.name
+        self.comm.uploaded_file_path = upload.path
+        self.comm.last_upload_stats = stats
+        self.last_upload = upload
+
+    def on_print_start(self, command, addr):
+        self.comm._logger.info("recive M6030 start Print")
+        if self.comm.nameLastUploadedFile is not None:
+            filenameToSelect = self.comm.sup._file_manager.path_on_disk(
+                FileDestinations.LOCAL, self.comm.nameLastUploadedFile)
+            self.comm.sup.sla_printer.select_file(filenameToSelect, False, printAfterSelect=True)
+        self.reply("ok", addr)
+
+    commands = {
+        "M99999": on_discovery,
+        "M4001": on_info,
+        "M28": on_upload_start,
+        "M4012": on_upload_progress,
+        "M29": on_upload_end,
+        "M6030": on_print_start,
+    }
+
 
 class chitu_comm():
 
     def __init__(self,sel):
 
         self.sup = sel
+        self._logger = logging.getLogger("octoprint.plugins.Chituboard.chitu_comm")
 
-        self.file_is_uploading = False
         self.ip = "0.0.0.0"
 
         for addr in octoprint.util.interface_addresses():
@@ -30,196 +222,72 @@ class chitu_comm():
                 self.ip = addr
 
         self.mac = "0:0:0:0"
-                
+
         self.name = "Octoprint"
         self.version = "V1.4.1"
         self.id = "28,00,26,00,0d,50,48,50"
         self.z_step_hight = "0.000625"
-        self.ok_answer = str.encode("ok")
         self.nameLastUploadedFile = None
-        self.file_handler = None
         self.uploaded_file_path = None
-        self.shutdownSig = False
-
-        self.last_file_position_count = 0
-        
-
-        def get_host_ip(self, parameter_list):
-            #[ad["addr"] for ad in ni.ifaddresses(interface)[ni.AF_INET]
-            pass
-            #TODO: implemet
+        self.last_upload_stats = None
+        self.printCB = None
 
-        def get_host_mac(self, parameter_list):
-            pass
-            #TODO: implemet
+        self.port = PORT
+        self.loop = None
+        self.transport = None
+        self.protocol = None
+        self.listen_thread = None
 
-        def set_host_ip(self, parameter_list):
-            pass    #':'.join(("%012X" % get_mac())[i:i+2] for i in range(0, 12, 2))
-            #TODO: implemet
-
-        def set_host_mac(self, parameter_list):
-            pass
-            #TODO: implemet
-
-        def find_host_ip(self, parameter_list):
-            pass
-            #TODO: implemet #gethostbyname(gethostname())
-
-        def find_host_mac(self, parameter_list):
-            pass
-            #TODO: implemet
+    @property
+    def file_is_uploading(self):
+        return self.protocol is not None and self.protocol.upload is not None
 
     def printstartCP(self,cb=None):
         if cb is not None:
             self.printCB = cb
-    # ~ def process_m99999(message):
-        # ~ """
-        # ~ M99999 is used to process Chitubox brocast requests
-        # ~ """
-        # ~ resp = "ok. NAME:{0} IP:{1} \n".format(PRINTERNAME, localIp)
-        # ~ s.sendto(resp, address)
-        # ~ if debug:
-            # ~ print("Info: Received broadcast request from {0}\n".format(address[0]))
-            # ~ print("Recv: {0}\nSend: {1}".format(str(message), resp))
-    
-    def shutdownService(self):
-        pass
-        #self.process_conn.send("shutdown")
 
     def start_listen_reqest(self):
-        
-        self.listen_thread = threading.Thread(target=self.listen_request)
+        """
+        Starts the receiver on its own event loop thread
+        """
+        self.loop = asyncio.new_event_loop()
+        started = threading.Event()
+        self.listen_thread = threading.Thread(target=self.listen_request, args=(started,))
         self.listen_thread.daemon = True
         self.listen_thread.start()
-        
-        """
-        self.process_conn, child_conn = multiprocessing.Pipe()
-        self.udp_process = multiprocessing.Process(target=self.listen_request,args=(child_conn,))
+        started.wait(5)
 
-        self.udp_process.start()
-        """
-    def listen_request(self):
-        self.file_is_uploading = False
-        
-        self.s=socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    def listen_request(self, started=None):
+        asyncio.set_event_loop(self.loop)
+        try:
+            self.loop.run_until_complete(self._open_endpoint())
+            self._logger.info("Info: Chitubox file receiver is now listening on the port {0}\n".format(str(self.port)))
+        except OSError as e:
+            self._logger.info("Chitubox file receiver can't listen on port {}: {}".format(self.port, e))
+            return
+        finally:
+            if started is not None:
+                started.set()
+        try:
+            self.loop.run_forever()
+        finally:
+            if self.protocol is not None and self.protocol.upload is not None:
+                self.protocol.finish_upload()
+            self.transport.close()
+            self.loop.run_until_complete(asyncio.sleep(0))
+            self.loop.close()
+
+    async def _open_endpoint(self):
+        s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
         s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
         s.setsockopt(socket.SOL_SOCKET, socket.SO_BROADCAST, 1)
-        
-        self.s.bind(('',3000))
-        self.s.settimeout(2)
-        port = 3000
-        self._logger.info("Info: Chitubox file receiver is now listening on the port {0}\n".format(str(port)))
-        # ~ file_handler = None
-        # ~ uploaded_file_path = None
-        # ~ shutdownSig = False
-        
-        while True:
-            #print(conn.recv())
-            #if conn.recv() == "shutdown":
-            #    self.s.close()
-            #    break
-            try:
-                m = self.s.recvfrom(4096)
-            except socket.timeout:
-                continue
-    
-            except KeyboardInterrupt:
-                self.s.close()
-                break
-            ############################################
-            #file upload processing
-            ############################################
-            
-            if self.file_is_uploading is True:
-                if "M4012 I1" in m[0].decode('latin-1'):
-                    self._logger.info("recive M4012 I1")
-                    
-                    #print("%s count" % (struct.unpack("<i",message_end_part)[0] 
-                    
-                    answer = "ok "+ str(last_file_position_count)+"/1"
-                    answer_as_bytes = str.encode(answer)
-                    self.s.sendto(answer_as_bytes,m[1])
-                    
-                    continue     
-    
-    
-                if "M29" in m[0].decode('latin-1'):
-                    self._logger.info("recive M29 end file upload")
-                    self.sup._logger.info("end fileupload of file: "+uploaded_file_path)
-    
-                    self.file_handler.close()
-    
-                    self.file_is_uploading = False
-    
-                    self.s.sendto(self.ok_answer,m[1])
-                    continue
-    
-                message_end_part = m[0][len(m[0])-6:len(m[0])-2]
-                last_file_position_count = struct.unpack("<i",message_end_part)[0] + len(m[0])-6
-    
-    
-                #TODO:byte len(m[0])-1 ist die "prüfsumme" 
-                # muss noch validiert werden.
-                #wenn prüfsumme falsch sende resend antwort
-                """
-                if (receivedText.Find("resend") != wxNOT_FOUND)
-                {
-                    long resend_index = getValue(receivedText, "resend ", -1);
-                    photonFile->Seek(resend_index, wxFromStart);
-                }
-                
-                """
-    
-                self.file_handler.write(m[0][0:len(m[0])-6])
-    
-                last_file_position_count = struct.unpack("<i",message_end_part)[0] + len(m[0])-6
-    
-                self.s.sendto(self.ok_answer,m[1])
-                continue
-    
-            #############################################
-    
-            if m[0] == b'M99999':#to find printer in network
-                self._logger.info("recive M99999 broadcast message")
-    
-                answer = 'ok MAC:'+ self.mac +' IP:'+self.ip.encode("utf-8")+' VER:'+self.version+' ID:'+self.id+' NAME:'+self.name
-                answer_as_bytes = str.encode(answer)
-                self.s.sendto(answer_as_bytes,m[1])
-                continue
-    
-            if m[0] == b'M4001':
-                #ok X:0.012500 Y:0.012500 Z:0.000625 E:0.001340 T:0/0/0/155/1 U:'GBK' B:1
-                #self.log.info("recive M4001 init Message")
-                answer = "ok X:0.012500 Y:0.012500 Z:"+self.z_step_hight+" E:0.001340 T:0/0/0/155/1 U:'GBK' B:1"
-                answer_as_bytes = str.encode(answer)
-                self.s.sendto(answer_as_bytes,m[1])
-                continue
-    
-            ############################################
-            #file upload
-            ############################################
-            if "M28" in m[0].decode('latin-1'):
-                self._logger.info("recive M28 start Fileupload")
-                
-                self.nameLastUploadedFile = m[0][3:len(m[0])].decode('latin-1')
-                self.uploaded_file_path = self.sup._settings.global_get_basefolder("watched") + "/" + self.nameLastUploadedFile
-    
-                try:
-                    self.file_handler = open(self.uploaded_file_path, "wb")
-                except OSError as e:
-                    self.sup._logger.info("cant write to file "+ file_path +" , throwing error")
-                
-                self.file_is_uploading = True
-                self.s.sendto(self.ok_answer,m[1])
-                continue
-    
-            if "M6030" in m[0].decode('latin-1'):
-                print("recive M6030 start Print")
-    
-                filenameToSelect = self.sup._file_manager.path_on_disk(FileDestinations.LOCAL, self.nameLastUploadedFile)
-                print(filenameToSelect)
-                self.sup.sla_printer.select_file(filenameToSelect, False, printAfterSelect=True)
-    
-                self.s.sendto(self.ok_answer,m[1])
-                continue
-            ##self._storage(destination).file_in_path(path, file)
+        # large receive buffer so bursts from Chitubox aren't dropped
+        s.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, WRITE_BUFFER_SIZE)
+        s.bind(("", self.port))
+        self.transport, self.protocol = await self.loop.create_datagram_endpoint(
+            lambda: ChituUploadProtocol(self), sock=s)
+
+    def shutdownService(self):
+        if self.loop is not None and self.loop.is_running():
+            self.loop.call_soon_threadsafe(self.loop.stop)
+            self.listen_thread.join(5)
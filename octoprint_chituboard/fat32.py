@@ -0,0 +1,588 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+"""
+Writes files straight into the FAT32 image exported to the printer by
+g_mass_storage (/piusb.bin, see Chituboard.sh), without going through
+the vfat loop mount:
+
+	with UsbImage("/piusb.bin", mount_point).edit() as image:
+		image.write_file("model.ctb", "/tmp/model.ctb")
+
+Only the root directory is handled, which is where the printer looks for
+files. A file that is replaced keeps its clusters and only the sectors
+whose content changed are written, so is the FAT and the directory.
+
+Run python -m octoprint_chituboard.fat32 --help for the command line.
+"""
+
+import contextlib
+import glob
+import itertools
+import os
+import struct
+import subprocess
+import sys
+import time
+from typing import Iterator, List, NamedTuple, Optional
+
+FREE = 0
+END_OF_CHAIN = 0x0FFFFFFF
+_CLUSTER_MASK = 0x0FFFFFFF
+
+ATTR_READ_ONLY = 0x01
+ATTR_HIDDEN = 0x02
+ATTR_SYSTEM = 0x04
+ATTR_VOLUME_ID = 0x08
+ATTR_DIRECTORY = 0x10
+ATTR_ARCHIVE = 0x20
+ATTR_LONG_NAME = 0x0F
+
+_DELETED = 0xE5
+_ENTRY_SIZE = 32
+_LFN_CHARS = 13
+_SHORT_NAME_CHARS = set(b"ABCDEFGHIJKLMNOPQRSTUVWXYZ0123456789!#$%&'()-@^_`{}~")
+
+# g_mass_storage LUN backing file, writing to it ejects / inserts the medium
+GADGET_LUN_GLOB = "/sys/devices/platform/soc/*.usb/gadget*/lun0/file"
+GADGET_OPTIONS = ["removable=1", "ro=0", "stall=0"]
+
+
+class Fat32Error(Exception):
+	pass
+
+
+class BootSector(NamedTuple):
+	bytes_per_sector: int
+	sectors_per_cluster: int
+	reserved_sectors: int
+	fat_count: int
+	root_entries: int
+	total_sectors_16: int
+	media: int
+	fat_size_16: int
+	sectors_per_track: int
+	heads: int
+	hidden_sectors: int
+	total_sectors_32: int
+	fat_size_32: int
+	ext_flags: int
+	fs_version: int
+	root_cluster: int
+	fs_info_sector: int
+
+	@property
+	def total_sectors(self) -> int:
+		return self.total_sectors_16 or self.total_sectors_32
+
+
+_BOOT_SECTOR = struct.Struct("<HBHBHHBHHHIIIHHIH")
+_BOOT_SECTOR_OFFSET = 11
+# name, attr, nt_res, ctime_tenth, ctime, cdate, adate, cluster_hi, wtime, wdate, cluster_lo, size
+_DIR_ENTRY = struct.Struct("<11sBBBHHHHHHHI")
+# order, name1, attr, type, checksum, name2, cluster, name3
+_LFN_ENTRY = struct.Struct("<B10sBBB12sH4s")
+_FS_INFO_SIGNATURES = ((0, 0x41615252), (484, 0x61417272))
+_UINT32 = struct.Struct("<I")
+
+
+class DirEntry(NamedTuple):
+	name: str  # long name if there is one
+	short_name: bytes  # 11 bytes, space padded
+	attr: int
+	first_cluster: int
+	size: int
+	slots: List[int]  # entry numbers in the directory, long name parts first
+
+
+def _lfn_checksum(short_name: bytes) -> int:
+	total = 0
+	for byte in short_name:
+		total = (((total & 1) << 7) + (total >> 1) + byte) & 0xFF
+	return total
+
+
+def _short_name_text(short_name: bytes) -> str:
+	base, ext = short_name[:8].rstrip(), short_name[8:].rstrip()
+	return (base + b"." + ext if ext else base).decode("latin-1")
+
+
+def _short_name_bytes(text: str) -> bytes:
+	return bytes(c for c in text.encode("ascii", "replace") if c in _SHORT_NAME_CHARS)
+
+
+def _fat_timestamp(seconds: float):
+	t = time.localtime(seconds)
+	return (
+		(t.tm_hour << 11) | (t.tm_min << 5) | (t.tm_sec // 2),
+		(max(t.tm_year - 1980, 0) << 9) | (t.tm_mon << 5) | t.tm_mday)
+
+
+class Fat32Image:
+	"""
+	FAT32 file system in an image file. The first FAT is read into memory,
+	changes to it are written back to every FAT copy by flush(), sector by
+	sector. sectors_written counts the sectors written so far.
+	"""
+
+	def __init__(self, file):
+		self._file = file
+		file.seek(0)
+		boot = file.read(512)
+		if len(boot) < 512 or boot[510:512] != b"\x55\xaa":
+			raise Fat32Error("no boot sector signature")
+		self.boot = BootSector(*_BOOT_SECTOR.unpack_from(boot, _BOOT_SECTOR_OFFSET))
+		if self.boot.fat_size_16 or not self.boot.fat_size_32 or self.boot.root_entries:
+			raise Fat32Error("not a FAT32 file system")
+		self.sector_size = self.boot.bytes_per_sector
+		self.cluster_size = self.sector_size * self.boot.sectors_per_cluster
+		self._fat_offset = self.boot.reserved_sectors * self.sector_size
+		self._fat_bytes = self.boot.fat_size_32 * self.sector_size
+		data_sector = self.boot.reserved_sectors + self.boot.fat_count * self.boot.fat_size_32
+		self._data_offset = data_sector * self.sector_size
+		self.cluster_count = (self.boot.total_sectors - data_sector) // self.boot.sectors_per_cluster
+		file.seek(self._fat_offset)
+		self._fat = bytearray(file.read(self._fat_bytes))
+		self._entries = memoryview(self._fat)[:(self.cluster_count + 2) * 4].cast("I")
+		if sys.byteorder != "little":
+			raise Fat32Error("FAT access needs a little endian host")
+		self._dirty_fat = set()
+		self._next_free = 2
+		self._free_delta = 0
+		self.sectors_written = 0
+		self._read_root()
+
+	@classmethod
+	@contextlib.contextmanager
+	def open(cls, path: str) -> Iterator["Fat32Image"]:
+		with open(path, "r+b") as file:
+			image = cls(file)
+			try:
+				yield image
+			finally:
+				image.flush()
+
+	# ----- clusters and the FAT -----
+
+	def _cluster_offset(self, cluster: int) -> int:
+		return self._data_offset + (cluster - 2) * self.cluster_size
+
+	def _get(self, cluster: int) -> int:
+		return self._entries[cluster] & _CLUSTER_MASK
+
+	def _set(self, cluster: int, value: int):
+		# the top four bits are reserved and have to be kept
+		self._entries[cluster] = (self._entries[cluster] & ~_CLUSTER_MASK & 0xFFFFFFFF) | value
+		self._dirty_fat.add(cluster * 4 // self.sector_size)
+
+	def chain(self, first: int) -> List[int]:
+		clusters = []
+		cluster = first
+		while 2 <= cluster < self.cluster_count + 2:
+			clusters.append(cluster)
+			if len(clusters) > self.cluster_count:
+				raise Fat32Error("cluster chain from {} loops".format(first))
+			cluster = self._get(cluster)
+		return clusters
+
+	def _allocate(self, count: int, after: Optional[int] = None) -> List[int]:
+		"""
+		Finds count free clusters, preferring the ones right after the
+		cluster after so a growing file stays contiguous, and links them
+		into a chain (continuing after's chain if given)
+		"""
+		clusters = []
+		if after is not None:
+			cluster = after + 1
+			while len(clusters) < count and cluster < self.cluster_count + 2 and self._get(cluster) == FREE:
+				clusters.append(cluster)
+				cluster += 1
+		taken = set(clusters)
+		start = min(max(self._next_free, 2), self.cluster_count + 2)
+		for cluster in itertools.chain(range(start, self.cluster_count + 2), range(2, start)):
+			if len(clusters) == count:
+				break
+			if self._get(cluster) == FREE and cluster not in taken:
+				clusters.append(cluster)
+		if len(clusters) < count:
+			raise Fat32Error("image is full")
+		previous = after
+		for cluster in clusters:
+			if previous is not None:
+				self._set(previous, cluster)
+			previous = cluster
+		if clusters:
+			self._set(clusters[-1], END_OF_CHAIN)
+			self._next_free = clusters[-1] + 1
+		self._free_delta -= len(clusters)
+		return clusters
+
+	def _free(self, clusters: List[int]):
+		for cluster in clusters:
+			self._set(cluster, FREE)
+		self._free_delta += len(clusters)
+		if clusters:
+			self._next_free = min(self._next_free, min(clusters))
+
+	def free_clusters(self) -> int:
+		return sum(1 for cluster in range(2, self.cluster_count + 2) if self._get(cluster) == FREE)
+
+	# ----- writing -----
+
+	def _write(self, offset: int, data) -> None:
+		self._file.seek(offset)
+		self._file.write(data)
+		self.sectors_written += -(-len(data) // self.sector_size)
+
+	def _write_changed(self, offset: int, data) -> None:
+		"""
+		Writes data at offset, skipping the sectors that already hold it
+		"""
+		self._file.seek(offset)
+		current = self._file.read(len(data))
+		if current == data:
+			return
+		run_start = None
+		for start in range(0, len(data), self.sector_size):
+			end = start + self.sector_size
+			if current[start:end] != data[start:end]:
+				if run_start is None:
+					run_start = start
+			elif run_start is not None:
+				self._write(offset + run_start, data[run_start:start])
+				run_start = None
+		if run_start is not None:
+			self._write(offset + run_start, data[run_start:])
+
+	def flush(self):
+		"""
+		Writes the changed FAT sectors to every FAT copy and updates the
+		free cluster count in the FS information sector
+		"""
+		for sector in sorted(self._dirty_fat):
+			data = self._fat[sector * self.sector_size:(sector + 1) * self.sector_size]
+			for copy in range(self.boot.fat_count):
+				self._write(self._fat_offset + copy * self._fat_bytes + sector * self.sector_size, data)
+		self._dirty_fat.clear()
+		if self._free_delta:
+			self._update_fs_info()
+		self._file.flush()
+
+	def _update_fs_info(self):
+		offset = self.boot.fs_info_sector * self.sector_size
+		self._file.seek(offset)
+		info = bytearray(self._file.read(self.sector_size))
+		if any(_UINT32.unpack_from(info, at)[0] != signature for at, signature in _FS_INFO_SIGNATURES):
+			return
+		free = _UINT32.unpack_from(info, 488)[0]
+		if free != 0xFFFFFFFF:
+			_UINT32.pack_into(info, 488, max(free + self._free_delta, 0))
+		_UINT32.pack_into(info, 492, self._next_free)
+		self._free_delta = 0
+		self._write(offset, info)
+
+	# ----- root directory -----
+
+	def _read_root(self):
+		self._root_clusters = self.chain(self.boot.root_cluster)
+		data = bytearray()
+		for cluster in self._root_clusters:
+			self._file.seek(self._cluster_offset(cluster))
+			data += self._file.read(self.cluster_size)
+		self._root = data
+
+	def _slot_offset(self, slot: int) -> int:
+		cluster = self._root_clusters[slot * _ENTRY_SIZE // self.cluster_size]
+		return self._cluster_offset(cluster) + slot * _ENTRY_SIZE % self.cluster_size
+
+	def _write_slot(self, slot: int, entry: bytes):
+		self._root[slot * _ENTRY_SIZE:(slot + 1) * _ENTRY_SIZE] = entry
+		self._write_changed(self._slot_offset(slot), entry)
+
+	def entries(self) -> List[DirEntry]:
+		"""
+		Files and directories in the root directory
+		"""
+		result = []
+		long_parts = []
+		for slot in range(len(self._root) // _ENTRY_SIZE):
+			raw = self._root[slot * _ENTRY_SIZE:(slot + 1) * _ENTRY_SIZE]
+			if raw[0] == 0:
+				break
+			if raw[0] == _DELETED:
+				long_parts = []
+				continue
+			if raw[11] == ATTR_LONG_NAME:
+				order, name1, _, _, checksum, name2, _, name3 = _LFN_ENTRY.unpack(raw)
+				if order & 0x40:
+					long_parts = []
+				long_parts.append((slot, checksum, name1 + name2 + name3))
+				continue
+			short_name, attr = bytes(raw[:11]), raw[11]
+			fields = _DIR_ENTRY.unpack(raw)
+			first_cluster = (fields[7] << 16) | fields[10]
+			name = _short_name_text(short_name)
+			slots = [slot]
+			if long_parts and all(checksum == _lfn_checksum(short_name) for _, checksum, _ in long_parts):
+				text = b"".join(part for _, _, part in reversed(long_parts)).decode("utf-16-le")
+				name = text.split("\0", 1)[0]
+				slots = [part_slot for part_slot, _, _ in long_parts] + slots
+			long_parts = []
+			if not attr & ATTR_VOLUME_ID:
+				result.append(DirEntry(name, short_name, attr, first_cluster, fields[11], slots))
+		return result
+
+	def find(self, name: str) -> Optional[DirEntry]:
+		folded = name.casefold()
+		for entry in self.entries():
+			if entry.name.casefold() == folded or _short_name_text(entry.short_name).casefold() == folded:
+				return entry
+		return None
+
+	def _short_name_for(self, name: str) -> bytes:
+		"""
+		8.3 name for a new file: the name itself if it is a valid upper
+		case 8.3 name, otherwise a BASE~N.EXT alias for the long name
+		"""
+		upper = name.upper()
+		if "." in upper.strip("."):
+			base, _, ext = upper.rpartition(".")
+		else:
+			base, ext = upper, ""
+		base, ext = _short_name_bytes(base), _short_name_bytes(ext)[:3]
+		taken = {entry.short_name for entry in self.entries()}
+		exact = base[:8].ljust(8) + ext.ljust(3)
+		if base and _short_name_text(exact) == name and exact not in taken:
+			return exact
+		for number in range(1, 1000000):
+			tail = b"~" + str(number).encode()
+			candidate = (base[:8 - len(tail)] + tail).ljust(8) + ext.ljust(3)
+			if candidate not in taken:
+				return candidate
+		raise Fat32Error("no free short name for {}".format(name))
+
+	def _free_slots(self, count: int) -> int:
+		"""
+		First of count consecutive unused directory entries, the directory
+		grows by a cluster if there is no such run
+		"""
+		run = 0
+		slots = len(self._root) // _ENTRY_SIZE
+		for slot in range(slots):
+			if self._root[slot * _ENTRY_SIZE] in (0, _DELETED):
+				run += 1
+				if run == count:
+					return slot - count + 1
+			else:
+				run = 0
+		cluster = self._allocate(1, after=self._root_clusters[-1])[0]
+		self._root_clusters.append(cluster)
+		self._root += bytes(self.cluster_size)
+		self._write(self._cluster_offset(cluster), bytes(self.cluster_size))
+		return self._free_slots(count)
+
+	def _directory_entries(self, name: str, short_name: bytes, first_cluster: int, size: int, mtime: float) -> List[bytes]:
+		wtime, wdate = _fat_timestamp(mtime)
+		short = _DIR_ENTRY.pack(short_name, ATTR_ARCHIVE, 0, 0, wtime, wdate, wdate,
+			first_cluster >> 16, wtime, wdate, first_cluster & 0xFFFF, size)
+		if _short_name_text(short_name) == name:
+			return [short]
+		encoded = name.encode("utf-16-le")
+		chars = len(encoded) // 2
+		parts = -(-chars // _LFN_CHARS)
+		encoded += b"\0\0" if chars % _LFN_CHARS else b""
+		encoded = encoded.ljust(parts * _LFN_CHARS * 2, b"\xff")
+		checksum = _lfn_checksum(short_name)
+		entries = []
+		for part in range(parts, 0, -1):
+			text = encoded[(part - 1) * _LFN_CHARS * 2:part * _LFN_CHARS * 2]
+			order = part | (0x40 if part == parts else 0)
+			entries.append(_LFN_ENTRY.pack(order, text[:10], ATTR_LONG_NAME, 0, checksum, text[10:22], 0, text[22:]))
+		return entries + [short]
+
+	# ----- files -----
+
+	def write_file(self, name: str, source_path: str, append: bool = False) -> DirEntry:
+		"""
+		Stores the file at source_path as name in the root directory. An
+		existing file is rewritten in place: its clusters are reused, the
+		chain grows or shrinks as needed and only changed sectors are
+		written. With append the source is added to the end of the file.
+		"""
+		if len(name.encode("utf-16-le")) // 2 > 255:
+			raise Fat32Error("name too long")
+		existing = self.find(name)
+		if existing is not None and existing.attr & ATTR_DIRECTORY:
+			raise Fat32Error("{} is a directory".format(name))
+		source_size = os.path.getsize(source_path)
+		start = existing.size if existing is not None and append else 0
+		size = start + source_size
+		if size > 0xFFFFFFFF:
+			raise Fat32Error("file too large for FAT32")
+
+		clusters = self.chain(existing.first_cluster) if existing is not None and existing.first_cluster else []
+		needed = -(-size // self.cluster_size)
+		if needed > len(clusters):
+			clusters += self._allocate(needed - len(clusters), after=clusters[-1] if clusters else None)
+		elif needed < len(clusters):
+			self._free(clusters[needed:])
+			clusters = clusters[:needed]
+			if clusters:
+				self._set(clusters[-1], END_OF_CHAIN)
+
+		with open(source_path, "rb") as source:
+			position = start
+			source_offset = 0
+			while source_offset < source_size:
+				index, within = divmod(position, self.cluster_size)
+				length = min(self.cluster_size - within, source_size - source_offset)
+				data = source.read(length)
+				self._write_changed(self._cluster_offset(clusters[index]) + within, data)
+				position += length
+				source_offset += length
+
+		first_cluster = clusters[0] if clusters else 0
+		mtime = os.path.getmtime(source_path)
+		if existing is not None:
+			entry = bytearray(self._root[existing.slots[-1] * _ENTRY_SIZE:(existing.slots[-1] + 1) * _ENTRY_SIZE])
+			wtime, wdate = _fat_timestamp(mtime)
+			struct.pack_into("<H", entry, 20, first_cluster >> 16)
+			struct.pack_into("<HHHI", entry, 22, wtime, wdate, first_cluster & 0xFFFF, size)
+			struct.pack_into("<H", entry, 18, wdate)
+			self._write_slot(existing.slots[-1], bytes(entry))
+			slots = existing.slots
+			short_name = existing.short_name
+		else:
+			short_name = self._short_name_for(name)
+			new_entries = self._directory_entries(name, short_name, first_cluster, size, mtime)
+			first_slot = self._free_slots(len(new_entries))
+			slots = list(range(first_slot, first_slot + len(new_entries)))
+			for slot, entry in zip(slots, new_entries):
+				self._write_slot(slot, entry)
+		self.flush()
+		return DirEntry(name, short_name, ATTR_ARCHIVE, first_cluster, size, slots)
+
+	def delete_file(self, name: str) -> bool:
+		entry = self.find(name)
+		if entry is None:
+			return False
+		if entry.attr & ATTR_DIRECTORY:
+			raise Fat32Error("{} is a directory".format(name))
+		if entry.first_cluster:
+			self._free(self.chain(entry.first_cluster))
+		for slot in entry.slots:
+			raw = bytearray(self._root[slot * _ENTRY_SIZE:(slot + 1) * _ENTRY_SIZE])
+			raw[0] = _DELETED
+			self._write_slot(slot, bytes(raw))
+		self.flush()
+		return True
+
+	def read_file(self, name: str) -> bytes:
+		entry = self.find(name)
+		if entry is None:
+			raise FileNotFoundError(name)
+		data = bytearray()
+		for cluster in self.chain(entry.first_cluster) if entry.first_cluster else []:
+			self._file.seek(self._cluster_offset(cluster))
+			data += self._file.read(self.cluster_size)
+		return bytes(data[:entry.size])
+
+
+def _run(command: List[str]):
+	if os.geteuid() != 0:
+		command = ["sudo", "-n"] + command
+	subprocess.run(command, check=True)
+
+
+def export_image(image_path: str, lun_file: Optional[str] = None):
+	"""
+	Makes the printer read the image again: the medium is ejected and
+	inserted on the gadget's LUN, or g_mass_storage is reloaded if there
+	is no LUN to write to
+	"""
+	if lun_file is None:
+		luns = glob.glob(GADGET_LUN_GLOB)
+		lun_file = luns[0] if luns else None
+	if lun_file is not None:
+		for value in ("", image_path):
+			if os.geteuid() == 0:
+				with open(lun_file, "w") as lun:
+					lun.write(value)
+			else:
+				subprocess.run(["sudo", "-n", "tee", lun_file], input=value.encode(),
+					stdout=subprocess.DEVNULL, check=True)
+		return
+	_run(["modprobe", "-r", "g_mass_storage"])
+	_run(["modprobe", "g_mass_storage", "file=" + image_path] + GADGET_OPTIONS)
+
+
+class UsbImage:
+	"""
+	The image shared with the printer. edit() is the one step that
+	changes it: the loop mount (if mounted) is taken down first so the
+	kernel's cached FAT can't overwrite the changes, then the image is
+	synced, mounted again and exported to the printer once.
+	"""
+
+	def __init__(self, image_path: str = "/piusb.bin", mount_point: Optional[str] = None,
+			export: bool = True, lun_file: Optional[str] = None):
+		self.image_path = image_path
+		self.mount_point = mount_point
+		self.export = export
+		self.lun_file = lun_file
+
+	@contextlib.contextmanager
+	def edit(self) -> Iterator[Fat32Image]:
+		mounted = self.mount_point is not None and os.path.ismount(self.mount_point)
+		if mounted:
+			_run(["umount", self.mount_point])
+		try:
+			with open(self.image_path, "r+b") as file:
+				image = Fat32Image(file)
+				yield image
+				image.flush()
+				os.fsync(file.fileno())
+		finally:
+			if mounted:
+				# the mount options come from the fstab entry Chituboard.sh adds
+				_run(["mount", self.mount_point])
+		if self.export:
+			export_image(self.image_path, self.lun_file)
+
+
+def main(argv=None) -> int:
+	import argparse
+
+	parser = argparse.ArgumentParser(description="Edit the root directory of the printer's FAT32 image")
+	parser.add_argument("image")
+	parser.add_argument("--mount-point", help="loop mount of the image, taken down while editing")
+	parser.add_argument("--export", action="store_true", help="export the image to the printer afterwards")
+	commands = parser.add_subparsers(dest="command", required=True)
+	commands.add_parser("ls")
+	put = commands.add_parser("put")
+	put.add_argument("file")
+	put.add_argument("--name", help="name in the image, default the local name")
+	put.add_argument("--append", action="store_true")
+	remove = commands.add_parser("rm")
+	remove.add_argument("name")
+	args = parser.parse_args(argv)
+
+	usb = UsbImage(args.image, args.mount_point, export=args.export)
+	try:
+		with usb.edit() as image:
+			if args.command == "ls":
+				for entry in image.entries():
+					print("{:>12}  {}{}".format(entry.size, entry.name, "/" if entry.attr & ATTR_DIRECTORY else ""))
+			elif args.command == "put":
+				entry = image.write_file(args.name or os.path.basename(args.file), args.file, append=args.append)
+				print("{}: {} bytes, {} sectors written".format(entry.name, entry.size, image.sectors_written))
+			elif not image.delete_file(args.name):
+				print("{} not found".format(args.name))
+				return 1
+	except (Fat32Error, OSError, subprocess.CalledProcessError) as inst:
+		print("error: {}".format(inst))
+		return 1
+	return 0
+
+
+if __name__ == "__main__":
+	sys.exit(main())
@@ -1,9 +1,56 @@
+import io
+import mmap
 import pathlib
+import time
 from abc import ABC, abstractmethod
-from dataclasses import dataclass
-from typing import Sequence, Tuple
+from contextlib import contextmanager
+from dataclasses import dataclass, field
+from typing import TYPE_CHECKING, Any, Callable, Iterator, List, Optional, Sequence, Tuple
 
-import png
+if TYPE_CHECKING:
+	# numpy and png are only loaded once a file is actually read
+	import png
+	from .layers import LayerIndex, LiftSettings, MappedSlicedModel
+
+# read_header gets this many bytes from the start of a file in one read,
+# enough for the header blocks that sit before the previews
+HEADER_READ_SIZE = 4096
+
+
+class PhaseTimer:
+	"""
+	Records the wall clock seconds spent in consecutive phases of work
+	"""
+
+	def __init__(self, timings: Optional[dict] = None):
+		self.timings = timings if timings is not None else {}
+		self._last = time.perf_counter()
+
+	def mark(self, phase: str):
+		now = time.perf_counter()
+		self.timings[phase] = now - self._last
+		self._last = now
+
+
+class HeaderReader:
+	"""
+	Reads the small fixed size blocks of a file header. The first
+	HEADER_READ_SIZE bytes are read once, blocks inside them are sliced
+	out of that, blocks further into the file are read on their own.
+	"""
+
+	def __init__(self, file):
+		self._file = file
+		self._head = file.read(HEADER_READ_SIZE)
+
+	def read(self, offset: int, size: int) -> bytes:
+		if offset + size <= len(self._head):
+			return self._head[offset:offset + size]
+		self._file.seek(offset)
+		return self._file.read(size)
+
+	def unpack(self, struct_class, offset: int = 0):
+		return struct_class.unpack(self.read(offset, struct_class.get_size()))
 
 
 @dataclass(frozen=True)
@@ -21,18 +68,142 @@ class SlicedModelFile(ABC):
 	printer_name: str
 	printing_area: dict
 	dimensions: dict
+	# structured array with one record per layer definition
+	layer_defs: Optional[Any] = field(default=None, repr=False, compare=False)
+	layer_index: "LayerIndex" = field(init=False, repr=False, compare=False)
+
+	def __post_init__(self):
+		from .layers import LayerIndex
+
+		starts = None if self.layer_defs is None else self.layer_defs["image_offset"]
+		object.__setattr__(self, "layer_index", LayerIndex(self.end_byte_offset_by_layer, starts))
+
+	@classmethod
+	@abstractmethod
+	def read(self, path: pathlib.Path, timings: Optional[dict] = None) -> "SlicedModelFile":
+		"""
+		Reads the whole file. If timings is given, the seconds spent on
+		each phase (header, layer_table, first_layer_decode, print_area)
+		are stored in it.
+		"""
+		...
 
 	@classmethod
 	@abstractmethod
-	def read(self, path: pathlib.Path) -> "SlicedModelFile":
+	def read_header(cls, path: pathlib.Path) -> "SlicedModelFile":
+		"""
+		Reads only the fixed size header blocks, no layer table and no
+		layer image, so the cost does not grow with the file. The model
+		has an empty end_byte_offset_by_layer, printing_area and
+		dimensions; the layer index can be filled in with
+		load_layer_index when it is needed.
+		"""
 		...
 
 	@classmethod
 	@abstractmethod
-	def read_preview(cls, path: pathlib.Path) -> png.Image:
+	def read_preview(cls, path: pathlib.Path) -> "png.Image":
 		...
 		
 	@classmethod
 	@abstractmethod
 	def read_dict(self, path: pathlib.Path, metadata: dict) -> "SlicedModelFile":
 		...
+
+	@classmethod
+	def from_analysis(cls, path: pathlib.Path, analysis: dict) -> "SlicedModelFile":
+		"""
+		Rebuilds the model from a stored analysis result (see
+		analysis_worker.analysis_result) without reading the file
+		"""
+		from .layers import LayerIndex
+
+		model = cls(
+			filename=path.name,
+			bed_size_mm=tuple(analysis["bed_size_mm"]),
+			height_mm=analysis["height_mm"],
+			layer_height_mm=analysis["layer_height_mm"],
+			layer_count=analysis["layer_count"],
+			resolution=tuple(analysis["resolution"]),
+			print_time_secs=analysis["print_time_secs"],
+			volume=analysis["volume"],
+			end_byte_offset_by_layer=analysis["end_byte_offset_by_layer"],
+			slicer_version=analysis["slicer_version"],
+			printer_name=analysis["printer_name"],
+			printing_area=analysis["printing_area"],
+			dimensions=analysis["dimensions"],
+		)
+		starts = analysis.get("start_byte_offset_by_layer")
+		if starts is not None:
+			object.__setattr__(model, "layer_index", LayerIndex(model.end_byte_offset_by_layer, starts))
+		return model
+
+	def load_layer_index(self, path: pathlib.Path) -> "LayerIndex":
+		"""
+		Reads the layer table of path into layer_index, for models from
+		read_header
+		"""
+		from .layers import LayerIndex, end_byte_offsets
+
+		with self.open(path) as model:
+			layer_defs = model.layer_defs
+			index = LayerIndex(end_byte_offsets(layer_defs), layer_defs["image_offset"])
+			del layer_defs
+		object.__setattr__(self, "layer_index", index)
+		return index
+
+	def read_layer_durations(self, path: pathlib.Path) -> List[float]:
+		"""
+		Expected seconds per layer from the layer table of path, see
+		layers.layer_durations
+		"""
+		from .layers import layer_durations
+
+		with self.open(path) as model:
+			return layer_durations(model.layer_defs, self._read_lift(model.buffer)).tolist()
+
+	@classmethod
+	def _read_lift(cls, buffer) -> Optional["LiftSettings"]:
+		"""
+		Lift and retract settings from the param block of a mapped file,
+		None for formats that store them per layer
+		"""
+		return None
+
+	@classmethod
+	@abstractmethod
+	def _read_layers(cls, buffer) -> Tuple[Any, Callable]:
+		"""
+		Parses the layer definition table out of a mapped file. Returns
+		the table and a decoder taking (layer index, layer bytes). The
+		table is copied out of buffer, a view would keep the map open.
+		"""
+		...
+
+	@classmethod
+	@contextmanager
+	def open(cls, path: pathlib.Path) -> Iterator["MappedSlicedModel"]:
+		"""
+		Memory maps a sliced file for random access to its layers:
+
+			with CTBFile.open(path) as model:
+				layer = model.layers[120]
+				image = model.layers.decode(120)
+
+		The map is closed when the with block ends. Layers and decoded
+		images are copies and stay usable after it; a view of
+		model.buffer taken by the caller has to be released before.
+		"""
+		from .layers import LayerSequence, MappedSlicedModel
+
+		with io.open(str(path), "rb") as file:
+			buffer = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+		layers = None
+		try:
+			layer_defs, decoder = cls._read_layers(buffer)
+			layers = LayerSequence(buffer, layer_defs, decoder)
+			yield MappedSlicedModel(path, buffer, layers)
+		finally:
+			if layers is not None:
+				layers.release()
+			buffer.close()
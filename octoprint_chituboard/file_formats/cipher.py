@@ -1,6 +1,8 @@
 from dataclasses import dataclass
 import numpy as np
 
+UINT32_MASK: int = 0xFFFFFFFF
+
 
 @dataclass
 class Keyring86:
@@ -10,33 +12,27 @@ class Keyring86:
 
 # Key encoding provided by:
 # https://github.com/cbiffle/catibo/blob/master/doc/cbddlp-ctb.adoc
-	@classmethod
 	def __init__(self, seed: int, slicenum: int):
-		initial = int(seed)*int(0x2d83cdac) + int(0xd8a83423)
-		key = (int(slicenum*int(0x1e1530cd)) + int(0xec3d47cd)) * int(initial)
-		self.initial = int(initial)
-		self.key =  int(key)
+		initial = (int(seed)*0x2d83cdac + 0xd8a83423) & UINT32_MASK
+		key = ((int(slicenum)*0x1e1530cd + 0xec3d47cd) * initial) & UINT32_MASK
+		self.initial = initial
+		self.key = key
 		self.index = 0
-	
-	@classmethod
+
 	def Next(self) -> bytes:
-		k = int(self.key >> int((8 * self.index)))
+		k = (self.key >> (8 * self.index)) & 0xFF
 		self.index += 1
 		if self.index&3 == 0:
-			self.key = int(self.key + self.initial)
+			self.key = (self.key + self.initial) & UINT32_MASK
 			self.index = 0
-		return k.to_bytes((k.bit_length() + 7) // 8, 'little')
-		#return k.to_bytes(4,'little')
-		#return k.tobytes()
+		return bytes([k])
+
+	def keystream(self, length: int):
+		return _keystream(self, length)
 
-	@classmethod
 	def Read(self, data: bytes) -> bytes:
-		out = bytearray()
-		for i in data:
-			temp = self.Next()
-			out.extend([i^temp[0]])
-		return bytes(out)
-		
+		return _xor(self, data)
+
 def cipher86(seed, slicenum, data):
 	if seed == 0:
 		return data
@@ -54,33 +50,27 @@ class KeyringFDG:
 
 # Key encoding provided by:
 # https://github.com/cbiffle/catibo/blob/master/doc/cbddlp-ctb.adoc
-	@classmethod
 	def __init__(self, seed: int, slicenum: int):
-		initial = int(seed)-int(0x1dcb76c3) ^ int(0x257e2431)
-		key = int(initial*int(0x82391efd)) * int(slicenum ^ int(0x110bdacd))
-		self.initial = int(initial)
-		self.key =  int(key)
+		initial = ((int(seed) - 0x1dcb76c3) ^ 0x257e2431) & UINT32_MASK
+		key = (initial * 0x82391efd * (int(slicenum) ^ 0x110bdacd)) & UINT32_MASK
+		self.initial = initial
+		self.key = key
 		self.index = 0
-	
-	@classmethod
+
 	def Next(self) -> bytes:
-		k = int(self.key >> int((8 * self.index)))
+		k = (self.key >> (8 * self.index)) & 0xFF
 		self.index += 1
 		if self.index&3 == 0:
-			self.key = int(self.key + self.initial)
+			self.key = (self.key + self.initial) & UINT32_MASK
 			self.index = 0
-		return k.to_bytes((k.bit_length() + 7) // 8, 'little')
-		#return k.to_bytes(4,'little')
-		#return k.tobytes()
+		return bytes([k])
+
+	def keystream(self, length: int):
+		return _keystream(self, length)
 
-	@classmethod
 	def Read(self, data: bytes) -> bytes:
-		out = bytearray()
-		for i in data:
-			temp = self.Next()
-			out.extend([i^temp[0]])
-		return bytes(out)
-		
+		return _xor(self, data)
+
 def cipherFDG(seed, slicenum, data):
 	if seed == 0:
 		return data
@@ -89,3 +79,30 @@ def cipherFDG(seed, slicenum, data):
 		out = kr.Read(data)
 		return out
 
+
+def _keystream(keyring, length: int):
+	"""
+	Computes the next length bytes of a keyring's XOR stream in bulk.
+	Every key word is key + n*initial (mod 2**32) and contributes its 4
+	little endian bytes, so whole words are generated at once with
+	uint32 wraparound arithmetic. Advances the keyring like Next() would.
+	"""
+	skip = keyring.index
+	words = (skip + length + 3) // 4
+	steps = np.arange(words, dtype=np.uint32)
+	with np.errstate(over="ignore"):
+		keys = np.uint32(keyring.key) + steps * np.uint32(keyring.initial)
+	stream = keys.astype("<u4").view(np.uint8)[skip:skip + length]
+
+	consumed = skip + length
+	keyring.key = (keyring.key + (consumed // 4) * keyring.initial) & UINT32_MASK
+	keyring.index = consumed & 3
+	return stream
+
+
+def _xor(keyring, data: bytes) -> bytes:
+	"""
+	XORs the layer bytes with the keyring's stream in a single pass
+	"""
+	buffer = np.frombuffer(data, dtype=np.uint8)
+	return np.bitwise_xor(buffer, keyring.keystream(len(buffer))).tobytes()
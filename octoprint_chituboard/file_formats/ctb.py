@@ -1,15 +1,17 @@
 import pathlib
 import struct
 from dataclasses import dataclass
-from typing import List
+from functools import partial
+from typing import List, Optional
 import numpy as np
 
 import png
-from typedstruct import LittleEndianStruct, StructType
+from .structs import LittleEndianStruct, StructType
 
-from . import SlicedModelFile
+from . import HeaderReader, PhaseTimer, SlicedModelFile
 from .cipher import cipher86
 from .rle import *
+from .layers import LiftSettings, read_layer_table, end_byte_offsets
 
 @dataclass(frozen=True)
 class CTBHeader(LittleEndianStruct):
@@ -106,6 +108,8 @@ class CTBLayerDef(LittleEndianStruct):
 	unknown_02: int = StructType.uint32()
 	unknown_03: int = StructType.uint32()
 
+CTB_LAYER_DEF_DTYPE = CTBLayerDef.dtype()
+
 
 @dataclass(frozen=True)
 class CTBPreview(LittleEndianStruct):
@@ -115,77 +119,34 @@ class CTBPreview(LittleEndianStruct):
 	image_length: int = StructType.uint32()
 
 
-REPEAT_RGB15_MASK: int = 1 << 5
-
-def _read_image(width: int, height: int, data: bytes) -> png.Image:
-	""" 
-	Decodes a RLE byte array from PhotonFile object to a pygame surface.
-	Based on https://github.com/Reonarudo/pcb2photon/issues/2
-	Encoding scheme:
-	The color (R,G,B) of a pixel spans 2 bytes (little endian) and each 
-	color component is 5 bits: RRRRR GGG GG X BBBBB
-	If the X bit is set, then the next 2 bytes (little endian) masked
-	with 0xFFF represents how many more times to repeat that pixel.
-	"""
-	array: List[List[int]] = [[]]
-
-	(i, x) = (0, 0)
-	while i < len(data):
-		# Combine 2 bytes Little Endian so we get RRRRR GGG GG X BBBBB (and advance read byte counter)
-		color16 = int(struct.unpack_from("<H", data, i)[0])
-		i += 2
-		repeat = 1
-		if color16 & REPEAT_RGB15_MASK:
-			repeat += int(struct.unpack_from("<H", data, i)[0]) & 0xFFF
-			i += 2
-			
-		# Retrieve color components and make pygame color tuple
-		(r, g, b) = (
-			(color16 >> 0) & 0x1F,
-			(color16 >> 6) & 0x1F,
-			(color16 >> 11) & 0x1F,
-		)
-
-		# If the X bit is set, then the next 2 bytes (little endian) 
-		# masked with 0xFFF represents how many more times to repeat that pixel.
-		while repeat > 0:
-			array[-1] += [r, g, b]
-			repeat -= 1
-
-			x += 1
-			if x == width:
-				x = 0
-				array.append([])
-
-	array.pop()
-
-	return png.from_array(array, "RGB;5")
-	
 def _read_layer(width: int, height: int, seed:int, layernum:int, data: bytes) -> png.Image:
 	#data = cipher86(np.uint32(seed),np.uint32(layernum),data)
 	data = cipher86(seed,layernum,data)
 	
 	return read_rle7image(width, height, data)
 
-def _read_layer_array(width: int, height: int, seed:int, layernum:int, data: bytes):
+def _read_layer_array(width: int, height: int, seed:int, layernum:int, data: bytes, out=None):
 	#data = cipher(np.uint32(seed),np.uint32(layernum),data)
 	data = cipher86(seed,layernum,data)
-	return read_rle7array(width, height, data)
+	return read_rle7array(width, height, data, out=out)
+
+def _read_layer_runs(width: int, height: int, seed:int, layernum:int, data: bytes):
+	data = cipher86(seed,layernum,data)
+	return read_rle7runs(width, height, data)
 	
-def get_printarea(resolution,header,image):
+def get_printarea(header,runs):
 	resolutionX = header.resolution_x
 	resolutionY = header.resolution_y
 	PixelSize = (header.bed_size_x_mm*1000)/resolutionX
-	rows_with_white= np.max(image, axis=1)
-	col_with_white= np.max(image, axis=0)
-	row_low = np.argmax(rows_with_white)
-	row_high = -np.argmax(rows_with_white[::-1])
-	col_low = np.argmax(col_with_white)
-	col_high = -np.argmax(col_with_white[::-1])
+	# bounding box of the brightest pixels, taken from the runs
+	peak = int(runs["value"].max()) if len(runs) else 1
+	pixels, row_low, row_high, col_low, col_high = run_stats(runs, peak)
+	if not pixels:
+		row_low, row_high, col_low, col_high = 0, resolutionY - 1, 0, resolutionX - 1
 	minX = float(row_low*PixelSize/1000)
-	maxX = float((resolutionY+row_high)*PixelSize/1000)
+	maxX = float((row_high+1)*PixelSize/1000)
 	minY = float(col_low*PixelSize/1000)
-	maxY = float((resolutionX+col_high)*PixelSize/1000)
+	maxY = float((col_high+1)*PixelSize/1000)
 	width = float(maxX-minX)
 	depth = float(maxY-minY)
 	height = float(header.height_mm)
@@ -198,8 +159,9 @@ def get_printarea(resolution,header,image):
 @dataclass(frozen=True)
 class CTBFile(SlicedModelFile):
 	@classmethod
-	def read(self, path: pathlib.Path) -> "CTBFile":
+	def read(self, path: pathlib.Path, timings: Optional[dict] = None) -> "CTBFile":
 		with open(str(path), "rb") as file:
+			timer = PhaseTimer(timings)
 			ctb_header = CTBHeader.unpack(file.read(CTBHeader.get_size()))
 			
 			file.seek(ctb_header.param_offset)
@@ -211,29 +173,25 @@ class CTBFile(SlicedModelFile):
 			file.seek(ctb_slicer.machine_offset)
 			printer_name = file.read(ctb_slicer.machine_size).decode()
 
-			end_byte_offset_by_layer = []
-			for layer in range(0, ctb_header.layer_count):
-				file.seek(ctb_header.layer_defs_offset + layer * CTBLayerDef.get_size())
-				layer_def = CTBLayerDef.unpack(file.read(CTBLayerDef.get_size()))
-				end_byte_offset_by_layer.append(
-					layer_def.image_offset + layer_def.image_length
-				)
-			
-			file.seek(ctb_header.layer_defs_offset + 0 * CTBLayerDef.get_size())
-			first_layer = CTBLayerDef.unpack(file.read(CTBLayerDef.get_size()))
+			timer.mark("header")
+			layer_defs = read_layer_table(
+				file, ctb_header.layer_defs_offset, ctb_header.layer_count, CTB_LAYER_DEF_DTYPE)
+			end_byte_offset_by_layer = end_byte_offsets(layer_defs)
+			timer.mark("layer_table")
 			
-			file.seek(first_layer.image_offset)
-			data = file.read(first_layer.image_length)
+			file.seek(int(layer_defs[0]["image_offset"]))
+			data = file.read(int(layer_defs[0]["image_length"]))
 			results = {}
-			image = _read_layer_array(
+			runs = _read_layer_runs(
 				ctb_header.resolution_x,
 				ctb_header.resolution_y,
 				ctb_header.encryption_seed,
 				0,
 				data)
+			timer.mark("first_layer_decode")
 			#try:
-			imlayer = np.array(image)
-			results = get_printarea(imlayer.shape,ctb_header,imlayer)
+			results = get_printarea(ctb_header,runs)
+			timer.mark("print_area")
 			#except:
 			#	results["printing_area"] = {'minX': 0.0, 'minY': 0.0}
 			#	results["dimensions"] = {'width':len(image), 'depth':len(image[0]) , 'height': ctb_header.height_mm}
@@ -263,8 +221,45 @@ class CTBFile(SlicedModelFile):
 				printer_name=printer_name,
 				printing_area = results["printing_area"],
 				dimensions = results["dimensions"],
+				layer_defs = layer_defs,
 			)
 	
+	@classmethod
+	def read_header(self, path: pathlib.Path) -> "CTBFile":
+		with open(str(path), "rb") as file:
+			head = HeaderReader(file)
+			ctb_header = head.unpack(CTBHeader)
+			ctb_param = head.unpack(CTBParam, ctb_header.param_offset)
+			ctb_slicer = head.unpack(CTBSlicer, ctb_header.slicer_offset)
+			printer_name = head.read(ctb_slicer.machine_offset, ctb_slicer.machine_size).decode()
+
+		return CTBFile(
+			filename=path.name,
+			bed_size_mm=(
+				round(ctb_header.bed_size_x_mm, 4),
+				round(ctb_header.bed_size_y_mm, 4),
+				round(ctb_header.bed_size_z_mm, 4),
+			),
+			height_mm=ctb_header.height_mm,
+			layer_height_mm=ctb_header.layer_height_mm,
+			layer_count=ctb_header.layer_count,
+			resolution=(ctb_header.resolution_x, ctb_header.resolution_y),
+			print_time_secs=ctb_header.print_time,
+			volume=ctb_param.volume_ml,
+			end_byte_offset_by_layer=[],
+			slicer_version=".".join(
+				[
+					str(ctb_slicer.version_release),
+					str(ctb_slicer.version_major),
+					str(ctb_slicer.version_minor),
+					str(ctb_slicer.version_patch),
+				]
+			),
+			printer_name=printer_name,
+			printing_area={},
+			dimensions={},
+		)
+
 	@classmethod
 	def read_dict(self, path: pathlib.Path, metadata: dict) -> "CTBFile":
 		with open(str(path), "rb") as file:
@@ -276,13 +271,9 @@ class CTBFile(SlicedModelFile):
 			file.seek(ctb_header.slicer_offset)
 			ctb_slicer = CTBSlicer.unpack(file.read(CTBSlicer.get_size()))
 			
-			end_byte_offset_by_layer = []
-			for layer in range(0, ctb_header.layer_count):
-				file.seek(ctb_header.layer_defs_offset + layer * CTBLayerDef.get_size())
-				layer_def = CTBLayerDef.unpack(file.read(CTBLayerDef.get_size()))
-				end_byte_offset_by_layer.append(
-					layer_def.image_offset + layer_def.image_length
-				)
+			layer_defs = read_layer_table(
+				file, ctb_header.layer_defs_offset, ctb_header.layer_count, CTB_LAYER_DEF_DTYPE)
+			end_byte_offset_by_layer = end_byte_offsets(layer_defs)
 
 			voume_ml = metadata["filament"]["tool0"]["volume"]
 			return CTBFile(
@@ -310,8 +301,35 @@ class CTBFile(SlicedModelFile):
 					printer_name = metadata["printer_name"],
 					printing_area = metadata["printing_area"],
 					dimensions = metadata["dimensions"],
+					layer_defs = layer_defs,
 				)
 
+	@classmethod
+	def _read_layers(cls, buffer):
+		ctb_header = CTBHeader.unpack_from(buffer)
+		layer_defs = np.frombuffer(
+			buffer, CTB_LAYER_DEF_DTYPE, ctb_header.layer_count, ctb_header.layer_defs_offset).copy()
+		decoder = partial(
+			_read_layer_array,
+			ctb_header.resolution_x,
+			ctb_header.resolution_y,
+			ctb_header.encryption_seed)
+		return layer_defs, decoder
+
+	@classmethod
+	def _read_lift(cls, buffer):
+		ctb_header = CTBHeader.unpack_from(buffer)
+		if not ctb_header.param_offset:
+			return None
+		ctb_param = CTBParam.unpack_from(buffer, ctb_header.param_offset)
+		return LiftSettings.from_mm_per_min(
+			ctb_param.bottom_layer_count,
+			ctb_param.bottom_lift_height,
+			ctb_param.bottom_lift_speed,
+			ctb_param.lift_height,
+			ctb_param.lift_Speed,
+			ctb_param.retract_Speed)
+
 	@classmethod
 	def read_preview(cls, path: pathlib.Path) -> png.Image:
 		with open(str(path), "rb") as file:
@@ -323,4 +341,4 @@ class CTBFile(SlicedModelFile):
 			file.seek(preview.image_offset)
 			data = file.read(preview.image_length)
 
-			return _read_image(preview.resolution_x, preview.resolution_y, data)
+			return read_image(preview.resolution_x, preview.resolution_y, data)
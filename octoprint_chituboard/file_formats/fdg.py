@@ -1,14 +1,17 @@
 import pathlib
 import struct
 from dataclasses import dataclass
-from typing import List
+from functools import partial
+from typing import List, Optional
 
 import png
-from typedstruct import LittleEndianStruct, StructType
+import numpy as np
+from .structs import LittleEndianStruct, StructType
 
-from . import SlicedModelFile
+from . import HeaderReader, PhaseTimer, SlicedModelFile
 from .cipher import cipherFDG
 from .rle import *
+from .layers import LiftSettings, read_layer_table, end_byte_offsets
 
 @dataclass(frozen=True)
 class FDGHeader(LittleEndianStruct):
@@ -84,6 +87,8 @@ class FDGLayerDef(LittleEndianStruct):
 	unknown_02: int = StructType.uint32()
 	unknown_03: int = StructType.uint32()
 
+FDG_LAYER_DEF_DTYPE = FDGLayerDef.dtype()
+
 
 @dataclass(frozen=True)
 class FDGPreview(LittleEndianStruct):
@@ -93,65 +98,34 @@ class FDGPreview(LittleEndianStruct):
 	image_length: int = StructType.uint32()
 
 
-REPEAT_RGB15_MASK: int = 1 << 5
-
-
-def _read_image(width: int, height: int, data: bytes) -> png.Image:
-	array: List[List[int]] = [[]]
-
-	(i, x) = (0, 0)
-	while i < len(data):
-		color16 = int(struct.unpack_from("<H", data, i)[0])
-		i += 2
-		repeat = 1
-		if color16 & REPEAT_RGB15_MASK:
-			repeat += int(struct.unpack_from("<H", data, i)[0]) & 0xFFF
-			i += 2
-
-		(r, g, b) = (
-			(color16 >> 0) & 0x1F,
-			(color16 >> 6) & 0x1F,
-			(color16 >> 11) & 0x1F,
-		)
-
-		while repeat > 0:
-			array[-1] += [r, g, b]
-			repeat -= 1
-
-			x += 1
-			if x == width:
-				x = 0
-				array.append([])
-
-	array.pop()
-
-	return png.from_array(array, "RGB;5")
-
 def _read_layer(width: int, height: int, seed:int, layernum:int, data: bytes) -> png.Image:
 	#data = cipherFDG(np.uint32(seed),np.uint32(layernum),data)
 	data = cipherFDG(seed,layernum,data)
 	
 	return read_grayimage(width, height, data)
 
-def _read_layer_array(width: int, height: int, seed:int, layernum:int, data: bytes):
+def _read_layer_array(width: int, height: int, seed:int, layernum:int, data: bytes, out=None):
 	#data = cipher(np.uint32(seed),np.uint32(layernum),data)
 	data = cipherFDG(seed,layernum,data)
-	return read_grayarray(width, height, data)
+	return read_grayarray(width, height, data, out=out)
+
+def _read_layer_runs(width: int, height: int, seed:int, layernum:int, data: bytes):
+	data = cipherFDG(seed,layernum,data)
+	return read_grayruns(width, height, data)
 	
-def get_printarea(resolution,header,image):
+def get_printarea(header,runs):
 	resolutionX = header.resolution_x
 	resolutionY = header.resolution_y
 	PixelSize = (header.bed_size_x_mm*1000)/resolutionX
-	rows_with_white= np.max(image, axis=1)
-	col_with_white= np.max(image, axis=0)
-	row_low = np.argmax(rows_with_white)
-	row_high = -np.argmax(rows_with_white[::-1])
-	col_low = np.argmax(col_with_white)
-	col_high = -np.argmax(col_with_white[::-1])
+	# bounding box of the brightest pixels, taken from the runs
+	peak = int(runs["value"].max()) if len(runs) else 1
+	pixels, row_low, row_high, col_low, col_high = run_stats(runs, peak)
+	if not pixels:
+		row_low, row_high, col_low, col_high = 0, resolutionY - 1, 0, resolutionX - 1
 	minX = float(row_low*PixelSize/1000)
-	maxX = float((resolutionY+row_high)*PixelSize/1000)
+	maxX = float((row_high+1)*PixelSize/1000)
 	minY = float(col_low*PixelSize/1000)
-	maxY = float((resolutionX+col_high)*PixelSize/1000)
+	maxY = float((col_high+1)*PixelSize/1000)
 	width = float(maxX-minX)
 	depth = float(maxY-minY)
 	height = float(header.height_mm)
@@ -163,35 +137,32 @@ def get_printarea(resolution,header,image):
 @dataclass(frozen=True)
 class FDGFile(SlicedModelFile):
 	@classmethod
-	def read(self, path: pathlib.Path) -> "FDGFile":
+	def read(self, path: pathlib.Path, timings: Optional[dict] = None) -> "FDGFile":
 		with open(str(path), "rb") as file:
+			timer = PhaseTimer(timings)
 			fdg_header = FDGHeader.unpack(file.read(FDGHeader.get_size()))
 
 			file.seek(fdg_header.machine_offset)
 			printer_name = file.read(fdg_header.machine_size).decode()
 
-			end_byte_offset_by_layer = []
-			for layer in range(0, fdg_header.layer_count):
-				file.seek(fdg_header.layer_defs_offset + layer * FDGLayerDef.get_size())
-				layer_def = FDGLayerDef.unpack(file.read(FDGLayerDef.get_size()))
-				end_byte_offset_by_layer.append(
-					layer_def.image_offset + layer_def.image_length
-				)
-			file.seek(fdg_header.layer_defs_offset + 0 * FDGLayerDef.get_size())
-			first_layer = FDGLayerDef.unpack(file.read(FDGLayerDef.get_size()))
-			
-			file.seek(first_layer.image_offset)
-			data = file.read(first_layer.image_length)
+			timer.mark("header")
+			layer_defs = read_layer_table(
+				file, fdg_header.layer_defs_offset, fdg_header.layer_count, FDG_LAYER_DEF_DTYPE)
+			end_byte_offset_by_layer = end_byte_offsets(layer_defs)
+			timer.mark("layer_table")
+			file.seek(int(layer_defs[0]["image_offset"]))
+			data = file.read(int(layer_defs[0]["image_length"]))
 			results = {}
-			image = _read_layer_array(
+			runs = _read_layer_runs(
 				fdg_header.resolution_x,
 				fdg_header.resolution_y,
 				fdg_header.encryption_seed,
 				0,
 				data)
+			timer.mark("first_layer_decode")
 			#try:
-			imlayer = np.array(image)
-			results = get_printarea(imlayer.shape,fdg_header,imlayer)
+			results = get_printarea(fdg_header,runs)
+			timer.mark("print_area")
 			
 
 			return FDGFile(
@@ -219,8 +190,43 @@ class FDGFile(SlicedModelFile):
 				printer_name=printer_name,
 				printing_area = results["printing_area"],
 				dimensions = results["dimensions"],
+				layer_defs = layer_defs,
 			)
 			
+	@classmethod
+	def read_header(self, path: pathlib.Path) -> "FDGFile":
+		with open(str(path), "rb") as file:
+			head = HeaderReader(file)
+			fdg_header = head.unpack(FDGHeader)
+			printer_name = head.read(fdg_header.machine_offset, fdg_header.machine_size).decode()
+
+		return FDGFile(
+			filename=path.name,
+			bed_size_mm=(
+				round(fdg_header.bed_size_x_mm, 4),
+				round(fdg_header.bed_size_y_mm, 4),
+				round(fdg_header.bed_size_z_mm, 4),
+			),
+			height_mm=fdg_header.height_mm,
+			layer_height_mm=fdg_header.layer_height_mm,
+			layer_count=fdg_header.layer_count,
+			resolution=(fdg_header.resolution_x, fdg_header.resolution_y),
+			print_time_secs=fdg_header.print_time,
+			volume=fdg_header.volume_milliliters,
+			end_byte_offset_by_layer=[],
+			slicer_version=".".join(
+				[
+					str(fdg_header.slicer_version_release),
+					str(fdg_header.slicer_version_major),
+					str(fdg_header.slicer_version_minor),
+					str(fdg_header.slicer_version_patch),
+				]
+			),
+			printer_name=printer_name,
+			printing_area={},
+			dimensions={},
+		)
+
 	@classmethod
 	def read_dict(self, path: pathlib.Path, metadata: dict) -> "FDGFile":
 		with open(str(path), "rb") as file:
@@ -229,13 +235,9 @@ class FDGFile(SlicedModelFile):
 			file.seek(fdg_header.machine_offset)
 			printer_name = file.read(fdg_header.machine_size).decode()
 			
-			end_byte_offset_by_layer = []
-			for layer in range(0, fdg_header.layer_count):
-				file.seek(fdg_header.layer_defs_offset + layer * FDGLayerDef.get_size())
-				layer_def = FDGLayerDef.unpack(file.read(FDGLayerDef.get_size()))
-				end_byte_offset_by_layer.append(
-					layer_def.image_offset + layer_def.image_length
-				)
+			layer_defs = read_layer_table(
+				file, fdg_header.layer_defs_offset, fdg_header.layer_count, FDG_LAYER_DEF_DTYPE)
+			end_byte_offset_by_layer = end_byte_offsets(layer_defs)
 
 			voume_ml = metadata["filament"]["tool0"]["volume"]
 			return FDGFile(
@@ -263,8 +265,33 @@ class FDGFile(SlicedModelFile):
 					printer_name = metadata["printer_name"],
 					printing_area = metadata["printing_area"],
 					dimensions = metadata["dimensions"],
+					layer_defs = layer_defs,
 				)
 
+	@classmethod
+	def _read_layers(cls, buffer):
+		fdg_header = FDGHeader.unpack_from(buffer)
+		layer_defs = np.frombuffer(
+			buffer, FDG_LAYER_DEF_DTYPE, fdg_header.layer_count, fdg_header.layer_defs_offset).copy()
+		decoder = partial(
+			_read_layer_array,
+			fdg_header.resolution_x,
+			fdg_header.resolution_y,
+			fdg_header.encryption_seed)
+		return layer_defs, decoder
+
+	@classmethod
+	def _read_lift(cls, buffer):
+		# FDG keeps the lift settings in its header
+		fdg_header = FDGHeader.unpack_from(buffer)
+		return LiftSettings.from_mm_per_min(
+			fdg_header.bottom_layer_count,
+			fdg_header.bottom_lift_height,
+			fdg_header.bottom_lift_speed,
+			fdg_header.lift_height,
+			fdg_header.lift_speed,
+			fdg_header.retract_speed)
+
 	@classmethod
 	def read_preview(cls, path: pathlib.Path) -> png.Image:
 		with open(str(path), "rb") as file:
@@ -276,4 +303,4 @@ class FDGFile(SlicedModelFile):
 			file.seek(preview.image_offset)
 			data = file.read(preview.image_length)
 
-			return _read_image(preview.resolution_x, preview.resolution_y, data)
+			return read_image(preview.resolution_x, preview.resolution_y, data)
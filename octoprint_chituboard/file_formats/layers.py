@@ -0,0 +1,180 @@
+from typing import BinaryIO, Callable, List, NamedTuple, Optional, Sequence
+
+import numpy as np
+
+
+def read_layer_table(file: BinaryIO, offset: int, count: int, dtype: np.dtype):
+	"""
+	Reads a whole layer definition table with a single read and parses
+	it into a structured array, one record per layer.
+	"""
+	file.seek(offset)
+	data = file.read(count * dtype.itemsize)
+	return np.frombuffer(data, dtype=dtype, count=len(data) // dtype.itemsize)
+
+
+def end_byte_offsets(layer_defs) -> List[int]:
+	"""
+	Byte offset just past each layer's image data
+	"""
+	return (layer_defs["image_offset"].astype(np.int64) + layer_defs["image_length"]).tolist()
+
+
+class LiftSettings(NamedTuple):
+	"""
+	Plate movement after each layer for the formats that store it once
+	in a param block (CTB, CBDDLP, FDG, photon) instead of per layer.
+	Heights in mm, speeds in mm/s; the first bottom_layers layers use
+	the bottom lift.
+	"""
+	bottom_layers: int
+	bottom_height: float
+	bottom_speed: float
+	height: float
+	speed: float
+	retract_speed: float
+
+	@classmethod
+	def from_mm_per_min(cls, bottom_layers: int, bottom_height: float, bottom_speed: float,
+			height: float, speed: float, retract_speed: float) -> "LiftSettings":
+		"""
+		From the param block values, which store speeds in mm/min
+		"""
+		return cls(int(bottom_layers), bottom_height, bottom_speed / 60, height, speed / 60, retract_speed / 60)
+
+
+def _travel_time(height, speed) -> np.ndarray:
+	speed = np.broadcast_to(np.asarray(speed, dtype=np.float64), np.shape(height))
+	return np.divide(height, speed, out=np.zeros_like(speed), where=speed > 0)
+
+
+def layer_durations(layer_defs, lift: Optional[LiftSettings] = None) -> np.ndarray:
+	"""
+	Expected seconds each layer takes on the printer, from the per layer
+	exposure and light off time plus the time to lift the plate and bring
+	it back. The lift comes from lift if given, else from the per layer
+	lift_height and lift_speed of the formats that store those.
+	"""
+	names = layer_defs.dtype.names
+	durations = layer_defs["layer_exposure"].astype(np.float64)
+	if "layer_off_time" in names:
+		durations += layer_defs["layer_off_time"]
+	if lift is not None:
+		bottom = np.arange(len(durations)) < lift.bottom_layers
+		height = np.where(bottom, lift.bottom_height, lift.height).astype(np.float64)
+		speed = np.where(bottom, lift.bottom_speed, lift.speed)
+		durations += _travel_time(height, speed) + _travel_time(height, lift.retract_speed)
+	elif "lift_height" in names and "lift_speed" in names:
+		height = layer_defs["lift_height"].astype(np.float64)
+		durations += 2 * _travel_time(height, layer_defs["lift_speed"])
+	return durations
+
+
+class Layer(NamedTuple):
+	index: int
+	data: bytes  # compressed (and possibly encrypted) image bytes
+	layer_def: np.void
+
+
+class LayerSequence(Sequence):
+	"""
+	Lazy view of the layers of a memory mapped sliced file. Nothing is
+	read until a layer is indexed and then only that layer's compressed
+	bytes are read from the map. Indexing returns a copy of them that
+	stays valid after the map is closed; decode() works on a view that
+	it releases before returning.
+	"""
+
+	def __init__(self, buffer, layer_defs, decoder: Callable):
+		self._view = memoryview(buffer)
+		self.layer_defs = layer_defs
+		self.decoder = decoder
+		self._offsets = layer_defs["image_offset"].astype(np.int64)
+		self._ends = self._offsets + layer_defs["image_length"]
+
+	def __len__(self) -> int:
+		return len(self.layer_defs)
+
+	def __getitem__(self, index):
+		if isinstance(index, slice):
+			return [self[i] for i in range(*index.indices(len(self)))]
+		index = self._check_index(index)
+		return Layer(index, self._view[self._offsets[index]:self._ends[index]].tobytes(), self.layer_defs[index])
+
+	def _check_index(self, index: int) -> int:
+		if index < 0:
+			index += len(self)
+		if not 0 <= index < len(self):
+			raise IndexError("layer index out of range")
+		return index
+
+	def decode(self, index: int, out=None):
+		"""
+		Decompresses (and decrypts) a single layer to a pixel array. If
+		out is given the pixels are written into it, so a loop over all
+		layers can reuse one buffer.
+		"""
+		index = self._check_index(index)
+		with self._view[self._offsets[index]:self._ends[index]] as data:
+			return self.decoder(index, data, out=out)
+
+	def release(self):
+		self._view.release()
+
+
+class MappedSlicedModel:
+	"""
+	Handle returned by SlicedModelFile.open(), valid inside the with block
+	"""
+
+	def __init__(self, path, buffer, layers: LayerSequence):
+		self.path = path
+		self.buffer = buffer
+		self.layers = layers
+
+	@property
+	def layer_defs(self):
+		return self.layers.layer_defs
+
+
+class LayerPosition(NamedTuple):
+	index: int  # zero based layer number
+	progress: float  # fraction of the layer's bytes read, 0.0 - 1.0
+	start: int
+	end: int
+
+
+class LayerIndex:
+	"""
+	Sorted byte offset index mapping the file position reported by the
+	firmware (M27 "SD printing byte") to the layer being printed.
+	"""
+
+	def __init__(self, end_offsets: Sequence[int], start_offsets: Optional[Sequence[int]] = None):
+		ends = np.asarray(end_offsets, dtype=np.int64).reshape(-1)
+		if start_offsets is None:
+			starts = np.concatenate(([0], ends[:-1]))
+		else:
+			starts = np.asarray(start_offsets, dtype=np.int64).reshape(-1)
+		self._order = np.argsort(ends, kind="stable")
+		self._ends = ends[self._order]
+		self._starts = np.minimum(starts[self._order], self._ends)
+
+	def __len__(self) -> int:
+		return len(self._ends)
+
+	def locate(self, position: int) -> Optional[LayerPosition]:
+		"""
+		Finds the layer whose image data contains position. The firmware
+		reports the end offset of the layer it is exposing, so a position
+		on a layer boundary belongs to the layer ending there.
+		"""
+		if not len(self._ends):
+			return None
+		i = min(int(np.searchsorted(self._ends, position)), len(self._ends) - 1)
+		start, end = int(self._starts[i]), int(self._ends[i])
+		if end > start:
+			progress = min(max((position - start) / (end - start), 0.0), 1.0)
+		else:
+			progress = 1.0
+		return LayerPosition(int(self._order[i]), progress, start, end)
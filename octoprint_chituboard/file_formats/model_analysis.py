@@ -0,0 +1,121 @@
+import pathlib
+from typing import NamedTuple, Optional
+
+import numpy as np
+
+# One record per layer. Rows and columns are image coordinates, the
+# bounding box is -1 for layers without any exposed pixel.
+LAYER_STATS_DTYPE = np.dtype([
+	("layer", "<u4"),
+	("pixels", "<u4"),
+	("area_mm2", "<f4"),
+	("row_min", "<i4"),
+	("row_max", "<i4"),
+	("col_min", "<i4"),
+	("col_max", "<i4"),
+	("centroid_row", "<f4"),
+	("centroid_col", "<f4"),
+])
+
+
+class ModelAnalysis(NamedTuple):
+	layers: np.ndarray  # LAYER_STATS_DTYPE records
+	volume_ml: float
+	printing_area: dict
+	dimensions: dict
+
+	def to_dict(self, with_layers: bool = False) -> dict:
+		result = {
+			"volume_ml": self.volume_ml,
+			"printing_area": self.printing_area,
+			"dimensions": self.dimensions,
+			"exposed_layers": int(np.count_nonzero(self.layers["pixels"])),
+		}
+		if with_layers:
+			# empty layers have no centroid, NaN is not valid JSON
+			result["layers"] = {
+				name: [None if value != value else value for value in self.layers[name].tolist()]
+				for name in self.layers.dtype.names}
+		return result
+
+
+def layer_stats(index: int, image, pixel_area_mm2: float) -> tuple:
+	"""
+	Exposed pixel count, area, bounding box and centroid of one decoded
+	layer, as a LAYER_STATS_DTYPE record tuple
+	"""
+	image = np.asarray(image, dtype=np.uint8)
+	row_counts = np.count_nonzero(image, axis=1)
+	pixels = int(row_counts.sum())
+	if not pixels:
+		return (index, 0, 0.0, -1, -1, -1, -1, np.nan, np.nan)
+	col_counts = np.count_nonzero(image, axis=0)
+	rows = np.flatnonzero(row_counts)
+	cols = np.flatnonzero(col_counts)
+	centroid_row = float(np.dot(row_counts, np.arange(len(row_counts)))) / pixels
+	centroid_col = float(np.dot(col_counts, np.arange(len(col_counts)))) / pixels
+	return (index, pixels, pixels * pixel_area_mm2,
+		rows[0], rows[-1], cols[0], cols[-1], centroid_row, centroid_col)
+
+
+def summarize(layers: np.ndarray, pixel_size_mm: tuple, layer_height_mm: float) -> ModelAnalysis:
+	"""
+	Combines per layer statistics into the 3D bounding box and the resin
+	volume. printing_area follows get_printarea: X along image rows, Y
+	along image columns.
+	"""
+	pixel_w, pixel_h = pixel_size_mm
+	volume_ml = float(layers["area_mm2"].astype(np.float64).sum()) * layer_height_mm / 1000
+	exposed = layers[layers["pixels"] > 0]
+	if not len(exposed):
+		printing_area = {"minX": 0.0, "maxX": 0.0, "minY": 0.0, "maxY": 0.0}
+		dimensions = {"width": 0.0, "depth": 0.0, "height": 0.0}
+		return ModelAnalysis(layers, volume_ml, printing_area, dimensions)
+	minX = float(exposed["row_min"].min() * pixel_h)
+	maxX = float((exposed["row_max"].max() + 1) * pixel_h)
+	minY = float(exposed["col_min"].min() * pixel_w)
+	maxY = float((exposed["col_max"].max() + 1) * pixel_w)
+	printing_area = {"minX": minX, "maxX": maxX, "minY": minY, "maxY": maxY}
+	dimensions = {
+		"width": maxX - minX,
+		"depth": maxY - minY,
+		"height": float((int(exposed["layer"].max()) + 1) * layer_height_mm),
+	}
+	return ModelAnalysis(layers, volume_ml, printing_area, dimensions)
+
+
+def _pixel_size_mm(sliced_model_file) -> tuple:
+	bed_x, bed_y = sliced_model_file.bed_size_mm[:2]
+	res_x, res_y = sliced_model_file.resolution
+	return (bed_x / res_x, bed_y / res_y)
+
+
+def analyse_model(path: pathlib.Path, processes: Optional[int] = None, chunksize: int = 4) -> ModelAnalysis:
+	"""
+	Decodes every layer of a sliced file and measures it. Layers are
+	decoded by a LayerPool (one process per core unless processes is
+	given), each worker writes the per layer records into shared memory,
+	so memory stays at one decoded layer per worker.
+	"""
+	from .utils import get_file_format
+
+	path = pathlib.Path(path)
+	sliced_model_file = get_file_format(path).read(path)
+	pixel_w, pixel_h = _pixel_size_mm(sliced_model_file)
+	pixel_area_mm2 = pixel_w * pixel_h
+	layer_count = sliced_model_file.layer_count
+	layers = np.zeros(layer_count, dtype=LAYER_STATS_DTYPE)
+
+	if processes == 1:
+		with get_file_format(path).open(path) as model:
+			image = None
+			for i in range(layer_count):
+				image = model.layers.decode(i, out=image)
+				layers[i] = layer_stats(i, image, pixel_area_mm2)
+	else:
+		from .parallel import LayerPool
+
+		with LayerPool(path, processes, chunksize) as pool:
+			layers = pool.records(layer_stats, LAYER_STATS_DTYPE, pixel_area_mm2)
+
+	return summarize(layers, (pixel_w, pixel_h), sliced_model_file.layer_height_mm)
@@ -0,0 +1,158 @@
+import multiprocessing
+import pathlib
+from multiprocessing import resource_tracker, shared_memory
+from typing import Callable, Iterator, Optional, Sequence, Tuple
+
+import numpy as np
+
+# per process state of the pool workers: the mapped model and the
+# shared memory blocks attached so far, by name
+_worker_model = None
+_worker_blocks = {}
+
+
+class SharedArray:
+	"""
+	Numpy array living in a multiprocessing.shared_memory block, so pool
+	workers can fill it in place instead of pickling results back
+	"""
+
+	def __init__(self, shape: Tuple[int, ...], dtype):
+		self.shape = tuple(shape)
+		self.dtype = np.dtype(dtype)
+		size = max(int(np.prod(self.shape)) * self.dtype.itemsize, 1)
+		self.block = shared_memory.SharedMemory(create=True, size=size)
+		self.array = np.ndarray(self.shape, dtype=self.dtype, buffer=self.block.buf)
+
+	@property
+	def spec(self) -> tuple:
+		return (self.block.name, self.shape, self.dtype)
+
+	def close(self):
+		self.array = None
+		try:
+			self.block.close()
+		except BufferError:
+			# a caller still holds a view, the mapping goes away with it
+			pass
+		self.block.unlink()
+
+
+def _attach(spec: tuple) -> np.ndarray:
+	name, shape, dtype = spec
+	if name not in _worker_blocks:
+		try:
+			block = shared_memory.SharedMemory(name=name, track=False)
+		except TypeError:
+			# before python 3.13 attaching registers the block again with
+			# the resource tracker shared with the parent, which is harmless
+			block = shared_memory.SharedMemory(name=name)
+		_worker_blocks[name] = (block, np.ndarray(shape, dtype=dtype, buffer=block.buf))
+	return _worker_blocks[name][1]
+
+
+def _init_worker(path: str):
+	global _worker_model
+	from .utils import get_file_format
+
+	context = get_file_format(path).open(pathlib.Path(path))
+	_worker_model = (context, context.__enter__())
+
+
+def _decode_range(spec: tuple, start: int, stop: int, out_offset: int) -> int:
+	out = _attach(spec)
+	layers = _worker_model[1].layers
+	for i in range(start, stop):
+		layers.decode(i, out=out[i - out_offset])
+	return stop - start
+
+
+def _records_range(spec: tuple, start: int, stop: int, func: Callable, args: tuple) -> int:
+	out = _attach(spec)
+	layers = _worker_model[1].layers
+	image = None
+	for i in range(start, stop):
+		image = layers.decode(i, out=image)
+		out[i] = func(i, image, *args)
+	return stop - start
+
+
+def _ranges(start: int, stop: int, chunksize: int) -> Iterator[Tuple[int, int]]:
+	for i in range(start, stop, chunksize):
+		yield i, min(i + chunksize, stop)
+
+
+class LayerPool:
+	"""
+	Decodes the layers of one sliced file on all cores. Every worker maps
+	the file on its own and gets layer ranges to work on; decoded bitmaps
+	or per layer records are written straight into shared memory.
+
+		with LayerPool(path) as pool:
+			stats = pool.records(layer_stats, LAYER_STATS_DTYPE, pixel_area)
+			for layer_range, images in pool.batches():
+				...
+	"""
+
+	def __init__(self, path: pathlib.Path, processes: Optional[int] = None, chunksize: int = 4):
+		from .utils import get_file_format
+
+		self.path = pathlib.Path(path)
+		self.processes = processes or multiprocessing.cpu_count()
+		self.chunksize = chunksize
+		with get_file_format(self.path).open(self.path) as model:
+			self.layer_count = len(model.layers)
+			self.layer_shape = np.asarray(model.layers.decode(0)).shape if self.layer_count else (0, 0)
+		# workers have to share the parent's resource tracker, otherwise each
+		# starts its own and reports the shared blocks as leaked on exit
+		resource_tracker.ensure_running()
+		self._pool = multiprocessing.Pool(self.processes, _init_worker, (str(self.path),))
+
+	def __enter__(self):
+		return self
+
+	def __exit__(self, *args):
+		self.close()
+
+	def close(self):
+		self._pool.terminate()
+		self._pool.join()
+
+	def records(self, func: Callable, dtype, *args) -> np.ndarray:
+		"""
+		Runs func(index, image, *args) on every layer and returns the
+		records it produced as an array of dtype, one per layer. func has
+		to be a module level function so workers can import it.
+		"""
+		shared = SharedArray((self.layer_count,), dtype)
+		try:
+			jobs = [
+				self._pool.apply_async(_records_range, (shared.spec, start, stop, func, args))
+				for start, stop in _ranges(0, self.layer_count, self.chunksize)]
+			for job in jobs:
+				job.get()
+			return shared.array.copy()
+		finally:
+			shared.close()
+
+	def batches(self, indices: Optional[Sequence[int]] = None, batch_size: Optional[int] = None) -> Iterator[Tuple[range, np.ndarray]]:
+		"""
+		Yields (layer range, decoded images) for consecutive batches of
+		layers. The images array is only valid until the next batch is
+		requested, it is reused to keep memory bounded.
+		"""
+		layers = range(self.layer_count) if indices is None else indices
+		if not isinstance(layers, range) or layers.step != 1:
+			raise ValueError("indices has to be a range of consecutive layers")
+		batch_size = batch_size or self.processes * self.chunksize
+		shared = SharedArray((batch_size,) + tuple(self.layer_shape), np.uint8)
+		try:
+			for batch_start, batch_stop in _ranges(layers.start, layers.stop, batch_size):
+				jobs = [
+					self._pool.apply_async(_decode_range, (shared.spec, start, stop, batch_start))
+					for start, stop in _ranges(batch_start, batch_stop, self.chunksize)]
+				for job in jobs:
+					job.get()
+				yield range(batch_start, batch_stop), shared.array[:batch_stop - batch_start]
+		finally:
+			shared.close()
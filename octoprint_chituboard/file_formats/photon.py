@@ -1,13 +1,15 @@
 import pathlib
 import struct
 from dataclasses import dataclass
-from typing import List
+from functools import partial
+from typing import List, Optional
 
 import png, time
-from typedstruct import LittleEndianStruct, StructType
+from .structs import LittleEndianStruct, StructType
 import numpy as np
-from . import SlicedModelFile
+from . import HeaderReader, PhaseTimer, SlicedModelFile
 from .rle import *
+from .layers import LiftSettings, read_layer_table, end_byte_offsets
 
 
 @dataclass(frozen=True)
@@ -101,6 +103,8 @@ class PhotonLayerDef(LittleEndianStruct):
 	unknown_03: int = StructType.uint32()  # 1c:
 	unknown_04: int = StructType.uint32()  # 20:
 
+PHOTON_LAYER_DEF_DTYPE = PhotonLayerDef.dtype()
+
 
 @dataclass(frozen=True)
 class PhotonPreview(LittleEndianStruct):
@@ -114,61 +118,29 @@ class PhotonPreview(LittleEndianStruct):
 	unknown_04: int = StructType.uint32()
 
 
-REPEAT_RGB15_MASK: int = 1 << 5
-
-
-def _read_image(width: int, height: int, data: bytes) -> png.Image:
-	array: List[List[int]] = [[]]
-
-	(i, x) = (0, 0)
-	while i < len(data):
-		color16 = int(struct.unpack_from("<H", data, i)[0])
-		i += 2
-		repeat = 1
-		if color16 & REPEAT_RGB15_MASK:
-			repeat += int(struct.unpack_from("<H", data, i)[0]) & 0xFFF
-			i += 2
-
-		(r, g, b) = (
-			(color16 >> 0) & 0x1F,
-			(color16 >> 6) & 0x1F,
-			(color16 >> 11) & 0x1F,
-		)
-
-		while repeat > 0:
-			array[-1] += [r, g, b]
-			repeat -= 1
-
-			x += 1
-			if x == width:
-				x = 0
-				array.append([])
-
-	array.pop()
-
-	return png.from_array(array, "RGB;5")
-	
 def _read_layer(width: int, height: int, layernum:int, data: bytes) -> png.Image:
 	
 	return read_rle1image(width, height, data)
 
-def _read_layer_array(width: int, height: int, layernum:int, data: bytes):
-	return read_rle1array(width, height, data)
+def _read_layer_array(width: int, height: int, layernum:int, data: bytes, out=None):
+	return read_rle1array(width, height, data, out=out)
+
+def _read_layer_runs(width: int, height: int, layernum:int, data: bytes):
+	return read_rle1runs(width, height, data)
 	
-def get_printarea(resolution,header,image):
+def get_printarea(header,runs):
 	resolutionX = header.resolution_x
 	resolutionY = header.resolution_y
 	PixelSize = (header.bed_size_x_mm*1000)/resolutionX
-	rows_with_white= np.max(image, axis=1)
-	col_with_white= np.max(image, axis=0)
-	row_low = np.argmax(rows_with_white)
-	row_high = -np.argmax(rows_with_white[::-1])
-	col_low = np.argmax(col_with_white)
-	col_high = -np.argmax(col_with_white[::-1])
+	# bounding box of the brightest pixels, taken from the runs
+	peak = int(runs["value"].max()) if len(runs) else 1
+	pixels, row_low, row_high, col_low, col_high = run_stats(runs, peak)
+	if not pixels:
+		row_low, row_high, col_low, col_high = 0, resolutionY - 1, 0, resolutionX - 1
 	minX = float(row_low*PixelSize/1000)
-	maxX = float((resolutionY+row_high)*PixelSize/1000)
+	maxX = float((row_high+1)*PixelSize/1000)
 	minY = float(col_low*PixelSize/1000)
-	maxY = float((resolutionX+col_high)*PixelSize/1000)
+	maxY = float((col_high+1)*PixelSize/1000)
 	width = float(maxX-minX)
 	depth = float(maxY-minY)
 	height = float(header.height_mm)
@@ -181,8 +153,9 @@ def get_printarea(resolution,header,image):
 @dataclass(frozen=True)
 class PhotonFile(SlicedModelFile):
 	@classmethod
-	def read(self, path: pathlib.Path) -> "PhotonFile":
+	def read(self, path: pathlib.Path, timings: Optional[dict] = None) -> "PhotonFile":
 		with open(str(path), "rb") as file:
+			timer = PhaseTimer(timings)
 			photon_header = PhotonHeader.unpack(file.read(PhotonHeader.get_size()))
 			
 			file.seek(photon_header.param_offset)
@@ -194,33 +167,27 @@ class PhotonFile(SlicedModelFile):
 			file.seek(photon_slicer.machine_offset)
 			printer_name = file.read(photon_slicer.machine_size).decode()
 
-			end_byte_offset_by_layer = []
-			for layer in range(0, photon_header.layer_count):
-				file.seek(
-					photon_header.layer_defs_offset + layer * PhotonLayerDef.get_size()
-				)
-				layer_def = PhotonLayerDef.unpack(file.read(PhotonLayerDef.get_size()))
-				end_byte_offset_by_layer.append(
-					layer_def.image_offset + layer_def.image_length
-				)
-			file.seek(photon_header.layer_defs_offset + 0 * PhotonLayerDef.get_size())
-			first_layer = PhotonLayerDef.unpack(file.read(PhotonLayerDef.get_size()))
-			
-			file.seek(first_layer.image_offset)
-			data = file.read(first_layer.image_length)
+			timer.mark("header")
+			layer_defs = read_layer_table(
+				file, photon_header.layer_defs_offset, photon_header.layer_count, PHOTON_LAYER_DEF_DTYPE)
+			end_byte_offset_by_layer = end_byte_offsets(layer_defs)
+			timer.mark("layer_table")
+			file.seek(int(layer_defs[0]["image_offset"]))
+			data = file.read(int(layer_defs[0]["image_length"]))
 			results = {}
-			image = _read_layer_array(
+			runs = _read_layer_runs(
 				photon_header.resolution_x,
 				photon_header.resolution_y,
 				0,
 				data)
+			timer.mark("first_layer_decode")
 			try:
-				imlayer = np.array(image)
-				results = get_printarea(imlayer.shape,photon_header,imlayer)
+				results = get_printarea(photon_header,runs)
+				timer.mark("print_area")
 			except:
 				results = {}
 				results["printing_area"] = {'minX': 0.0, 'minY': 0.0}
-				results["dimensions"] = {'width':len(image), 'depth':len(image[0]) , 'height': photon_header.height_mm}
+				results["dimensions"] = {'width':photon_header.resolution_y, 'depth':photon_header.resolution_x , 'height': photon_header.height_mm}
 				
 
 			return PhotonFile(
@@ -248,8 +215,45 @@ class PhotonFile(SlicedModelFile):
 				printer_name=printer_name,
 				printing_area = results["printing_area"],
 				dimensions = results["dimensions"],
+				layer_defs = layer_defs,
 			)
 
+	@classmethod
+	def read_header(self, path: pathlib.Path) -> "PhotonFile":
+		with open(str(path), "rb") as file:
+			head = HeaderReader(file)
+			photon_header = head.unpack(PhotonHeader)
+			photon_param = head.unpack(PhotonParam, photon_header.param_offset)
+			photon_slicer = head.unpack(PhotonSlicer, photon_header.slicer_offset)
+			printer_name = head.read(photon_slicer.machine_offset, photon_slicer.machine_size).decode()
+
+		return PhotonFile(
+			filename=path.name,
+			bed_size_mm=(
+				round(photon_header.bed_size_x_mm, 4),
+				round(photon_header.bed_size_y_mm, 4),
+				round(photon_header.bed_size_z_mm, 4),
+			),
+			height_mm=photon_header.height_mm,
+			layer_height_mm=photon_header.layer_height_mm,
+			layer_count=photon_header.layer_count,
+			resolution=(photon_header.resolution_x, photon_header.resolution_y),
+			print_time_secs=photon_header.print_time,
+			volume=photon_param.volume_ml,
+			end_byte_offset_by_layer=[],
+			slicer_version=".".join(
+				[
+					str(photon_slicer.version_release),
+					str(photon_slicer.version_major),
+					str(photon_slicer.version_minor),
+					str(photon_slicer.version_patch),
+				]
+			),
+			printer_name=printer_name,
+			printing_area={},
+			dimensions={},
+		)
+
 	@classmethod
 	def read_dict(self, path: pathlib.Path, metadata: dict) -> "PhotonFile":
 		with open(str(path), "rb") as file:
@@ -261,15 +265,9 @@ class PhotonFile(SlicedModelFile):
 			file.seek(photon_header.slicer_offset)
 			photon_slicer = PhotonSlicer.unpack(file.read(PhotonSlicer.get_size()))
 
-			end_byte_offset_by_layer = []
-			for layer in range(0, photon_header.layer_count):
-				file.seek(
-					photon_header.layer_defs_offset + layer * PhotonLayerDef.get_size()
-				)
-				layer_def = PhotonLayerDef.unpack(file.read(PhotonLayerDef.get_size()))
-				end_byte_offset_by_layer.append(
-					layer_def.image_offset + layer_def.image_length
-				)
+			layer_defs = read_layer_table(
+				file, photon_header.layer_defs_offset, photon_header.layer_count, PHOTON_LAYER_DEF_DTYPE)
+			end_byte_offset_by_layer = end_byte_offsets(layer_defs)
 				
 			return PhotonFile(
 					filename=path.name,
@@ -296,8 +294,31 @@ class PhotonFile(SlicedModelFile):
 					printer_name = metadata["printer_name"],
 					printing_area = metadata["printing_area"],
 					dimensions = metadata["dimensions"],
+					layer_defs = layer_defs,
 				)
 
+	@classmethod
+	def _read_layers(cls, buffer):
+		photon_header = PhotonHeader.unpack_from(buffer)
+		layer_defs = np.frombuffer(
+			buffer, PHOTON_LAYER_DEF_DTYPE, photon_header.layer_count, photon_header.layer_defs_offset).copy()
+		decoder = partial(_read_layer_array, photon_header.resolution_x, photon_header.resolution_y)
+		return layer_defs, decoder
+
+	@classmethod
+	def _read_lift(cls, buffer):
+		photon_header = PhotonHeader.unpack_from(buffer)
+		if not photon_header.param_offset:
+			return None
+		photon_param = PhotonParam.unpack_from(buffer, photon_header.param_offset)
+		return LiftSettings.from_mm_per_min(
+			photon_param.bottom_layer_count,
+			photon_param.bottom_lift_height,
+			photon_param.bottom_lift_speed,
+			photon_param.lift_height,
+			photon_param.lift_speed,
+			photon_param.retract_speed)
+
 	@classmethod
 	def read_preview(cls, path: pathlib.Path) -> png.Image:
 		with open(str(path), "rb") as file:
@@ -309,4 +330,4 @@ class PhotonFile(SlicedModelFile):
 			file.seek(preview.image_offset)
 			data = file.read(preview.image_length)
 
-			return _read_image(preview.resolution_x, preview.resolution_y, data)
+			return read_image(preview.resolution_x, preview.resolution_y, data)
@@ -1,15 +1,17 @@
 import pathlib
 import struct, os
 from dataclasses import dataclass
-from typing import List
+from functools import partial
+from typing import List, Optional
 from typing import Mapping, Set, Type, Tuple
 import numpy as np
 
 import png
-from typedstruct import LittleEndianStruct, StructType
+from .structs import LittleEndianStruct, StructType
 
-from . import SlicedModelFile
+from . import HeaderReader, PhaseTimer, SlicedModelFile
 from .rle import *
+from .layers import read_layer_table, end_byte_offsets
 
 @dataclass(frozen=True)
 class PwmsFileMark(LittleEndianStruct):
@@ -148,96 +150,32 @@ class PwmsLayerDef(LittleEndianStruct):
 	layer_exposure: float = StructType.float32()
 	layer_height_mm: float = StructType.float32()
 
-REPEAT_RGB15_MASK: int = 1 << 5
+PWMS_LAYER_DEF_DTYPE = PwmsLayerDef.dtype()
 
-def _read_image(width: int, height: int, data: bytes) -> png.Image:
-	array: List[List[int]] = [[]]
-
-	(i, x) = (0, 0)
-	while i < len(data):
-		color16 = int(struct.unpack_from("<H", data, i)[0])
-		i += 2
-		repeat = 1
-		if color16 & REPEAT_RGB15_MASK:
-			repeat += int(struct.unpack_from("<H", data, i)[0]) & 0xFFF
-			i += 2
-
-		(r, g, b) = (
-			(color16 >> 0) & 0x1F,
-			(color16 >> 6) & 0x1F,
-			(color16 >> 11) & 0x1F,
-		)
-
-		while repeat > 0:
-			array[-1] += [r, g, b]
-			repeat -= 1
-
-			x += 1
-			if x == width:
-				x = 0
-				array.append([])
-
-	array.pop()
-
-	return png.from_array(array, "RGB;5")
-	
-def _read_rle4image(width: int, height: int, antialias: int, data: bytes) -> png.Image:
-	array: List[List[int]] = [[]]
-
-	(i, x) = (0, 0)
-	while i < len(data):
-		grey = struct.unpack_from("<B", data, i)[0]
-		color = 0
-		nr = grey & 0xf  # turn highest bit of
-		L = grey >> 4  # only read 1st bit
-		repeat = 1
-		if L == 0x0:
-			color = 0x00
-			repeat = (nr*256) + struct.unpack_from("<B", data, i+1)[0]
-			i += 1
-		elif L == 0xf:
-			color = 0xff - 1
-			repeat = (nr*256) + struct.unpack_from("<B", data, i+1)[0]
-			i += 1
-		else:
-			color = L << 4 | L
-			color &= antialias
-		i+=1
-
-		while repeat > 0:
-			array[-1] += [color]
-			repeat -= 1
-
-			x += 1
-			if x == width:
-				x = 0
-				array.append([])
-
-	array.pop()
-	return png.from_array(array, "L"), array
-	
 def _read_layer(width: int, height: int, antialias: int, layernum:int, data: bytes) -> png.Image:	
 	return read_rle4image(width, height, antialias, data)
 
-def _read_layer_array(width: int, height: int, antialias: int, layernum:int, data: bytes):
-	return read_rle4array(width, height, antialias, data)
+def _read_layer_array(width: int, height: int, antialias: int, layernum:int, data: bytes, out=None):
+	return read_rle4array(width, height, antialias, data, out=out)
+
+def _read_layer_runs(width: int, height: int, antialias: int, layernum:int, data: bytes):
+	return read_rle4runs(width, height, antialias, data)
 	
-def get_printarea(resolution,header,image, height):
+def get_printarea(header,runs, height):
 	resolutionX = header.resolution_x
 	resolutionY = header.resolution_y
 	bed_size_x_mm = header.resolution_x*header.pixel_size/1000.0
 	#PixelSize = (header.bed_size_x_mm*1000)/resolutionX
 	PixelSize = header.pixel_size
-	rows_with_white= np.max(image, axis=1)
-	col_with_white= np.max(image, axis=0)
-	row_low = np.argmax(rows_with_white)
-	row_high = -np.argmax(rows_with_white[::-1])
-	col_low = np.argmax(col_with_white)
-	col_high = -np.argmax(col_with_white[::-1])
+	# bounding box of the brightest pixels, taken from the runs
+	peak = int(runs["value"].max()) if len(runs) else 1
+	pixels, row_low, row_high, col_low, col_high = run_stats(runs, peak)
+	if not pixels:
+		row_low, row_high, col_low, col_high = 0, resolutionY - 1, 0, resolutionX - 1
 	minX = float(row_low*PixelSize/1000)
-	maxX = float((resolutionY+row_high)*PixelSize/1000)
+	maxX = float((row_high+1)*PixelSize/1000)
 	minY = float(col_low*PixelSize/1000)
-	maxY = float((resolutionX+col_high)*PixelSize/1000)
+	maxY = float((col_high+1)*PixelSize/1000)
 	width = float(maxX-minX)
 	depth = float(maxY-minY)
 	results = {}
@@ -293,8 +231,9 @@ def _calc_print_time(header, layermark):
 @dataclass(frozen=True)
 class PwmsFile(SlicedModelFile):
 	@classmethod
-	def read(self, path: pathlib.Path) -> "PwmsFile":
+	def read(self, path: pathlib.Path, timings: Optional[dict] = None) -> "PwmsFile":
 		with open(str(path), "rb") as file:
+			timer = PhaseTimer(timings)
 			pwms_filemark = PwmsFileMark.unpack(file.read(PwmsFileMark.get_size()))
 			
 			file.seek(pwms_filemark.header_offset)
@@ -307,32 +246,29 @@ class PwmsFile(SlicedModelFile):
 			
 			height_mm = pwms_header.layer_height_mm*pwms_layermark.layer_count
 			
-			end_byte_offset_by_layer = []
-			for layer in range(0, pwms_layermark.layer_count):
-				file.seek(
-					pwms_filemark.layer_defs_offset + PwmsLayerMark.get_size() + layer * PwmsLayerDef.get_size()
-				)
-				layer_def = PwmsLayerDef.unpack(file.read(PwmsLayerDef.get_size()))
-				end_byte_offset_by_layer.append(
-					layer_def.image_offset + layer_def.image_length
-				)
+			timer.mark("header")
+			layer_defs = read_layer_table(
+				file,
+				pwms_filemark.layer_defs_offset + PwmsLayerMark.get_size(),
+				pwms_layermark.layer_count,
+				PWMS_LAYER_DEF_DTYPE)
+			end_byte_offset_by_layer = end_byte_offsets(layer_defs)
+			timer.mark("layer_table")
 			print_time = _calc_print_time(pwms_header, pwms_layermark)
 			
-			file.seek(pwms_filemark.layer_defs_offset + PwmsLayerMark.get_size() +  0 * PwmsLayerDef.get_size())
-			first_layer = PwmsLayerDef.unpack(file.read(PwmsLayerDef.get_size()))
-			
-			file.seek(first_layer.image_offset)
-			data = file.read(first_layer.image_length)
+			file.seek(int(layer_defs[0]["image_offset"]))
+			data = file.read(int(layer_defs[0]["image_length"]))
 			results = {}
-			image = _read_layer_array(
+			runs = _read_layer_runs(
 				pwms_header.resolution_x,
 				pwms_header.resolution_y,
 				pwms_header.anti_alias_level,
 				0,
 				data)
+			timer.mark("first_layer_decode")
 			#try:
-			imlayer = np.array(image)
-			results = get_printarea(imlayer.shape,pwms_header,imlayer,height_mm)
+			results = get_printarea(pwms_header,runs,height_mm)
+			timer.mark("print_area")
 			#except:
 			#	results = {}
 			#	results["printing_area"] = {'minX': 0.0, 'minY': 0.0}
@@ -360,8 +296,38 @@ class PwmsFile(SlicedModelFile):
 				printer_name=printer_info[0],# Use filename ending to determine printer name
 				printing_area = results["printing_area"],
 				dimensions = results["dimensions"],
+				layer_defs = layer_defs,
 			)
 			
+	@classmethod
+	def read_header(self, path: pathlib.Path) -> "PwmsFile":
+		with open(str(path), "rb") as file:
+			head = HeaderReader(file)
+			pwms_filemark = head.unpack(PwmsFileMark)
+			pwms_header = head.unpack(PwmsHeader, pwms_filemark.header_offset)
+			pwms_layermark = head.unpack(PwmsLayerMark, pwms_filemark.layer_defs_offset)
+
+		printer_info = _get_printer_info(path.name)
+		return PwmsFile(
+			filename=path.name,
+			bed_size_mm=(
+				round(pwms_header.resolution_x*pwms_header.pixel_size/1000.0, 4),
+				round(pwms_header.resolution_y*pwms_header.pixel_size/1000.0, 4),
+				printer_info[3],
+			),
+			height_mm=round(pwms_header.layer_height_mm*pwms_layermark.layer_count, 4),
+			layer_height_mm=pwms_header.layer_height_mm,
+			layer_count=pwms_layermark.layer_count,
+			resolution=(pwms_header.resolution_x, pwms_header.resolution_y),
+			print_time_secs=_calc_print_time(pwms_header, pwms_layermark),
+			volume=pwms_header.volume_ml,
+			end_byte_offset_by_layer=[],
+			slicer_version="1.8.0.0",
+			printer_name=printer_info[0],
+			printing_area={},
+			dimensions={},
+		)
+
 	@classmethod
 	def read_dict(self, path: pathlib.Path, metadata: dict) -> "PwmsFile":
 		with open(str(path), "rb") as file:
@@ -375,15 +341,12 @@ class PwmsFile(SlicedModelFile):
 			
 			height_mm = pwms_header.layer_height_mm*pwms_layermark.layer_count
 			
-			end_byte_offset_by_layer = []
-			for layer in range(0, pwms_layermark.layer_count):
-				file.seek(
-					pwms_filemark.layer_defs_offset + PwmsLayerMark.get_size() + layer * PwmsLayerDef.get_size()
-				)
-				layer_def = PwmsLayerDef.unpack(file.read(PwmsLayerDef.get_size()))
-				end_byte_offset_by_layer.append(
-					layer_def.image_offset + layer_def.image_length
-				)
+			layer_defs = read_layer_table(
+				file,
+				pwms_filemark.layer_defs_offset + PwmsLayerMark.get_size(),
+				pwms_layermark.layer_count,
+				PWMS_LAYER_DEF_DTYPE)
+			end_byte_offset_by_layer = end_byte_offsets(layer_defs)
 				
 			return PwmsFile(
 				filename=path.name,
@@ -403,20 +366,33 @@ class PwmsFile(SlicedModelFile):
 				printer_name = metadata["printer_name"],
 				printing_area = metadata["printing_area"],
 				dimensions = metadata["dimensions"],
+				layer_defs = layer_defs,
 			)
 
+	@classmethod
+	def _read_layers(cls, buffer):
+		pwms_filemark = PwmsFileMark.unpack_from(buffer)
+		pwms_header = PwmsHeader.unpack_from(buffer, pwms_filemark.header_offset)
+		pwms_layermark = PwmsLayerMark.unpack_from(buffer, pwms_filemark.layer_defs_offset)
+		layer_defs = np.frombuffer(
+			buffer,
+			PWMS_LAYER_DEF_DTYPE,
+			pwms_layermark.layer_count,
+			pwms_filemark.layer_defs_offset + PwmsLayerMark.get_size()).copy()
+		decoder = partial(
+			_read_layer_array,
+			pwms_header.resolution_x,
+			pwms_header.resolution_y,
+			pwms_header.anti_alias_level)
+		return layer_defs, decoder
+
 	@classmethod
 	def read_preview(cls, path: pathlib.Path) -> png.Image:
 		with open(str(path), "rb") as file:
 			pwms_filemark = PwmsFileMark.unpack(file.read(PwmsFileMark.get_size()))
+			# raw RGB565 image data follows the preview section header
 			file.seek(pwms_filemark.preview_offset)
-			pwms_preview = PwmsPreview.unpack(file.read(PwmsPreview.get_size()))
-			# image offset is PWMSpreview offset + pwmspreview.getsize()
-
-			file.seek(pwms_header.high_res_preview_offset)
 			preview = PwmsPreview.unpack(file.read(PwmsPreview.get_size()))
-
-			file.seek(preview.image_offset)
-			data = file.read(preview.image_length)
-
-			return _read_image(preview.resolution_x, preview.resolution_y, data)
+			data = file.read(preview.resolution_x * preview.resolution_y * 2)
+			image = read_rgb565array(preview.resolution_x, preview.resolution_y, data)
+			return png.from_array(image.reshape(preview.resolution_y, -1), "RGB")
@@ -2,13 +2,16 @@ import os
 import pathlib
 import struct
 from dataclasses import dataclass
-from typing import List, Mapping, Type, Tuple
+from functools import partial
+from typing import List, Mapping, Type, Tuple, Optional
 
 import png
-from typedstruct import LittleEndianStruct, StructType
+import numpy as np
+from .structs import LittleEndianStruct, StructType
 
-from . import SlicedModelFile
+from . import HeaderReader, PhaseTimer, SlicedModelFile
 from .rle import *
+from .layers import read_layer_table, end_byte_offsets
 
 @dataclass(frozen=True)
 class PwsFileMark(LittleEndianStruct):
@@ -136,37 +139,7 @@ class PwsLayerDef(LittleEndianStruct):
 	layer_exposure: float = StructType.float32()
 	layer_height_mm: float = StructType.float32()
 
-REPEAT_RGB15_MASK: int = 1 << 5
-def _read_image(width: int, height: int, data: bytes) -> png.Image:
-	array: List[List[int]] = [[]]
-
-	(i, x) = (0, 0)
-	while i < len(data):
-		color16 = int(struct.unpack_from("<H", data, i)[0])
-		i += 2
-		repeat = 1
-		if color16 & REPEAT_RGB15_MASK:
-			repeat += int(struct.unpack_from("<H", data, i)[0]) & 0xFFF
-			i += 2
-
-		(r, g, b) = (
-			(color16 >> 0) & 0x1F,
-			(color16 >> 6) & 0x1F,
-			(color16 >> 11) & 0x1F,
-		)
-
-		while repeat > 0:
-			array[-1] += [r, g, b]
-			repeat -= 1
-
-			x += 1
-			if x == width:
-				x = 0
-				array.append([])
-
-	array.pop()
-
-	return png.from_array(array, "RGB;5")
+PWS_LAYER_DEF_DTYPE = PwsLayerDef.dtype()
 
 EXTENSION_TO_BED_SIZE: Mapping[str, Tuple[str, float, float, float]] = {
 	".pws": ("Anycubic Photon S", 68.04, 120.96, 165),
@@ -215,25 +188,27 @@ def _calc_print_time(header, layermark):
 def _read_layer(width: int, height: int, layernum:int, data: bytes) -> png.Image:	
 	return read_rle1image(width, height, data)
 
-def _read_layer_array(width: int, height: int, layernum:int, data: bytes):
-	return read_rle1array(width, height, data)
+def _read_layer_array(width: int, height: int, layernum:int, data: bytes, out=None):
+	return read_rle1array(width, height, data, out=out)
+
+def _read_layer_runs(width: int, height: int, layernum:int, data: bytes):
+	return read_rle1runs(width, height, data)
 	
-def get_printarea(resolution,header,image, height):
+def get_printarea(header,runs, height):
 	resolutionX = header.resolution_x
 	resolutionY = header.resolution_y
 	bed_size_x_mm = header.resolution_x*header.pixel_size/1000.0
 	#PixelSize = (header.bed_size_x_mm*1000)/resolutionX
 	PixelSize = header.pixel_size
-	rows_with_white= np.max(image, axis=1)
-	col_with_white= np.max(image, axis=0)
-	row_low = np.argmax(rows_with_white)
-	row_high = -np.argmax(rows_with_white[::-1])
-	col_low = np.argmax(col_with_white)
-	col_high = -np.argmax(col_with_white[::-1])
+	# bounding box of the brightest pixels, taken from the runs
+	peak = int(runs["value"].max()) if len(runs) else 1
+	pixels, row_low, row_high, col_low, col_high = run_stats(runs, peak)
+	if not pixels:
+		row_low, row_high, col_low, col_high = 0, resolutionY - 1, 0, resolutionX - 1
 	minX = float(row_low*PixelSize/1000)
-	maxX = float((resolutionY+row_high)*PixelSize/1000)
+	maxX = float((row_high+1)*PixelSize/1000)
 	minY = float(col_low*PixelSize/1000)
-	maxY = float((resolutionX+col_high)*PixelSize/1000)
+	maxY = float((col_high+1)*PixelSize/1000)
 	width = float(maxX-minX)
 	depth = float(maxY-minY)
 	results = {}
@@ -244,8 +219,9 @@ def get_printarea(resolution,header,image, height):
 @dataclass(frozen=True)
 class PwsFile(SlicedModelFile):
 	@classmethod
-	def read(self, path: pathlib.Path) -> "PwsFile":
+	def read(self, path: pathlib.Path, timings: Optional[dict] = None) -> "PwsFile":
 		with open(str(path), "rb") as file:
+			timer = PhaseTimer(timings)
 			pws_filemark = PwsFileMark.unpack(file.read(PwsFileMark.get_size()))
 			pws_header = PwsHeader.unpack(file.read(PwsHeader.get_size()))
 			pws_layermark = PwsLayerMark.unpack(file.read(PwsLayerMark.get_size()))
@@ -255,31 +231,28 @@ class PwsFile(SlicedModelFile):
 			
 			height_mm = pws_header.layer_height_mm*pws_layermark.layer_count
 			
-			end_byte_offset_by_layer = []
-			for layer in range(0, pws_layermark.layer_count):
-				file.seek(
-					pws_filemark.layer_defs_offset + PwsLayerMark.get_size() + layer * PwsLayerDef.get_size()
-				)
-				layer_def = PwsLayerDef.unpack(file.read(PwsLayerDef.get_size()))
-				end_byte_offset_by_layer.append(
-					layer_def.image_offset + layer_def.image_length
-				)
+			timer.mark("header")
+			layer_defs = read_layer_table(
+				file,
+				pws_filemark.layer_defs_offset + PwsLayerMark.get_size(),
+				pws_layermark.layer_count,
+				PWS_LAYER_DEF_DTYPE)
+			end_byte_offset_by_layer = end_byte_offsets(layer_defs)
+			timer.mark("layer_table")
 			print_time = _calc_print_time(pws_header, pws_layermark)
 			
-			file.seek(pws_filemark.layer_defs_offset + PwsLayerMark.get_size() +  0 * PwsLayerDef.get_size())
-			first_layer = PwsLayerDef.unpack(file.read(PwsLayerDef.get_size()))
-			
-			file.seek(first_layer.image_offset)
-			data = file.read(first_layer.image_length)
+			file.seek(int(layer_defs[0]["image_offset"]))
+			data = file.read(int(layer_defs[0]["image_length"]))
 			results = {}
-			image = _read_layer_array(
+			runs = _read_layer_runs(
 				pws_header.resolution_x,
 				pws_header.resolution_y,
 				0,
 				data)
+			timer.mark("first_layer_decode")
 			#try:
-			imlayer = np.array(image)
-			results = get_printarea(imlayer.shape,pws_header,imlayer,height_mm)
+			results = get_printarea(pws_header,runs,height_mm)
+			timer.mark("print_area")
 			#except:
 			#	results = {}
 			#	results["printing_area"] = {'minX': 0.0, 'minY': 0.0}
@@ -308,9 +281,39 @@ class PwsFile(SlicedModelFile):
 				printer_name=printer_name,# Use filename ending to determine printer name
 				printing_area = results["printing_area"],
 				dimensions = results["dimensions"],
+				layer_defs = layer_defs,
 			)
 
 
+	@classmethod
+	def read_header(self, path: pathlib.Path) -> "PwsFile":
+		with open(str(path), "rb") as file:
+			head = HeaderReader(file)
+			pws_filemark = head.unpack(PwsFileMark)
+			pws_header = head.unpack(PwsHeader, pws_filemark.header_offset)
+			pws_layermark = head.unpack(PwsLayerMark, pws_filemark.layer_defs_offset)
+
+		printer_info = _get_printer_info(path.name)
+		return PwsFile(
+			filename=path.name,
+			bed_size_mm=(
+				round(pws_header.resolution_x*pws_header.pixel_size/1000.0, 4),
+				round(pws_header.resolution_y*pws_header.pixel_size/1000.0, 4),
+				printer_info[3]
+			),
+			height_mm=round(pws_header.layer_height_mm*pws_layermark.layer_count, 4),
+			layer_height_mm=pws_header.layer_height_mm,
+			layer_count=pws_layermark.layer_count,
+			resolution=(pws_header.resolution_x, pws_header.resolution_y),
+			print_time_secs=_calc_print_time(pws_header, pws_layermark),
+			volume=pws_header.volume_ml,
+			end_byte_offset_by_layer=[],
+			slicer_version="1.8.0.0",
+			printer_name=printer_info[0],
+			printing_area={},
+			dimensions={},
+		)
+
 	@classmethod
 	def read_dict(self, path: pathlib.Path, metadata: dict) -> "PwsFile":
 		with open(str(path), "rb") as file:
@@ -323,15 +326,12 @@ class PwsFile(SlicedModelFile):
 			
 			height_mm = pws_header.layer_height_mm*pws_layermark.layer_count
 			
-			end_byte_offset_by_layer = []
-			for layer in range(0, pws_layermark.layer_count):
-				file.seek(
-					pws_filemark.layer_defs_offset + PwsLayerMark.get_size() + layer * PwsLayerDef.get_size()
-				)
-				layer_def = PwsLayerDef.unpack(file.read(PwsLayerDef.get_size()))
-				end_byte_offset_by_layer.append(
-					layer_def.image_offset + layer_def.image_length
-				)
+			layer_defs = read_layer_table(
+				file,
+				pws_filemark.layer_defs_offset + PwsLayerMark.get_size(),
+				pws_layermark.layer_count,
+				PWS_LAYER_DEF_DTYPE)
+			end_byte_offset_by_layer = end_byte_offsets(layer_defs)
 				
 			return PwsFile(
 				filename=path.name,
@@ -351,20 +351,30 @@ class PwsFile(SlicedModelFile):
 				printer_name = metadata["printer_name"],# Use filename ending to determine printer name
 				printing_area = metadata["printing_area"],
 				dimensions = metadata["dimensions"],
+				layer_defs = layer_defs,
 			)
 
 
+	@classmethod
+	def _read_layers(cls, buffer):
+		pws_filemark = PwsFileMark.unpack_from(buffer)
+		pws_header = PwsHeader.unpack_from(buffer, pws_filemark.header_offset)
+		pws_layermark = PwsLayerMark.unpack_from(buffer, pws_filemark.layer_defs_offset)
+		layer_defs = np.frombuffer(
+			buffer,
+			PWS_LAYER_DEF_DTYPE,
+			pws_layermark.layer_count,
+			pws_filemark.layer_defs_offset + PwsLayerMark.get_size()).copy()
+		decoder = partial(_read_layer_array, pws_header.resolution_x, pws_header.resolution_y)
+		return layer_defs, decoder
+
 	@classmethod
 	def read_preview(cls, path: pathlib.Path) -> png.Image:
 		with open(str(path), "rb") as file:
 			pws_filemark = PwsFileMark.unpack(file.read(PwsFileMark.get_size()))
-			pws_header = PwsHeader.unpack(file.read(PwsHeader.get_size()))
-			# image offset is PWSpreview offset + pwspreview.getsize()
-
-			file.seek(pws_header.preview_offset)
+			# raw RGB565 image data follows the preview section header
+			file.seek(pws_filemark.preview_offset)
 			preview = PwsPreview.unpack(file.read(PwsPreview.get_size()))
-
-			file.seek(pws_header.preview_offset+PwsPreview.get_size())
-			data = file.read(preview.image_length)
-
-			return _read_image(preview.resolution_x, preview.resolution_y, data)
+			data = file.read(preview.resolution_x * preview.resolution_y * 2)
+			image = read_rgb565array(preview.resolution_x, preview.resolution_y, data)
+			return png.from_array(image.reshape(preview.resolution_y, -1), "RGB")
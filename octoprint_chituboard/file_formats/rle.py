@@ -1,218 +1,203 @@
 import numpy as np
 import png, struct
+from typing import List, Sequence
 
 REPEAT_RGB15_MASK: int = 1 << 5
 
-def read_image(width: int, height: int, data: bytes) -> png.Image:
-	""" 
-	Decodes a RLE byte array from PhotonFile object to a pygame surface.
-	Based on https://github.com/Reonarudo/pcb2photon/issues/2
-	Encoding scheme:
-	The color (R,G,B) of a pixel spans 2 bytes (little endian) and each 
-	color component is 5 bits: RRRRR GGG GG X BBBBB
-	If the X bit is set, then the next 2 bytes (little endian) masked
-	with 0xFFF represents how many more times to repeat that pixel.
+# One run of lit pixels inside a single image row, col_end is exclusive
+RUN_DTYPE = np.dtype([
+	("row", "<i4"),
+	("col_start", "<i4"),
+	("col_end", "<i4"),
+	("value", "u1"),
+])
+
+
+def _token_starts(next_start):
 	"""
-	array: List[List[int]] = [[]]
+	Finds the offset of every token in a variable width stream.
+	next_start[i] is where the token following a token at offset i
+	would begin. Rather than walking the chain one token at a time,
+	pointer doubling collects the first 2**k tokens after k passes.
+	"""
+	n = len(next_start)
+	jump = np.append(np.minimum(next_start, n), n)
+	starts = np.zeros(1 if n else 0, dtype=np.intp)
+	while len(starts):
+		tail = jump[starts]
+		if tail[0] >= n:
+			break
+		starts = np.concatenate((starts, tail))
+		jump = jump[jump]
+	return starts[starts < n]
 
-	(i, x) = (0, 0)
-	while i < len(data):
-		# Combine 2 bytes Little Endian so we get RRRRR GGG GG X BBBBB (and advance read byte counter)
-		color16 = int(struct.unpack_from("<H", data, i)[0])
-		i += 2
-		repeat = 1
-		if color16 & REPEAT_RGB15_MASK:
-			repeat += int(struct.unpack_from("<H", data, i)[0]) & 0xFFF
-			i += 2
-			
-		# Retrieve color components and make pygame color tuple
-		(r, g, b) = (
-			(color16 >> 0) & 0x1F,
-			(color16 >> 6) & 0x1F,
-			(color16 >> 11) & 0x1F,
-		)
-
-		# If the X bit is set, then the next 2 bytes (little endian) 
-		# masked with 0xFFF represents how many more times to repeat that pixel.
-		while repeat > 0:
-			array[-1] += [r, g, b]
-			repeat -= 1
 
-			x += 1
-			if x == width:
-				x = 0
-				array.append([])
+def _out_array(out, shape: tuple):
+	"""
+	Checks a caller supplied output buffer (ndarray or writable
+	memoryview) and returns it as a uint8 ndarray of shape, sharing its
+	memory. Allocates a new array if out is None.
+	"""
+	if out is None:
+		return np.empty(shape, dtype=np.uint8)
+	array = np.asarray(out)
+	if (array.dtype != np.uint8 or array.size != int(np.prod(shape))
+			or not array.flags.c_contiguous or not array.flags.writeable):
+		raise ValueError("out must be a writable contiguous uint8 buffer of {} bytes".format(int(np.prod(shape))))
+	return array.reshape(shape)
 
-	array.pop()
 
-	return png.from_array(array, "RGB;5")
-	
-def read_grayimage(width: int, height: int, data: bytes) -> png.Image:
-    limit = width * height
-    array: List[List[int]] = [[]]
-    lastColor = 0xff
-    (i, x) = (0, 0)
-    n = 0
-    # i = index
-    while n < len(data):
-        code = struct.unpack_from("<B", data, n)[0]
-        n += 1
-        if (code & 0x80) == 0x80:
-            # Convert from 0..124 to 8bpp
-            lastColor = ((code & 0x7f) << 1) | (code & 1)
-            if lastColor >= 0xfc:
-                # Make 'white' actually white
-                lastColor = 0xff
-            if i < limit: 
-                array[-1] += [lastColor]
-                x += 1
-                if x == width:
-                    x = 0
-                    array.append([])
-            i += 1
-        else:
-            index = 0
-            while index < int(code):
-                if i < limit:
-                    array[-1] += [lastColor]
-                    x += 1
-                    if x == width:
-                        x = 0
-                        array.append([])
-                i += 1
-                index += 1
+def _expand_runs(values, lengths, size: int, out=None):
+	"""
+	Expands (value, length) runs into a flat uint8 pixel array of
+	exactly size pixels. Runs past the end are clipped, a short
+	stream is padded with black. values may have a trailing channel
+	axis, e.g. (runs, 3) for RGB.
 
-    array.pop()
-    return png.from_array(array, "L")
+	With out (see _out_array) the pixels are written in place without
+	any temporary of the image size: the change of value is stored at
+	the start of every run and a running sum (wrapping at 256) restores
+	the values. That is slower than np.repeat but allocates nothing.
+	"""
+	values = values.astype(np.uint8, copy=False)
+	ends = np.minimum(np.cumsum(lengths, dtype=np.int64), size)
+	if out is None:
+		pixels = np.repeat(values, np.diff(ends, prepend=0), axis=0)
+		if len(pixels) < size:
+			padding = np.zeros((size - len(pixels),) + pixels.shape[1:], dtype=np.uint8)
+			pixels = np.concatenate((pixels, padding))
+		return pixels
 
-def read_rle1image(width: int, height: int, data: bytes) -> png.Image:
-	array: List[List[int]] = [[]]
+	pixels = _out_array(out, (size,) + values.shape[1:])
+	starts = np.concatenate(([0], ends[:-1]))
+	nonempty = starts < ends
+	starts, values = starts[nonempty], values[nonempty]
+	pixels[...] = 0
+	if len(starts):
+		pixels[starts] = np.diff(values, axis=0, prepend=np.zeros((1,) + values.shape[1:], dtype=np.uint8))
+		if ends[-1] < size:
+			# back to black for the padding
+			pixels[ends[-1]] = (256 - values[-1].astype(np.int64)) % 256
+		np.cumsum(pixels, axis=0, dtype=np.uint8, out=pixels)
+	return pixels
 
-	(i, x) = (0, 0)
-	while i < len(data) and len(array) < height+1:
-		grey = struct.unpack_from("<B", data, i)[0]
-		i += 1
-		nr = grey & ~(1 << 7)  # turn highest bit of
-		L = grey >> 7  # only read 1st bit
-		repeat = 1
-		if grey & ~(1 << 7):
-			repeat = nr
-	
-		while repeat > 0:
-			array[-1] += [L]
-			repeat -= 1
-	
-			x += 1
-			if x == width:
-				x = 0
-				array.append([])
-	
-	array.pop()
-	return png.from_array(array, "L;1")
-	
-def read_rle4image(width: int, height: int, antialias: int, data: bytes) -> png.Image:
-	array: List[List[int]] = [[]]
 
-	(i, x) = (0, 0)
-	while i < len(data):
-		grey = struct.unpack_from("<B", data, i)[0]
-		color = 0
-		nr = grey & 0xf  # turn highest bit of
-		L = grey >> 4  # only read 1st bit
-		repeat = 1
-		if L == 0x0:
-			color = 0x00
-			repeat = (nr*256) + struct.unpack_from("<B", data, i+1)[0]
-			i += 1
-		elif L == 0xf:
-			color = 0xff - 1
-			repeat = (nr*256) + struct.unpack_from("<B", data, i+1)[0]
-			i += 1
-		else:
-			color = L << 4 | L
-			color &= antialias
-		i+=1
+def layer_runs(width: int, height: int, values, lengths, min_value: int = 1):
+	"""
+	Converts (value, length) runs into a RUN_DTYPE array of the runs with
+	value >= min_value, split where they wrap into the next image row.
+	Iterating it yields (row, col_start, col_end, value) records. Costs
+	O(runs), no pixel is expanded.
+	"""
+	size = width * height
+	ends = np.minimum(np.cumsum(lengths, dtype=np.int64), size)
+	starts = np.concatenate(([0], ends[:-1]))
+	keep = (np.asarray(values) >= min_value) & (starts < ends)
+	starts, ends, values = starts[keep], ends[keep], np.asarray(values)[keep]
 
-		while repeat > 0:
-			array[-1] += [color]
-			repeat -= 1
+	first_row = starts // width
+	last_row = (ends - 1) // width
+	pieces = last_row - first_row + 1
+	runs = np.empty(int(pieces.sum()), dtype=RUN_DTYPE)
+	owner = np.repeat(np.arange(len(pieces)), pieces)
+	rows = first_row[owner] + np.arange(len(owner)) - np.repeat(np.cumsum(pieces) - pieces, pieces)
+	runs["row"] = rows
+	runs["col_start"] = np.where(rows == first_row[owner], starts[owner] % width, 0)
+	runs["col_end"] = np.where(rows == last_row[owner], (ends[owner] - 1) % width + 1, width)
+	runs["value"] = values[owner]
+	return runs
 
-			x += 1
-			if x == width:
-				x = 0
-				array.append([])
 
-	array.pop()
-	return png.from_array(array, "L")
+def run_stats(runs, min_value: int = 1) -> tuple:
+	"""
+	Lit pixel count and bounding box (row_min, row_max, col_min, col_max,
+	inclusive) of the runs from layer_runs with value >= min_value. The
+	bounding box is -1 if no pixel is lit.
+	"""
+	runs = runs[runs["value"] >= min_value]
+	if not len(runs):
+		return (0, -1, -1, -1, -1)
+	pixels = int((runs["col_end"] - runs["col_start"]).sum(dtype=np.int64))
+	return (pixels, int(runs["row"].min()), int(runs["row"].max()),
+		int(runs["col_start"].min()), int(runs["col_end"].max()) - 1)
 
-def read_rle7image(width: int, height: int, data: bytes) -> png.Image:
-	array: List[List[int]] = [[]]
+def _scale5(channel):
+	# 5 bit to 8 bit, 0x1f becomes 0xff
+	return (channel << 3 | channel >> 2).astype(np.uint8)
 
-	(i, x) = (0, 0)
-	while i < len(data):
-		grey = struct.unpack_from("<B", data, i)[0]
-		# From each byte retrieve 
-		# bit 7(MSB) (highest bit)  single unique pixel(0) or run(1)
-		# bits 6:0(LSB) (lowest 7 bits) number of pixels of that color
-		# If a run is present, its length is encoded in the following 1-4 bytes.
-		code = grey
-		repeat = 1
-		if (grey & 0x80) == 0x80:
-			# Its a run
-			code = code & 0x7f# value of pixel 0-127
-			i+=1
-			# get the run length
-			rlen = struct.unpack_from("<B", data, i)[0]
-			if (rlen&0x80) == 0:
-				# 7 bit run length
-				repeat = rlen
-				#print(i, repeat,type(repeat), L)
-			elif (rlen&0xC0) == 0x80:
-				# 14 bit run length
-				repeat2 = struct.unpack_from("<B", data, i+1)[0]
-				repeat = rlen&0x3f
-				repeat = repeat << 8 | repeat2
-				#print(i, repeat,type(repeat), L)
-				i+=1
-			elif (rlen&0xE0) == 0xC0:
-				# 21 bit run length
-				repeat2 = struct.unpack_from("<B", data, i+1)[0]
-				repeat3 = struct.unpack_from("<B", data, i+2)[0]
-				repeat = rlen&0x1F
-				repeat = repeat << 8 | repeat2
-				repeat = repeat << 8 | repeat3
-				i += 2
-			elif (rlen&0xF0) == 0xE0:
-				# 28 bit run length
-				repeat2 = struct.unpack_from("<B", data, i+1)[0]
-				repeat3 = struct.unpack_from("<B", data, i+2)[0]
-				repeat4 = struct.unpack_from("<B", data, i+3)[0]
-				repeat = rlen&0xf
-				repeat = repeat << 8 | repeat2
-				repeat = repeat << 8 | repeat3
-				repeat = repeat << 8 | repeat4
-				i += 3
-			else:
-				return png.from_array(array, "L"), array
 
-		# Bit extend from 7-bit to 8-bit greymap
-		if (code != 0):
-			code = ((code << 1) | 1)
-			
-		while repeat > 0:# and len(array) < height+1:
-			array[-1] += [code]
-			repeat -= 1
+def _rgb15_runs(data: bytes):
+	"""
+	Splits an RGB15 preview stream into (rgb, lengths) runs, rgb is
+	(runs, 3) uint8 scaled to 8 bits
+	"""
+	words = np.frombuffer(data, dtype="<u2", count=len(data) // 2)
+	n = len(words)
+	is_run = (words & REPEAT_RGB15_MASK) != 0
+	starts = _token_starts(np.arange(n) + np.where(is_run, 2, 1))
+	# a run cut off by the end of the data is dropped
+	if len(starts) and is_run[starts[-1]] and starts[-1] + 1 >= n:
+		starts = starts[:-1]
+	colour16 = words[starts]
+	repeat = words[np.minimum(starts + 1, n - 1)] & 0xFFF
+	lengths = np.where(is_run[starts], 1 + repeat.astype(np.int64), 1)
+	rgb = np.stack((
+		_scale5(colour16 & 0x1F),
+		_scale5((colour16 >> 6) & 0x1F),
+		_scale5((colour16 >> 11) & 0x1F),
+	), axis=-1)
+	return rgb, lengths
 
-			x += 1
-			if x == width:
-				x = 0
-				array.append([])
-		i+=1
-			
-	array.pop()
-	return png.from_array(array[0:-1], "L")
+
+def read_rgb15array(width: int, height: int, data: bytes, out=None):
+	"""
+	Decodes an RGB15 run length preview (ctb, photon, fdg) into a
+	(height, width, 3) uint8 ndarray, written into out if given
+	"""
+	rgb, lengths = _rgb15_runs(data)
+	return _expand_runs(rgb, lengths, width * height, out).reshape(height, width, 3)
+
+
+def read_rgb565array(width: int, height: int, data: bytes):
+	"""
+	Decodes a raw little endian RGB565 preview (pws, pwms) into a
+	(height, width, 3) uint8 ndarray
+	"""
+	size = width * height
+	words = np.zeros(size, dtype="<u2")
+	raw = np.frombuffer(data, dtype="<u2", count=min(len(data) // 2, size))
+	words[:len(raw)] = raw
+	rgb = np.stack((
+		_scale5(words >> 11),
+		((words >> 5) & 0x3F) << 2 | ((words >> 5) & 0x3F) >> 4,
+		_scale5(words & 0x1F),
+	), axis=-1).astype(np.uint8)
+	return rgb.reshape(height, width, 3)
+
+
+def read_image(width: int, height: int, data: bytes) -> png.Image:
+	"""
+	Decodes an RGB15 run length preview to a png image
+	"""
+	return png.from_array(read_rgb15array(width, height, data).reshape(height, width * 3), "RGB")
+
+def read_grayimage(width: int, height: int, data: bytes) -> png.Image:
+	return png.from_array(read_grayarray(width, height, data), "L")
+
+def read_rle1image(width: int, height: int, data: bytes) -> png.Image:
+	return png.from_array(read_rle1array(width, height, data), "L;1")
 	
-def read_grayarray(width: int, height: int, data: bytes):
+def read_rle4image(width: int, height: int, antialias: int, data: bytes) -> png.Image:
+	return png.from_array(read_rle4array(width, height, antialias, data), "L")
+
+def read_rle7image(width: int, height: int, data: bytes) -> png.Image:
+	return png.from_array(read_rle7array(width, height, data), "L")
+	
+def _read_graylist(width: int, height: int, data: bytes):
+    """
+    Pure python grey RLE decoder, the reference read_grayarray is
+    tested against
+    """
     limit = width * height
     array: List[List[int]] = [[]]
     lastColor = 0xff
@@ -251,7 +236,76 @@ def read_grayarray(width: int, height: int, data: bytes):
     return array
 
 
-def read_rle1array(width: int, height: int, data: bytes):
+def _gray_runs(data: bytes, plane_lengths: Sequence[int], size: int):
+	"""
+	Splits grey RLE streams (CBDDLP, FDG) into (values, lengths) runs.
+	A code byte with bit 7 set is a new 7 bit colour and one pixel of it,
+	any other code repeats the current colour that many times. Each of
+	the concatenated planes starts with white as current colour and is
+	clipped or padded with black to exactly size pixels.
+	"""
+	codes = np.frombuffer(data, dtype=np.uint8)
+	n = len(codes)
+	plane_lengths = np.asarray(plane_lengths, dtype=np.int64)
+	plane_ends = np.cumsum(plane_lengths)
+	plane_starts = plane_ends - plane_lengths
+	plane = np.repeat(np.arange(len(plane_lengths)), plane_lengths)
+
+	is_colour = codes >= 0x80
+	# Convert from 0..124 to 8bpp, make 'white' actually white
+	colour = (codes & 0x7f) << 1 | (codes & 1)
+	colour = np.where(colour >= 0xfc, 0xff, colour)
+	last = np.maximum.accumulate(np.where(is_colour, np.arange(n), -1)) if n else np.zeros(0, dtype=np.int64)
+	values = np.where(last >= plane_starts[plane], colour[np.maximum(last, 0)], 0xff)
+	lengths = np.where(is_colour, 1, codes).astype(np.int64)
+
+	# pixel offsets inside each plane, clipped once at size
+	ends = np.concatenate(([0], np.cumsum(lengths)))
+	base = ends[plane_starts]
+	clipped = np.minimum(ends[1:] - base[plane], size)
+	lengths = clipped - np.minimum(ends[:-1] - base[plane], size)
+	padding = size - np.minimum(ends[plane_ends] - base, size)
+	values = np.insert(values, plane_ends, 0)
+	lengths = np.insert(lengths, plane_ends, padding)
+	return values, lengths
+
+
+def read_grayarray(width: int, height: int, data: bytes, out=None):
+	"""
+	Decodes a grey RLE layer into a (height, width) uint8 ndarray,
+	written into out if given
+	"""
+	size = width * height
+	values, lengths = _gray_runs(data, [len(data)], size)
+	return _expand_runs(values, lengths, size, out).reshape(height, width)
+
+
+def read_grayruns(width: int, height: int, data: bytes, min_value: int = 1):
+	"""
+	Row runs (see layer_runs) of a grey RLE layer
+	"""
+	values, lengths = _gray_runs(data, [len(data)], width * height)
+	return layer_runs(width, height, values, lengths, min_value)
+
+
+def read_grayplanes(width: int, height: int, planes: Sequence[bytes]):
+	"""
+	Decodes several grey RLE anti-alias planes of one layer in a single
+	pass and sums them into one (height, width) uint16 image, so nothing
+	is clipped; divide by len(planes) for the mean grey level
+	"""
+	size = width * height
+	if not len(planes):
+		return np.zeros((height, width), dtype=np.uint16)
+	values, lengths = _gray_runs(b"".join(planes), [len(plane) for plane in planes], size)
+	pixels = np.repeat(values.astype(np.uint8), lengths).reshape(len(planes), height, width)
+	return pixels.sum(axis=0, dtype=np.uint16)
+
+
+def _read_rle1list(width: int, height: int, data: bytes):
+	"""
+	Pure python RLE1 decoder, the reference read_rle1array is tested against
+	"""
 	array: List[List[int]] = [[]]
 
 	(i, x) = (0, 0)
@@ -275,8 +329,51 @@ def read_rle1array(width: int, height: int, data: bytes):
 	
 	array.pop()
 	return array
+
+
+def _rle1_runs(data: bytes):
+	"""
+	Splits a 1 bit RLE stream into (values, lengths) arrays. Every byte
+	is one run: bit 7 is the pixel, bits 6:0 the run length where 0
+	means a single pixel.
+	"""
+	codes = np.frombuffer(data, dtype=np.uint8)
+	lengths = codes & 0x7f
+	return codes >> 7, np.where(lengths == 0, 1, lengths)
+
+
+def read_rle1array(width: int, height: int, data: bytes, packed: bool = False, out=None):
+	"""
+	Decodes a 1 bit RLE layer (photon, pws) into a (height, width)
+	uint8 ndarray of 0 and 1, written into out if given. With packed the
+	rows are returned as np.packbits bytes, (height, ceil(width / 8)),
+	see unpack_rle1array; out is then only used as scratch space.
+	"""
+	values, lengths = _rle1_runs(data)
+	array = _expand_runs(values, lengths, width * height, out).reshape(height, width)
+	if packed:
+		return np.packbits(array, axis=1)
+	return array
+
+
+def read_rle1runs(width: int, height: int, data: bytes, min_value: int = 1):
+	"""
+	Row runs (see layer_runs) of a 1 bit RLE layer
+	"""
+	values, lengths = _rle1_runs(data)
+	return layer_runs(width, height, values, lengths, min_value)
+
+
+def unpack_rle1array(width: int, packed):
+	"""
+	Expands a packed layer from read_rle1array back to 0 and 1 pixels
+	"""
+	return np.unpackbits(packed, axis=1, count=width)
 	
-def read_rle4array(width: int, height: int, antialias: int, data: bytes):
+def _read_rle4list(width: int, height: int, antialias: int, data: bytes):
+	"""
+	Pure python RLE4 decoder, the reference read_rle4array is tested against
+	"""
 	array: List[List[int]] = [[]]
 
 	(i, x) = (0, 0)
@@ -311,69 +408,145 @@ def read_rle4array(width: int, height: int, antialias: int, data: bytes):
 	array.pop()
 	return array
 
-def read_rle7array(width: int, height: int, data: bytes):
-	array: List[List[int]] = [[]]
 
-	(i, x) = (0, 0)
-	while i < len(data):
-		grey = struct.unpack_from("<B", data, i)[0]
-		# From each byte retrieve 
-		# bit 7(MSB) (highest bit)  single unique pixel(0) or run(1)
-		# bits 6:0(LSB) (lowest 7 bits) number of pixels of that color
-		# If a run is present, its length is encoded in the following 1-4 bytes.
-		code = grey
+def _rle4_runs(data: bytes, antialias: int):
+	"""
+	Splits an Anycubic RLE4 stream into (values, lengths) arrays. The
+	high nibble of a code byte is the colour. Black (0x0) and white
+	(0xf, stored as 0xfe) are followed by a second byte, the low nibble
+	and that byte form a 12 bit run length. Any other colour is a single
+	grey pixel, masked by antialias.
+	"""
+	codes = np.frombuffer(data, dtype=np.uint8)
+	n = len(codes)
+	colour = codes >> 4
+	is_run = (colour == 0x0) | (colour == 0xf)
+	starts = _token_starts(np.arange(n) + np.where(is_run, 2, 1))
+	# a run cut off by the end of the data is dropped
+	if len(starts) and is_run[starts[-1]] and starts[-1] + 1 >= n:
+		starts = starts[:-1]
+
+	colour = colour[starts]
+	run = is_run[starts]
+	next_byte = codes[np.minimum(starts + 1, n - 1)].astype(np.int64)
+	lengths = np.where(run, (codes[starts] & 0xf).astype(np.int64) << 8 | next_byte, 1)
+	values = np.where(colour == 0xf, 0xfe, (colour << 4 | colour) & (int(antialias) & 0xff))
+	values = np.where(colour == 0x0, 0, values)
+	return values, lengths
+
+
+def read_rle4array(width: int, height: int, antialias: int, data: bytes, out=None):
+	"""
+	Decodes an Anycubic RLE4 layer (pwms, pwmx, pw0) into a
+	(height, width) uint8 ndarray, written into out if given
+	"""
+	values, lengths = _rle4_runs(data, antialias)
+	return _expand_runs(values, lengths, width * height, out).reshape(height, width)
+
+
+def read_rle4runs(width: int, height: int, antialias: int, data: bytes, min_value: int = 1):
+	"""
+	Row runs (see layer_runs) of an Anycubic RLE4 layer
+	"""
+	values, lengths = _rle4_runs(data, antialias)
+	return layer_runs(width, height, values, lengths, min_value)
+
+def _rle7_runs(data: bytes):
+	"""
+	Splits a CTB RLE7 stream into (values, lengths) arrays.
+	bit 7 of a code byte flags a run, bits 6:0 hold the 7-bit grey
+	value. A run is followed by a 1-4 byte length whose leading bits
+	give its width (0xxxxxxx, 10xxxxxx, 110xxxxx, 1110xxxx).
+	Decoding stops at the first malformed length, like the original
+	per pixel decoder did.
+	"""
+	codes = np.frombuffer(data, dtype=np.uint8)
+	n = len(codes)
+	padded = np.concatenate((codes, np.zeros(5, dtype=np.uint8))).astype(np.int64)
+
+	is_run = codes >= 0x80
+	rlen = padded[1:n + 1]
+	extra = np.select(
+		[rlen < 0x80, (rlen & 0xC0) == 0x80, (rlen & 0xE0) == 0xC0, (rlen & 0xF0) == 0xE0],
+		[0, 1, 2, 3],
+		default=-1)
+	width = np.where(is_run, 2 + np.maximum(extra, 0), 1)
+	starts = _token_starts(np.arange(n) + width)
+
+	run = is_run[starts]
+	extra = extra[starts]
+	bad = np.flatnonzero((run & (extra < 0)) | (starts + width[starts] > n))
+	if len(bad):
+		starts, run, extra = starts[:bad[0]], run[:bad[0]], extra[:bad[0]]
+
+	code = padded[starts] & 0x7f
+	lengths = padded[starts + 1] & np.array([0x7f, 0x3f, 0x1f, 0x0f])[extra]
+	for j in range(1, 4):
+		lengths = np.where(extra >= j, (lengths << 8) | padded[starts + 1 + j], lengths)
+	lengths = np.where(run, lengths, 1)
+
+	# Bit extend from 7-bit to 8-bit greymap
+	values = np.where(code != 0, (code << 1) | 1, 0)
+	return values, lengths
+
+
+def _read_rle7list(width: int, height: int, data: bytes) -> List[List[int]]:
+	"""
+	Pure python RLE7 decoder, the reference read_rle7array is tested against
+	"""
+	limit = width * height
+	pixels = bytearray()
+	i = 0
+	while i < len(data) and len(pixels) < limit:
+		code = data[i]
 		repeat = 1
-		if (grey & 0x80) == 0x80:
-			# Its a run
-			code = code & 0x7f# value of pixel 0-127
-			i+=1
-			# get the run length
-			rlen = struct.unpack_from("<B", data, i)[0]
-			if (rlen&0x80) == 0:
+		if code & 0x80:
+			# Its a run, get the run length
+			code &= 0x7f
+			i += 1
+			if i >= len(data):
+				break
+			rlen = data[i]
+			if (rlen & 0x80) == 0:
 				# 7 bit run length
-				repeat = rlen
-				#print(i, repeat,type(repeat), L)
-			elif (rlen&0xC0) == 0x80:
+				repeat, extra = rlen, 0
+			elif (rlen & 0xC0) == 0x80:
 				# 14 bit run length
-				repeat2 = struct.unpack_from("<B", data, i+1)[0]
-				repeat = rlen&0x3f
-				repeat = repeat << 8 | repeat2
-				#print(i, repeat,type(repeat), L)
-				i+=1
-			elif (rlen&0xE0) == 0xC0:
+				repeat, extra = rlen & 0x3f, 1
+			elif (rlen & 0xE0) == 0xC0:
 				# 21 bit run length
-				repeat2 = struct.unpack_from("<B", data, i+1)[0]
-				repeat3 = struct.unpack_from("<B", data, i+2)[0]
-				repeat = rlen&0x1F
-				repeat = repeat << 8 | repeat2
-				repeat = repeat << 8 | repeat3
-				i += 2
-			elif (rlen&0xF0) == 0xE0:
+				repeat, extra = rlen & 0x1f, 2
+			elif (rlen & 0xF0) == 0xE0:
 				# 28 bit run length
-				repeat2 = struct.unpack_from("<B", data, i+1)[0]
-				repeat3 = struct.unpack_from("<B", data, i+2)[0]
-				repeat4 = struct.unpack_from("<B", data, i+3)[0]
-				repeat = rlen&0xf
-				repeat = repeat << 8 | repeat2
-				repeat = repeat << 8 | repeat3
-				repeat = repeat << 8 | repeat4
-				i += 3
+				repeat, extra = rlen & 0x0f, 3
 			else:
-				return png.from_array(array, "L"), array
-
+				break
+			if i + extra >= len(data):
+				break
+			for _ in range(extra):
+				i += 1
+				repeat = repeat << 8 | data[i]
 		# Bit extend from 7-bit to 8-bit greymap
-		if (code != 0):
-			code = ((code << 1) | 1)
-			
-		while repeat > 0:# and len(array) < height+1:
-			array[-1] += [code]
-			repeat -= 1
+		if code != 0:
+			code = (code << 1) | 1
+		pixels += bytes([code]) * min(repeat, limit - len(pixels))
+		i += 1
+	pixels += bytes(limit - len(pixels))
+	return [list(pixels[row:row + width]) for row in range(0, limit, width)]
 
-			x += 1
-			if x == width:
-				x = 0
-				array.append([])
-		i+=1
-			
-	array.pop()
-	return array
+
+def read_rle7array(width: int, height: int, data: bytes, out=None):
+	"""
+	Decodes a CTB RLE7 layer into a (height, width) uint8 ndarray,
+	written into out if given
+	"""
+	values, lengths = _rle7_runs(data)
+	return _expand_runs(values, lengths, width * height, out).reshape(height, width)
+
+
+def read_rle7runs(width: int, height: int, data: bytes, min_value: int = 1):
+	"""
+	Row runs (see layer_runs) of a CTB RLE7 layer
+	"""
+	values, lengths = _rle7_runs(data)
+	return layer_runs(width, height, values, lengths, min_value)
@@ -0,0 +1,137 @@
+import dataclasses
+import struct
+from typing import Tuple
+
+# struct format character -> numpy type character of the same size
+_DTYPE_CODES = {
+	"c": "S1", "b": "i1", "B": "u1", "?": "?", "h": "i2", "H": "u2",
+	"i": "i4", "I": "u4", "q": "i8", "Q": "u8", "f": "f4", "d": "f8",
+}
+
+
+def _struct_field(format: str):
+	return dataclasses.field(metadata={"format": format})
+
+
+class StructType:
+	"""
+	Field declarations of a Struct dataclass, same names as typedstruct
+	"""
+
+	@classmethod
+	def char(cls) -> bytes:
+		return _struct_field("c")
+
+	@classmethod
+	def signed_char(cls) -> int:
+		return _struct_field("b")
+
+	@classmethod
+	def unsigned_char(cls) -> int:
+		return _struct_field("B")
+
+	@classmethod
+	def boolean(cls) -> bool:
+		return _struct_field("?")
+
+	@classmethod
+	def int16(cls) -> int:
+		return _struct_field("h")
+
+	@classmethod
+	def uint16(cls) -> int:
+		return _struct_field("H")
+
+	@classmethod
+	def int32(cls) -> int:
+		return _struct_field("i")
+
+	@classmethod
+	def uint32(cls) -> int:
+		return _struct_field("I")
+
+	@classmethod
+	def int64(cls) -> int:
+		return _struct_field("q")
+
+	@classmethod
+	def uint64(cls) -> int:
+		return _struct_field("Q")
+
+	@classmethod
+	def float32(cls) -> float:
+		return _struct_field("f")
+
+	@classmethod
+	def double64(cls) -> float:
+		return _struct_field("d")
+
+	@classmethod
+	def chars(cls, length: int = 1) -> bytes:
+		return _struct_field("{}s".format(length))
+
+
+class Struct:
+	"""
+	Base of the binary records of the file formats, declared as frozen
+	dataclasses with StructType fields. The struct.Struct and the field
+	names are compiled once per class on first use, records are filled
+	straight from struct.unpack without going through the dataclass
+	__init__.
+	"""
+
+	FORMAT_PREFIX: str = ""
+
+	@classmethod
+	def _compiled(cls) -> Tuple[struct.Struct, Tuple[str, ...]]:
+		compiled = cls.__dict__.get("_compiled_struct")
+		if compiled is None:
+			fields = dataclasses.fields(cls)
+			compiled = (
+				struct.Struct(cls.FORMAT_PREFIX + "".join(f.metadata["format"] for f in fields)),
+				tuple(f.name for f in fields))
+			cls._compiled_struct = compiled
+		return compiled
+
+	@classmethod
+	def _make(cls, values):
+		record = object.__new__(cls)
+		record.__dict__.update(zip(cls._compiled()[1], values))
+		return record
+
+	@classmethod
+	def get_format(cls) -> str:
+		return cls._compiled()[0].format
+
+	@classmethod
+	def get_size(cls) -> int:
+		return cls._compiled()[0].size
+
+	@classmethod
+	def unpack(cls, buffer: bytes):
+		return cls._make(cls._compiled()[0].unpack(buffer))
+
+	@classmethod
+	def unpack_from(cls, buffer: bytes, offset: int = 0):
+		return cls._make(cls._compiled()[0].unpack_from(buffer, offset))
+
+	@classmethod
+	def dtype(cls):
+		"""
+		Equivalent numpy structured dtype, for reading whole tables of
+		records at once (see layers.read_layer_table)
+		"""
+		import numpy as np
+
+		byte_order = "<" if cls.FORMAT_PREFIX == "<" else ">" if cls.FORMAT_PREFIX == ">" else "="
+		return np.dtype([
+			(f.name, byte_order + _DTYPE_CODES.get(f.metadata["format"], "S" + f.metadata["format"][:-1]))
+			for f in dataclasses.fields(cls)])
+
+
+class LittleEndianStruct(Struct):
+	FORMAT_PREFIX: str = "<"
+
+
+class BigEndianStruct(Struct):
+	FORMAT_PREFIX: str = ">"
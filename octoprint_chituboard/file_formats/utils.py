@@ -1,25 +1,47 @@
+import importlib
 import os
-from typing import Mapping, Set, Type
+from collections import abc
+from typing import Dict, Mapping, Set, Tuple, Type
 
 from . import SlicedModelFile
-from .ctb import CTBFile
-from .cbddlp import CBDDLPFile
-from .fdg import FDGFile
-from .photon import PhotonFile
-from .pws import PwsFile
-from .pwms import PwmsFile
-
-EXTENSION_TO_FILE_FORMAT: Mapping[str, Type[SlicedModelFile]] = {
-	".ctb": CTBFile,
-	".cbddlp": CBDDLPFile,
-	".photon": PhotonFile,
-	".fdg": FDGFile,
-	".pws": PwsFile,
-	".pw0": PwmsFile,
-	".pwmo": PwmsFile,
-	".pwms": PwmsFile,
-	".pwmx": PwmsFile,
-}
+
+
+class _FileFormatRegistry(abc.Mapping):
+	"""
+	Extension to SlicedModelFile class mapping that imports a format's
+	module (and with it numpy) only when the extension is first looked up
+	"""
+
+	def __init__(self, modules: Dict[str, Tuple[str, str]]):
+		self._modules = modules
+		self._formats: Dict[str, Type[SlicedModelFile]] = {}
+
+	def __getitem__(self, extension: str) -> Type[SlicedModelFile]:
+		file_format = self._formats.get(extension)
+		if file_format is None:
+			module_name, class_name = self._modules[extension]
+			module = importlib.import_module("." + module_name, __package__)
+			file_format = self._formats[extension] = getattr(module, class_name)
+		return file_format
+
+	def __iter__(self):
+		return iter(self._modules)
+
+	def __len__(self) -> int:
+		return len(self._modules)
+
+
+EXTENSION_TO_FILE_FORMAT: Mapping[str, Type[SlicedModelFile]] = _FileFormatRegistry({
+	".ctb": ("ctb", "CTBFile"),
+	".cbddlp": ("cbddlp", "CBDDLPFile"),
+	".photon": ("photon", "PhotonFile"),
+	".fdg": ("fdg", "FDGFile"),
+	".pws": ("pws", "PwsFile"),
+	".pw0": ("pwms", "PwmsFile"),
+	".pwmo": ("pwms", "PwmsFile"),
+	".pwms": ("pwms", "PwmsFile"),
+	".pwmx": ("pwms", "PwmsFile"),
+})
 
 def get_file_format(filename: str) -> Type[SlicedModelFile]:
 	(_, extension) = os.path.splitext(filename)
@@ -0,0 +1,131 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+import logging
+import re
+
+from .poll_scheduler import POLL_TYPES, PollScheduler
+
+regex_float_pattern = r"[-+]?[0-9]*\.?[0-9]+"
+regex_int_pattern = r"\d+"
+
+# fields of the firmware's M4000 status report, e.g.
+# ok B:0/0 X:0.000 Y:0.000 Z:150.000 F:256/256 D:0/0/1 T:0
+parse_M4000 = {
+	"floatB": re.compile(r"(^|[^A-Za-z])[Bb]:\s*(?P<actual>%s)(\s*\/?\s*(?P<target>%s))" %
+					 (regex_float_pattern, regex_float_pattern)),
+	"floatD": re.compile(r"(^|[^A-Za-z])[Dd]:\s*(?P<current>%s)(\s*\/?\s*(?P<total>%s))(\s*\/?\s*(?P<pause>%s))" %
+					 (regex_float_pattern, regex_float_pattern, regex_int_pattern)),
+	"floatE": re.compile(r"(^|[^A-Za-z])[Ee](?P<value>%s)" % regex_float_pattern),
+	"floatX": re.compile(r"(^|[^A-Za-z])[Xx]:(?P<value>%s)" % regex_float_pattern),
+	"floatY": re.compile(r"(^|[^A-Za-z])[Yy]:(?P<value>%s)" % regex_float_pattern),
+	"floatZ": re.compile(r"(^|[^A-Za-z])[Zz]:(?P<value>%s)" % regex_float_pattern),
+	"intN": re.compile(r"(^|[^A-Za-z])[Nn](?P<value>%s)" % regex_int_pattern),
+	"intS": re.compile(r"(^|[^A-Za-z])[Ss](?P<value>%s)" % regex_int_pattern),
+	"intT": re.compile(r"(^|[^A-Za-z])[Tt](?P<value>%s)" % regex_int_pattern),
+	}
+
+# One search over a received line finds the rewrite it needs, the group
+# name is the kind of line. A line the firmware sends is of at most one
+# kind. Most lines ("ok", "ok N12") match nothing.
+RECEIVED_KEYWORDS = re.compile(
+	r"^(?P<wait>wait)"
+	r"|^(?P<start>ok V)"
+	r"|(?P<identifier>CBD make it|ZWLF make it)"
+	r"|(?P<sd_byte>SD printing byte)"
+	r"|(?P<m4000>(?<![A-Za-z])[BbDd]:)"
+	r"|(?P<m114>C: X:)"
+	r"|(?P<error>not printing now)")
+
+# received lines reach the hook with their line ending
+_PLAIN_LINES = frozenset(("", "\n", "\r\n", "ok", "ok\n", "ok\r\n"))
+
+
+def classify_received(line):
+	"""
+	Kind of rewrite a received line needs (a group of RECEIVED_KEYWORDS),
+	None for lines that pass through unchanged
+	"""
+	if line in _PLAIN_LINES:
+		return None
+	match = RECEIVED_KEYWORDS.search(line)
+	return match.lastgroup if match is not None else None
+
+
+class gcode_modifier():
+	def __init__(self):
+		# ~ self._printer = PrinterInterface
+		self._logged_replacement = {}
+		self._logger = logging.getLogger("octoprint.plugin")
+		self.poll_scheduler = PollScheduler()
+
+	def get_gcode_send_modifier(self, comm_instance, phase, cmd, cmd_type, gcode,subcode=None , tags=None, *args, **kwargs):
+		if cmd.upper().startswith('M110'): #suppress line reset
+			return (None, )
+		# ~ elif gcode == "M105":
+			# ~ return "M4000", cmd_type
+		# ~ elif gcode == "M25" and "trigger:comm.cancel" in tags:
+			# ~ return "M33", cmd_type
+		else:
+			return None
+	
+	def get_gcode_queuing_modifier(self, comm_instance, phase, cmd, cmd_type, gcode, subcode=None, tags=None, *args, **kwargs):
+		if cmd_type in POLL_TYPES and not self.poll_scheduler.should_poll(cmd_type):
+			return (None, )
+		if gcode == "M105" and cmd_type == "temperature_poll":
+			return "M4000", cmd_type
+		elif gcode == "M25" and "trigger:comm.cancel" in tags:
+			return "M33", cmd_type
+
+
+# received lines of a short print on a Mars 2, used by the benchmark
+# below when no serial.log is given
+_SAMPLE_LOG = [
+	"ok V4.2.20.3_LCDM",
+	"ok",
+	"CBD make it. Date:Nov 11 2019 Time:16:39:09",
+	"ok",
+	"ok B:0/0 X:0.000 Y:0.000 Z:150.000 F:256/256 D:0/0/1 T:0",
+	"ok",
+	"SD printing byte 0/8392402",
+	"ok N0",
+	"wait",
+	"ok B:0/0 X:0.000 Y:0.000 Z:0.050 F:256/256 D:12839/8392402/0 T:0",
+	"ok",
+	"SD printing byte 12839/8392402",
+	"ok",
+	"ok C: X:0.000000 Y:0.000000 Z:0.050000 E:0.000000",
+	"ok",
+	"wait",
+	"ok",
+	"ok N1",
+	"Error:It's not printing now!",
+	"ok",
+]
+
+
+def _chained_checks(line):
+	# what the receive hook used to evaluate for every line
+	return (line.startswith("wait"), "CBD make it" in line, "ZWLF make it" in line,
+		"SD printing byte" in line, line.startswith("ok V"),
+		parse_M4000["floatB"].search(line), parse_M4000["floatD"].search(line),
+		parse_M4000["floatX"].search(line), parse_M4000["floatY"].search(line),
+		parse_M4000["floatZ"].search(line), "C: X:" in line, "not printing now" in line)
+
+
+def _received_lines(path):
+	with open(path, "r", errors="replace") as log:
+		return [line.split("Recv: ", 1)[1].rstrip("\r\n") for line in log if "Recv: " in line]
+
+
+if __name__ == "__main__":
+	import sys
+	import timeit
+
+	lines = _received_lines(sys.argv[1]) if len(sys.argv) > 1 else _SAMPLE_LOG
+	if not lines:
+		sys.exit("no received lines found")
+	repeat = max(1, 200000 // len(lines))
+	for name, check in (("chained checks", _chained_checks), ("classify_received", classify_received)):
+		seconds = min(timeit.repeat(lambda: [check(line) for line in lines], number=repeat, repeat=3))
+		print("{:<18} {:7.0f} ns/line".format(name, seconds / (repeat * len(lines)) * 1e9))
@@ -0,0 +1,82 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+"""
+Import time check for the plugin and the analysis worker, run with
+
+	python -m octoprint_chituboard.importtime [--budget MS]
+
+Every case is imported in a fresh interpreter. A case fails if one of
+the modules that are meant to be loaded on demand (numpy, png, the file
+format modules, the printer) got imported, or if it took longer than
+the budget.
+
+It has to run with the python of an OctoPrint install: python -m loads
+the plugin package first, and so does every case, and its __init__
+imports flask and octoprint. These are not stubbed in the probe because
+their import time is part of what the plugin case measures.
+"""
+
+import argparse
+import json
+import subprocess
+import sys
+
+_PACKAGE = __name__.rpartition(".")[0] or "octoprint_chituboard"
+_FORMAT_MODULES = ["file_formats." + name for name in ("ctb", "cbddlp", "fdg", "photon", "pws", "pwms")]
+
+# (name, statement, modules that must not be imported by it)
+CASES = [
+	("plugin", "import {package}",
+		["numpy", "png", "sla_printer", "sla_analyser"] + _FORMAT_MODULES),
+	("format registry", "from {package}.file_formats import utils; utils.get_supported_extensions()",
+		["numpy", "png", "sla_printer"] + _FORMAT_MODULES),
+	("ctb reader", "from {package}.file_formats import utils; utils.get_file_format('model.ctb')",
+		["sla_printer"] + [name for name in _FORMAT_MODULES if name != "file_formats.ctb"]),
+]
+
+_PROBE = """
+import json, sys, time
+start = time.perf_counter()
+{statement}
+print(json.dumps({{"seconds": time.perf_counter() - start, "modules": sorted(sys.modules)}}))
+"""
+
+
+def measure(statement: str) -> dict:
+	"""
+	Runs statement in a new interpreter, returns the seconds it took and
+	the modules loaded afterwards
+	"""
+	output = subprocess.run(
+		[sys.executable, "-c", _PROBE.format(statement=statement)],
+		check=True, stdout=subprocess.PIPE, universal_newlines=True).stdout
+	return json.loads(output.splitlines()[-1])
+
+
+def _qualified(name: str) -> str:
+	if name in ("numpy", "png"):
+		return name
+	return "{}.{}".format(_PACKAGE, name)
+
+
+def main(argv=None) -> int:
+	parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+	parser.add_argument("--budget", type=float, default=None,
+		help="fail cases taking longer than this many milliseconds")
+	args = parser.parse_args(argv)
+
+	failed = False
+	for name, statement, lazy in CASES:
+		result = measure(statement.format(package=_PACKAGE))
+		eager = [module for module in map(_qualified, lazy) if module in result["modules"]]
+		millis = result["seconds"] * 1000
+		problems = ["imported " + module for module in eager]
+		if args.budget is not None and millis > args.budget:
+			problems.append("over budget of {:.0f} ms".format(args.budget))
+		print("{:<16} {:8.1f} ms  {}".format(name, millis, ", ".join(problems) or "ok"))
+		failed = failed or bool(problems)
+	return 1 if failed else 0
+
+
+if __name__ == "__main__":
+	sys.exit(main())
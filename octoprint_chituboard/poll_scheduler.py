@@ -0,0 +1,153 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+import threading
+import time
+from typing import Callable, Optional, Sequence
+
+# command types of the polls OctoPrint queues on its own timers: the
+# temperature poll (sent as M4000, see gcode_modifier) and M27
+POLL_TYPES = ("temperature_poll", "sd_status_poll")
+
+
+class PollScheduler:
+	"""
+	Thins out OctoPrint's status polls during an SLA print. A layer takes
+	seconds to expose and lift and nothing is reported in between, so
+	polls are spaced out until shortly before the layer is expected to
+	end and then let through at the timer rate to catch the layer change.
+
+	Expected layer times come from the sliced file and are rescaled by
+	how long layers actually took. The scheduler can only drop polls, not
+	add any, so the timer intervals are the fastest it polls.
+	"""
+
+	def __init__(self, boundary_window: float = 2.0, max_interval: float = 15.0,
+			clock: Callable[[], float] = time.monotonic):
+		self.enabled = True
+		# seconds before the expected end of a layer from which every poll is sent
+		self.boundary_window = boundary_window
+		# longest gap between two polls of a type, pauses are noticed through M4000
+		self.max_interval = max_interval
+		self._clock = clock
+		self._lock = threading.Lock()
+		self.reset()
+
+	def reset(self, durations: Optional[Sequence[float]] = None):
+		"""
+		Starts scheduling a print with the given expected seconds per
+		layer, or stops scheduling if durations is None. Clears the stats.
+		"""
+		with self._lock:
+			self._durations = durations
+			self._scale = 1.0
+			self._layer = None
+			self._layer_started = None
+			self._layer_exact = False
+			self._last_poll = {}
+			self._pending = {}
+			self._layer_polls = 0
+			self._finished_layers = 0
+			self._finished_layer_polls = 0
+			self._last_layer_polls = None
+			self._sent = 0
+			self._dropped = 0
+			self._latency_count = 0
+			self._latency_sum = 0.0
+			self._latency_max = 0.0
+
+	def stop(self):
+		"""
+		Stops scheduling, polls go out at the timer rate again. The stats
+		of the print are kept until the next reset.
+		"""
+		with self._lock:
+			self._durations = None
+			self._pending.clear()
+
+	@property
+	def active(self) -> bool:
+		return self.enabled and self._durations is not None
+
+	def _window_start(self) -> Optional[float]:
+		if self._layer is None or not self._durations:
+			return None
+		expected = self._durations[min(self._layer, len(self._durations) - 1)] * self._scale
+		return self._layer_started + expected - self.boundary_window
+
+	def should_poll(self, poll_type: str) -> bool:
+		"""
+		Called for every poll OctoPrint queues, False if it should be
+		dropped. Polls that are let through count as sent.
+		"""
+		if not self.active:
+			return True
+		with self._lock:
+			now = self._clock()
+			last = self._last_poll.get(poll_type)
+			window_start = self._window_start()
+			if last is not None and window_start is not None:
+				due = last + min(max(window_start - last, 0.0), self.max_interval)
+				if now < due:
+					self._dropped += 1
+					return False
+			self._last_poll[poll_type] = now
+			self._pending.setdefault(poll_type, now)
+			self._layer_polls += 1
+			self._sent += 1
+			return True
+
+	def reply_received(self, poll_type: str):
+		"""
+		Records the time from queueing the oldest unanswered poll of
+		poll_type to its reply
+		"""
+		with self._lock:
+			queued = self._pending.pop(poll_type, None)
+			if queued is None:
+				return
+			latency = self._clock() - queued
+			self._latency_count += 1
+			self._latency_sum += latency
+			self._latency_max = max(self._latency_max, latency)
+
+	def layer_seen(self, index: int):
+		"""
+		Reports the layer the printer is on (from an M27 reply). When it
+		moved on by one the time the last layer took rescales the expected
+		layer times.
+		"""
+		if not self.active:
+			return
+		with self._lock:
+			if index == self._layer:
+				return
+			now = self._clock()
+			if self._layer is not None:
+				expected = self._durations[min(self._layer, len(self._durations) - 1)] if self._durations else 0
+				if self._layer_exact and index == self._layer + 1 and expected > 0:
+					ratio = (now - self._layer_started) / expected
+					self._scale = min(max(0.7 * self._scale + 0.3 * ratio, 0.25), 4.0)
+				self._finished_layers += 1
+				self._finished_layer_polls += self._layer_polls
+				self._last_layer_polls = self._layer_polls
+			# the first layer seen was already running for an unknown time
+			self._layer_exact = self._layer is not None
+			self._layer = index
+			self._layer_started = now
+			self._layer_polls = 0
+
+	def stats(self) -> dict:
+		with self._lock:
+			return dict(
+				active = self.active,
+				layer = None if self._layer is None else self._layer + 1,
+				pollsSent = self._sent,
+				pollsDropped = self._dropped,
+				pollsPerLayer = self._finished_layer_polls / self._finished_layers if self._finished_layers else None,
+				lastLayerPolls = self._last_layer_polls,
+				replyLatencyMs = dict(
+					mean = self._latency_sum / self._latency_count * 1000 if self._latency_count else None,
+					max = self._latency_max * 1000 if self._latency_count else None,
+					count = self._latency_count),
+				layerTimeScale = self._scale)
@@ -1,10 +1,10 @@
 #!/usr/bin/python
 # -*- coding: utf-8 -*-
 
-from octoprint.filemanager.analysis import AbstractAnalysisQueue
+from octoprint.filemanager.analysis import AbstractAnalysisQueue, AnalysisAborted
 import pprint
 import struct
-import yaml, time, os, math
+import time, os, math
 import logging
 
 from octoprint.events import Events, eventManager
@@ -14,7 +14,7 @@ from octoprint.util import get_fully_qualified_classname as fqcn
 from octoprint.util import monotonic_time
 from octoprint.util.platform import CLOSE_FDS
 
-from .file_formats.utils import get_file_format
+from .analysis_worker import AnalysisCancelled, AnalysisWorker
 from pathlib import Path
 
 
@@ -22,19 +22,22 @@ class sla_AnalysisQueue(AbstractAnalysisQueue):
 	"""
 	A queue to analyze SLA print files from
 	Chitubox, Lychee, or photon slicer
+
+	cache and thumbnails return the plugin's AnalysisCache and
+	ThumbnailCache, or None while there is none: the analysis factory
+	hook runs before the plugin is initialized and has created them
 	"""
 
-	def __init__(self, finished_callback):
+	def __init__(self, finished_callback, worker=None, cache=None, thumbnails=None):
 		AbstractAnalysisQueue.__init__(self, finished_callback)
 		
 		self._aborted = False
 		self._reenqueue = False
+		self._worker = worker if worker is not None else AnalysisWorker()
+		self._cache = cache
+		self._thumbnails = thumbnails
 
 	def _do_analysis(self, high_priority=False):
-		import sys
-		from io import TextIOWrapper
-		import sarge
-		import yaml
 		#results = {'analysisPending': True}
 		#self._finished_callback(self._current, results)
 		if self._current.analysis and all(
@@ -46,103 +49,56 @@ class sla_AnalysisQueue(AbstractAnalysisQueue):
 			return self._current.analysis
 		
 		try:
-			command = [
-				sys.executable,
-				"-m",
-				"octoprint",
-				"plugins",
-				"chituboard:sla_analysis",
-			]
-			command.append(self._current.absolute_path)
-			self._logger.debug("Invoking analysis commands: {}".format(" ".join(command)))
-		
 			self._aborted = False
-			p = sarge.run(
-				command, close_fds=CLOSE_FDS, async_=True, stdout=sarge.Capture()
-			)
-			self._logger.debug("check sarge process: ", p.commands[0])
-			while len(p.commands) == 0:
-				# somewhat ugly... we can't use wait_events because
-				# the events might not be all set if an exception
-				# by sarge is triggered within the async process
-				# thread
-				time.sleep(0.01)
-			self._logger.debug("check sarge process: ", p.commands[0])
-
-			# by now we should have a command, let's wait for its
-			# process to have been prepared
-			p.commands[0].process_ready.wait()
-			
-			if not p.commands[0].process:
-				# the process might have been set to None in case of any exception
-				raise RuntimeError(
-					"Error while trying to run command {}".format(" ".join(command))
-				)
-			try:
-				# let's wait for stuff to finish
-				while p.returncode is None:
-					if self._aborted:
-						# oh, we shall abort, let's do so!
-						p.commands[0].terminate()
-						raise AnalysisAborted(reenqueue=self._reenqueue)
-					# else continue
-					p.commands[0].poll()
-			finally:
-				p.close()
-			output = p.stdout.text
-			self._logger.debug("Got output: {!r}".format(output))
+			analysis = None
+			cache = self._cache() if self._cache is not None else None
+			if cache is not None:
+				analysis = cache.get(self._current.absolute_path)
+			if analysis is None:
+				self._logger.debug("Analysing {} in worker process".format(self._current.absolute_path))
+				try:
+					envelope = self._worker.analyse(
+						self._current.absolute_path, is_aborted=lambda: self._aborted)
+				except AnalysisCancelled:
+					raise AnalysisAborted(reenqueue=self._reenqueue)
+				analysis = envelope["result"]
+				self._logger.debug("Got analysis: {!r}, timings: {!r}".format(analysis, envelope["timings"]))
+				if cache is not None:
+					cache.put(self._current.absolute_path, analysis)
+			else:
+				self._logger.debug("Using cached analysis of {}".format(self._current.absolute_path))
+			thumbnails = self._thumbnails() if self._thumbnails is not None else None
+			if thumbnails is not None:
+				thumbnails.schedule(self._current.absolute_path)
 			
 			result = {}
-			if "ERROR:" in output:
-				_, error = output.split("ERROR:")
-				raise RuntimeError(error.strip())
-			elif "EMPTY:" in output:
-				self._logger.info("Result is empty, no extrusions found")
-			elif "RESULTS:" not in output:
-				raise RuntimeError("No analysis result found")
-			else:
-				self._logger.debug("passed if-else block")
-				_, output = output.split("RESULTS:")
-				self._logger.debug("passed output split {!r}".format(output))
-				analysis = {}
-				try:
-					analysis = yaml.safe_load(output)
-				except Exception as inst:
-					self._logger.debug("yaml load output failed, analysis type:", inst)
-					analysis["printing_area"] = {'minX': 5.0,'minY': 5.0, 'minZ': 5.0, 'maxX': 10.0, 'maxY': 10.0, 'maxZ': 10.0},
-					analysis["dimensions"] = {'width': 82.62, 'depth': 130.56, 'height': 12}
-					analysis["print_time_secs"] = 5500
-					analysis["volume"] = 500
-				#analysis["dimensions"] = {'width': 82.62, 'depth': 130.56, 'height': 12}
-				try:
-					analysis["total_time"] = analysis["print_time_secs"]
-				except Exception as inst:
-					self._logger.debug("yaml load output failed, analysis type:", inst)
+			analysis["total_time"] = analysis["print_time_secs"]
+			
+			result["printingArea"] = analysis["printing_area"]
+			result["dimensions"] = analysis["dimensions"]
+			if analysis["total_time"]:
+				result["estimatedPrintTime"] = analysis["print_time_secs"]
 				
-				result["printingArea"] = analysis["printing_area"]
-				result["dimensions"] = analysis["dimensions"]
-				if analysis["total_time"]:
-					result["estimatedPrintTime"] = analysis["print_time_secs"]
-					
-				if analysis["volume"]:
-					result["filament"] = {}
-					radius = 1.75/2
-					result["filament"]["tool0"] = {
-							"length": analysis["volume"]/(math.pi*radius*radius),
-							"volume": analysis["volume"],}
-				if analysis['layer_count']:
-					result['layer_count'] = analysis['layer_count']
-				if analysis['layer_height_mm']:
-					result['layer_height_mm'] = analysis['layer_height_mm']
-				if analysis['printer name']:
-					result['printer_name'] = analysis['printer name']
-				result['path'] = analysis['path']
-				#self._finished_callback(self._current, result)
+			if analysis["volume"]:
+				result["filament"] = {}
+				radius = 1.75/2
+				result["filament"]["tool0"] = {
+						"length": analysis["volume"]/(math.pi*radius*radius),
+						"volume": analysis["volume"],}
+			if analysis['layer_count']:
+				result['layer_count'] = analysis['layer_count']
+			if analysis['layer_height_mm']:
+				result['layer_height_mm'] = analysis['layer_height_mm']
+			if analysis['printer_name']:
+				result['printer_name'] = analysis['printer_name']
+			result['path'] = analysis['path']
 
 			if self._current.analysis and isinstance(self._current.analysis, dict):
 				return dict_merge(result, self._current.analysis)
 			else:
 				return result
+		except AnalysisAborted:
+			raise
 		except Exception as inst:
 			self._logger.debug("Analysis for {} ran into error: {}".format(self._current, inst))
 		finally:
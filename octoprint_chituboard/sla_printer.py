@@ -2,6 +2,7 @@
 
 import os, sys, glob
 import re
+import threading
 
 from past.builtins import basestring, long
 from octoprint.events import Events, eventManager
@@ -28,6 +29,7 @@ from octoprint.util import (
 from pathlib import Path
 import quopri
 import logging
+from .gcode_hooks import gcode_modifier
 from .file_formats.utils import get_file_format	
 
 # ~ from octoprint.settings import settings
@@ -75,13 +77,23 @@ Scenario 2 : pi only connected via uart separate flshdrive on the printer:
 
 class Sla_printer(Printer):
 
-	def __init__(self, fileManager, analysisQueue, printerProfileManager):
+	def __init__(self, fileManager, analysisQueue, printerProfileManager, analysis_cache=None):
+		"""
+		analysis_cache returns the plugin's AnalysisCache, or None while
+		there is none: the printer factory hook runs before the plugin is
+		initialized and has created it
+		"""
 		self._logger = logging.getLogger(__name__)
 		self._logger_job = logging.getLogger("{}.job".format(__name__))
 		self._analysisQueue = analysisQueue
 		self._fileManager = fileManager
 		self._printerProfileManager = printerProfileManager
+		self._analysis_cache = analysis_cache
 		self._sliced_model_file = None
+		self._sliced_model_path = None
+		# upload sliced files over the UART instead of using the flash drive
+		self.uart_upload = False
+		self.upload_window = 4
 
 		self.fileType = None
 		self._logger.info("init Sla_printer object for global printer object")
@@ -109,25 +121,28 @@ class Sla_printer(Printer):
 		if sd:
 			path_on_disk = "/" + path
 			path_in_storage = path
-			file_format = get_file_format("/home/pi/.octoprint/uploads/resin"+path_on_disk)
-			sliced_model_file = file_format.read(Path("/home/pi/.octoprint/uploads/resin"+path_on_disk))
+			model_path = "/home/pi/.octoprint/uploads/resin"+path_on_disk
+			sliced_model_file = self._read_sliced_model(model_path)
 			printTime = sliced_model_file.print_time_secs
 			self._logger.debug("print time: ", printTime)
 			
 		else:
 			path_on_disk = self._fileManager.path_on_disk(origin, path)
+			model_path = path_on_disk
 			file_format = get_file_format(path_on_disk)
-			try:
-				fileData = self._fileManager.get_metadata(
-						origin,
-						path_on_disk,
-					)
-				
-				sliced_model_file = file_format.read_dict(Path(path_on_disk),fileData["analysis"])
-				self._logger.info("Metadata %s" % str(fileData))
-			except Exception as inst:
-				self._logger.debug("yaml load output failed, analysis type:", inst)
-				sliced_model_file = file_format.read(Path(path_on_disk))	
+			sliced_model_file = self._read_sliced_model(path_on_disk, cache_only=True)
+			if sliced_model_file is None:
+				try:
+					fileData = self._fileManager.get_metadata(
+							origin,
+							path_on_disk,
+						)
+					
+					sliced_model_file = file_format.read_dict(Path(path_on_disk),fileData["analysis"])
+					self._logger.info("Metadata %s" % str(fileData))
+				except Exception as inst:
+					self._logger.debug("metadata load failed, reading file header:", inst)
+					sliced_model_file = self._read_sliced_model(path_on_disk)
 			# ~ file_format = get_file_format(path_on_disk)
 			# generate sliced_model_file by retrieving file metadata
 			# add classmethod to create object using metadata dict
@@ -141,6 +156,7 @@ class Sla_printer(Printer):
 			path_in_storage = self._fileManager.path_in_storage(origin, path_on_disk)
 			path_on_disk = os.path.split(self._fileManager.path_on_disk(origin, path))[-1]
 		self._sliced_model_file = sliced_model_file
+		self._sliced_model_path = model_path
 		self._logger.debug("Path: %s" % path_on_disk)
 		self._logger.debug("Path filename: %s" % os.path.split(path_on_disk)[-1])
 		self._logger.debug("Printer state str: ", self._comm.getStateString())
@@ -159,11 +175,29 @@ class Sla_printer(Printer):
 		self._updateProgressData()#printTime=printTime)
 		self._setCurrentZ(None)
 		
+	def _read_sliced_model(self, path_on_disk, cache_only=False):
+		"""
+		Builds the sliced model from the analysis cache if the file was
+		analysed before, otherwise reads only the file header, so selecting
+		a file never waits for the layers. With cache_only None is returned
+		on a cache miss.
+		"""
+		file_format = get_file_format(path_on_disk)
+		analysis_cache = self._analysis_cache() if self._analysis_cache is not None else None
+		if analysis_cache is not None:
+			analysis = analysis_cache.get(path_on_disk)
+			if analysis is not None:
+				return file_format.from_analysis(Path(path_on_disk), analysis)
+		if cache_only:
+			return None
+		return file_format.read_header(Path(path_on_disk))
+
 	def unselect_file(self, *args, **kwargs):
 		if self._comm is not None and (self._comm.isBusy() or self._comm.isStreaming()):
 			return
 			
 		self._sliced_model_file = None
+		self._sliced_model_path = None
 		self._comm.unselectFile()
 		self._updateProgressData()
 		self._setCurrentZ(None)
@@ -424,7 +458,8 @@ class Sla_printer(Printer):
 		
 	def add_sd_file(self, filename, path, on_success=None, on_failure=None, *args, **kwargs):
 		"""
-		Todo: add method to properly upload SD files using the UART port.
+		Sliced files are uploaded over the UART with _upload_sla_file if
+		uart_upload is set, otherwise they are already on the flash drive.
 		Basic outline of sd upload procedure in 
 		https://www.improwis.com/projects/sw_PhotonControl/
 		https://docs.google.com/document/d/14UBMO0Vhh9Lr0V3xcdetQ2_4UDnjFnho7OnbNxLOs3o/view#
@@ -435,8 +470,69 @@ class Sla_printer(Printer):
 		if self.fileType == "gcode": 
 			ret = Printer.add_sd_file(self, filename, path, on_success, on_failure, *args, **kwargs)
 		elif self.fileType == "sla_bin":
+			if self.uart_upload:
+				return self._upload_sla_file(filename, path, on_success, on_failure)
 			on_success()
 			print("printjob canceled")
+
+	def _upload_sla_file(self, filename, path, on_success=None, on_failure=None):
+		"""
+		Uploads a sliced file to the printer's own storage with M28/M29
+		(see uart_upload). The comm can't pass binary data, so the serial
+		connection is closed for the transfer and opened again afterwards.
+		"""
+		if self._comm is None or (self._comm.isBusy() or self._comm.isStreaming()):
+			self._logger.info("Cannot upload file: printer not connected or currently busy")
+			return None
+		state, port, baudrate, profile = self.get_current_connection()
+		remote_name = filename
+		self.disconnect()
+		thread = threading.Thread(
+			target=self._run_sla_upload,
+			args=(filename, path, remote_name, port, baudrate, profile, on_success, on_failure),
+			name="Chituboard UART upload")
+		thread.daemon = True
+		thread.start()
+		return remote_name
+
+	def _run_sla_upload(self, filename, path, remote_name, port, baudrate, profile, on_success, on_failure):
+		import serial
+		from .uart_upload import UartUploader, UploadError
+
+		payload = {"local": filename, "remote": remote_name}
+
+		def report(progress):
+			self._logger.info("Uploading {}: {}/{} bytes, {:.1f} kB/s, {} s left".format(
+				filename, progress.acked, progress.total, progress.bytes_per_sec / 1024,
+				"-" if progress.eta_secs is None else int(progress.eta_secs)))
+			eventManager().fire(Events.PLUGIN_CHITUBOARD_UPLOAD_PROGRESS, dict(payload,
+				acked=progress.acked, total=progress.total,
+				bytesPerSec=progress.bytes_per_sec, etaSecs=progress.eta_secs))
+
+		eventManager().fire(Events.TRANSFER_STARTED, payload)
+		start = monotonic_time()
+		result = None
+		try:
+			with serial.Serial(port, baudrate, timeout=2) as connection:
+				uploader = UartUploader(connection, window=self.upload_window, progress=report)
+				result = uploader.upload(path, remote_name)
+		except (UploadError, serial.SerialException, OSError) as inst:
+			self._logger.error("Upload of {} to the printer failed: {}".format(filename, inst))
+		finally:
+			# reconnect first, the callbacks may select and print the file
+			self.connect(port=port, baudrate=baudrate, profile=profile["id"] if profile else None)
+
+		# callbacks get the arguments Printer.add_sd_file passes to them
+		if result is None:
+			eventManager().fire(Events.TRANSFER_FAILED, dict(payload, time=monotonic_time() - start))
+			if callable(on_failure):
+				on_failure(remote_name, remote_name, FileDestinations.SDCARD)
+		else:
+			self._logger.info("Uploaded {}: {} bytes in {:.1f} s, {:.1f} kB/s, {} packets, {} resends".format(
+				filename, result.size, result.elapsed, result.bytes_per_sec / 1024, result.packets, result.resends))
+			eventManager().fire(Events.TRANSFER_DONE, dict(payload, time=result.elapsed))
+			if callable(on_success):
+				on_success(remote_name, remote_name, FileDestinations.SDCARD)
 			
 	def commands(self, commands, 
 		cmd_type=None, 
@@ -520,17 +616,49 @@ class Sla_printer(Printer):
 		return None
 	
 	def get_current_layer(self):
+		position = self.get_layer_position()
+		if position is None:
+			return "-"
+		return position.index + 1
+
+	def get_layer_position(self):
+		"""
+		Locate the reported file position in the sliced file's layer index.
+		Returns the layer, progress within it and its byte range, or None
+		"""
 		filepos = self.get_file_position()
-		current_layer = "-"
-		if filepos:
-			filepos = filepos["pos"]
-			if filepos == 0:
-				current_layer = 1
-			else:
-				current_layer = (
-					self._sliced_model_file.end_byte_offset_by_layer.index(filepos)+ 1
-				)
-		return current_layer
+		if not filepos:
+			return None
+		return self.locate_layer(filepos["pos"])
+
+	def locate_layer(self, position):
+		"""
+		Layer of the selected file containing the byte position, or None
+		"""
+		if self._sliced_model_file is None:
+			return None
+		layer_index = self._sliced_model_file.layer_index
+		if not len(layer_index) and self._sliced_model_file.layer_count and self._sliced_model_path:
+			# the model came from read_header, read its layer table once
+			try:
+				layer_index = self._sliced_model_file.load_layer_index(Path(self._sliced_model_path))
+			except Exception as inst:
+				self._logger.debug("Could not read layer table of {}: {}".format(self._sliced_model_path, inst))
+				return None
+		return layer_index.locate(position)
+
+	def get_layer_durations(self):
+		"""
+		Expected seconds per layer of the selected file, None if the
+		layer table can't be read
+		"""
+		if self._sliced_model_file is None or not self._sliced_model_path:
+			return None
+		try:
+			return self._sliced_model_file.read_layer_durations(Path(self._sliced_model_path))
+		except Exception as inst:
+			self._logger.debug("Could not read layer times of {}: {}".format(self._sliced_model_path, inst))
+			return None
 
 	def split_path(self, path):
 		path = to_unicode(path)
@@ -552,28 +680,3 @@ Groups will be as follows:
   * ``current``: current byte position in file being printed
   * ``total``: total size of file being printed
 """
-
-class gcode_modifier():
-	def __init__(self):
-		# ~ self._printer = PrinterInterface
-		self._logged_replacement = {}
-		self._logger = logging.getLogger("octoprint.plugin")
-		pass
-
-	def get_gcode_send_modifier(self, comm_instance, phase, cmd, cmd_type, gcode,subcode=None , tags=None, *args, **kwargs):
-		if cmd.upper().startswith('M110'): #suppress line reset
-			return (None, )
-		# ~ elif gcode == "M105":
-			# ~ return "M4000", cmd_type
-		# ~ elif gcode == "M25" and "trigger:comm.cancel" in tags:
-			# ~ return "M33", cmd_type
-		else:
-			return None
-	
-	def get_gcode_queuing_modifier(self, comm_instance, phase, cmd, cmd_type, gcode, subcode=None, tags=None, *args, **kwargs):
-		if gcode == "M105" and cmd_type == "temperature_poll":
-			return "M4000", cmd_type
-		elif gcode == "M25" and "trigger:comm.cancel" in tags:
-			return "M33", cmd_type
-	
-		
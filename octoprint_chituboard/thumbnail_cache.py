@@ -0,0 +1,101 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+import logging
+import os
+import queue
+import threading
+from pathlib import Path
+
+from .analysis_cache import evict_lru
+
+
+class ThumbnailCache():
+	"""
+	Preview images of sliced files stored as PNG in folder, named by the
+	content fingerprint from key_for (see AnalysisCache.key_for). Files
+	are queued for extraction at analysis time and decoded by a
+	background thread, the least recently served thumbnails are removed
+	once the folder grows beyond max_bytes.
+	"""
+
+	def __init__(self, folder, key_for, max_bytes=20 * 1024 * 1024):
+		self._logger = logging.getLogger(__name__)
+		self._folder = folder
+		self._key_for = key_for
+		self.max_bytes = max_bytes
+		self._lock = threading.RLock()
+		self._queue = queue.Queue()
+		self._thread = None
+		if not os.path.isdir(folder):
+			os.makedirs(folder)
+
+	def _entry_path(self, key):
+		return os.path.join(self._folder, key + ".png")
+
+	def get(self, path, generate=True):
+		"""
+		Returns (key, thumbnail path) for a sliced file, extracting the
+		preview first if it isn't cached yet and generate is set. None if
+		the file has no readable preview.
+		"""
+		key = self._key_for(path)
+		if key is None:
+			return None
+		entry_path = self._entry_path(key)
+		if os.path.exists(entry_path):
+			try:
+				os.utime(entry_path)
+			except OSError:
+				pass
+			return key, entry_path
+		if not generate:
+			return None
+		return self._generate(path, key)
+
+	def _generate(self, path, key):
+		from .file_formats.utils import get_file_format
+
+		entry_path = self._entry_path(key)
+		tmp_path = "{}.{}.tmp".format(entry_path, threading.get_ident())
+		try:
+			image = get_file_format(path).read_preview(Path(path))
+			with open(tmp_path, "wb") as entry_file:
+				image.write(entry_file)
+			os.replace(tmp_path, entry_path)
+		except Exception as inst:
+			self._logger.debug("Could not extract preview of {}: {}".format(path, inst))
+			try:
+				os.remove(tmp_path)
+			except OSError:
+				pass
+			return None
+		with self._lock:
+			evict_lru(self._folder, self.max_bytes, ".png")
+		return key, entry_path
+
+	def schedule(self, path):
+		"""
+		Queues path for preview extraction in the background
+		"""
+		with self._lock:
+			if self._thread is None or not self._thread.is_alive():
+				self._thread = threading.Thread(
+					target=self._run, name="chituboard-thumbnails", daemon=True)
+				self._thread.start()
+		self._queue.put(path)
+
+	def _run(self):
+		while True:
+			path = self._queue.get()
+			if path is None:
+				break
+			try:
+				self.get(path)
+			except Exception:
+				self._logger.exception("Thumbnail extraction for {} failed".format(path))
+
+	def stop(self):
+		with self._lock:
+			if self._thread is not None and self._thread.is_alive():
+				self._queue.put(None)
@@ -0,0 +1,313 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+"""
+Binary file upload to the printer's storage over the UART, with the
+Chitu M28/M29 transfer ChituBox uses over the network:
+
+	M28 <filename>      open the file, printer answers ok
+	<packets>           data + offset + checksum + 0x83, one reply each
+	M29                 close the file, printer answers ok
+
+Every packet carries up to chunk_size bytes of the file, the file offset
+of that data as little endian uint32, the XOR of all bytes before it and
+the end marker 0x83. The printer answers "ok" when it stored the packet
+and "resend <offset>" when the checksum or offset was wrong, after which
+the upload goes back to that offset.
+
+Run python -m octoprint_chituboard.uart_upload --help to upload a file
+from the command line, --loopback uploads to LoopbackPrinter instead of
+a serial port.
+"""
+
+import collections
+import functools
+import mmap
+import operator
+import os
+import random
+import re
+import struct
+import time
+from typing import Callable, NamedTuple, Optional
+
+CHUNK_SIZE = 1280
+END_MARKER = 0x83
+_OFFSET = struct.Struct("<I")
+_RESEND = re.compile(rb"resend\s*(?P<offset>\d+)", re.IGNORECASE)
+
+
+class UploadError(Exception):
+	pass
+
+
+class UploadProgress(NamedTuple):
+	acked: int  # bytes confirmed by the printer
+	total: int
+	bytes_per_sec: float
+	eta_secs: Optional[float]
+
+
+class UploadResult(NamedTuple):
+	size: int
+	elapsed: float
+	packets: int  # packets sent, including resent ones
+	resends: int  # times the upload went back to an earlier offset
+	timeouts: int
+
+	@property
+	def bytes_per_sec(self) -> float:
+		return self.size / self.elapsed if self.elapsed > 0 else 0.0
+
+
+def checksum(data) -> int:
+	"""
+	XOR of all bytes of data
+	"""
+	return functools.reduce(operator.xor, data, 0)
+
+
+def make_packet(data, offset: int) -> bytes:
+	body = bytes(data) + _OFFSET.pack(offset)
+	return body + bytes((checksum(body), END_MARKER))
+
+
+def parse_packet(packet: bytes):
+	"""
+	Splits a packet into (data, offset), None if it is damaged
+	"""
+	if len(packet) < 6 or packet[-1] != END_MARKER or checksum(packet[:-2]) != packet[-2]:
+		return None
+	return packet[:-6], _OFFSET.unpack_from(packet, len(packet) - 6)[0]
+
+
+class UartUploader:
+	"""
+	Sends a file with M28/M29 over a serial connection. Up to window
+	packets are sent before waiting for their replies; replies come in
+	order, so each "ok" confirms the oldest packet still outstanding.
+
+	transport needs write(bytes) and readline() returning b"" on timeout,
+	like a serial.Serial opened with a timeout.
+	"""
+
+	def __init__(self, transport, window: int = 4, chunk_size: int = CHUNK_SIZE,
+			max_retries: int = 10, progress: Optional[Callable[[UploadProgress], None]] = None,
+			progress_interval: float = 2.0):
+		if window < 1 or chunk_size < 1:
+			raise ValueError("window and chunk_size have to be positive")
+		self.transport = transport
+		self.window = window
+		self.chunk_size = chunk_size
+		self.max_retries = max_retries
+		self.progress = progress
+		self.progress_interval = progress_interval
+
+	def _command(self, command: str):
+		self.transport.write(command.encode("ascii", "replace") + b"\n")
+		for _ in range(self.max_retries + 1):
+			line = self.transport.readline()
+			if not line:
+				continue
+			if line.startswith(b"ok"):
+				return
+			if line.lower().startswith(b"error"):
+				raise UploadError("{} failed: {}".format(command, line.decode("latin-1").strip()))
+		raise UploadError("no answer to {}".format(command))
+
+	def _flush_input(self):
+		reset = getattr(self.transport, "reset_input_buffer", None)
+		if reset is not None:
+			reset()
+
+	def upload(self, path: str, remote_name: str) -> UploadResult:
+		"""
+		Uploads the file at path as remote_name and returns the transfer
+		statistics. Raises UploadError if the printer refuses the file or
+		stops answering.
+		"""
+		size = os.path.getsize(path)
+		start = time.monotonic()
+		self._command("M28 {}".format(remote_name))
+		packets = resends = timeouts = 0
+		if size:
+			with open(path, "rb") as file, mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as buffer:
+				view = memoryview(buffer)
+				try:
+					packets, resends, timeouts = self._stream(view, size, start)
+				finally:
+					view.release()
+		self._command("M29")
+		return UploadResult(size, time.monotonic() - start, packets, resends, timeouts)
+
+	def _stream(self, view: memoryview, size: int, start: float):
+		outstanding = collections.deque()  # (offset, length) of unanswered packets
+		position = acked = 0
+		# replies still due for packets sent before going back, they all
+		# ask for the offset the upload went back to
+		stale = 0
+		packets = resends = timeouts = retries = 0
+		last_report = start
+
+		while acked < size:
+			while position < size and len(outstanding) < self.window:
+				length = min(self.chunk_size, size - position)
+				self.transport.write(make_packet(view[position:position + length], position))
+				outstanding.append((position, length))
+				position += length
+				packets += 1
+
+			line = self.transport.readline()
+			if not line:
+				# lost packet or reply, start over from the oldest unanswered one
+				timeouts += 1
+				retries += 1
+				if retries > self.max_retries:
+					raise UploadError("printer stopped answering at byte {}".format(acked))
+				self._flush_input()
+				position, stale = acked, 0
+				outstanding.clear()
+				continue
+
+			resend = _RESEND.search(line)
+			if resend is None and not line.startswith(b"ok"):
+				# status output of the firmware, not a reply
+				continue
+			if resend is None:
+				# packets from before going back are only ever answered with
+				# resend, an ok already belongs to the packets sent since
+				stale = 0
+				if outstanding:
+					offset, length = outstanding.popleft()
+					acked = offset + length
+					retries = 0
+			else:
+				offset = int(resend.group("offset"))
+				if stale and offset == acked:
+					stale -= 1
+					continue
+				stale = 0
+				if not acked <= offset <= position:
+					raise UploadError("printer asked to resend from byte {}".format(offset))
+				resends += 1
+				retries += 1
+				if retries > self.max_retries:
+					raise UploadError("too many resends at byte {}".format(offset))
+				stale = max(len(outstanding) - 1, 0)
+				outstanding.clear()
+				position = acked = offset
+
+			now = time.monotonic()
+			if self.progress is not None and (now - last_report >= self.progress_interval or acked == size):
+				last_report = now
+				rate = acked / (now - start) if now > start else 0.0
+				self.progress(UploadProgress(acked, size, rate, (size - acked) / rate if rate else None))
+		return packets, resends, timeouts
+
+
+class LoopbackPrinter:
+	"""
+	Stand-in for the printer's side of the transfer, to test uploads
+	without hardware. Every write is taken as one command or packet and
+	answered like the firmware does; the received file ends up in files.
+	error_rate damages that share of packets on the way, drop_rate loses
+	that share of the replies to packets.
+	"""
+
+	def __init__(self, error_rate: float = 0.0, drop_rate: float = 0.0, seed: Optional[int] = None):
+		self.error_rate = error_rate
+		self.drop_rate = drop_rate
+		self.files = {}
+		self._random = random.Random(seed)
+		self._replies = collections.deque()
+		self._name = None
+		self._data = None
+
+	def _reply(self, line: bytes, droppable: bool = False):
+		if not droppable or self._random.random() >= self.drop_rate:
+			self._replies.append(line + b"\n")
+
+	def write(self, data: bytes) -> int:
+		if self._name is None:
+			command = data.decode("latin-1").strip()
+			if command.startswith("M28 "):
+				self._name = command[4:].strip()
+				self._data = bytearray()
+				self._reply(b"ok")
+			else:
+				self._reply(b"Error:It's not printing now!")
+			return len(data)
+		if data.strip() == b"M29":
+			self.files[self._name] = bytes(self._data)
+			self._name = self._data = None
+			self._reply(b"ok")
+			return len(data)
+		if self.error_rate and self._random.random() < self.error_rate:
+			damaged = bytearray(data)
+			damaged[self._random.randrange(len(damaged))] ^= 0x5A
+			data = bytes(damaged)
+		packet = parse_packet(data)
+		if packet is None or packet[1] != len(self._data):
+			self._reply(b"resend " + str(len(self._data)).encode(), droppable=True)
+		else:
+			self._data += packet[0]
+			self._reply(b"ok", droppable=True)
+		return len(data)
+
+	def readline(self) -> bytes:
+		return self._replies.popleft() if self._replies else b""
+
+	def reset_input_buffer(self):
+		self._replies.clear()
+
+
+def main(argv=None) -> int:
+	import argparse
+
+	parser = argparse.ArgumentParser(description="Upload a sliced file to the printer over the UART")
+	parser.add_argument("file")
+	parser.add_argument("--name", help="file name on the printer, default the local name")
+	target = parser.add_mutually_exclusive_group(required=True)
+	target.add_argument("--port", help="serial port of the printer")
+	target.add_argument("--loopback", action="store_true", help="upload to a LoopbackPrinter")
+	parser.add_argument("--baudrate", type=int, default=115200)
+	parser.add_argument("--window", type=int, default=4)
+	parser.add_argument("--chunk-size", type=int, default=CHUNK_SIZE)
+	parser.add_argument("--error-rate", type=float, default=0.0, help="damaged packets with --loopback")
+	parser.add_argument("--drop-rate", type=float, default=0.0, help="lost replies with --loopback")
+	args = parser.parse_args(argv)
+
+	name = args.name or os.path.basename(args.file)
+	if args.loopback:
+		transport = LoopbackPrinter(args.error_rate, args.drop_rate, seed=0)
+	else:
+		import serial
+
+		transport = serial.Serial(args.port, args.baudrate, timeout=2)
+
+	def report(progress):
+		eta = "-" if progress.eta_secs is None else "{:.0f} s".format(progress.eta_secs)
+		print("{:>10}/{} bytes  {:8.1f} kB/s  eta {}".format(
+			progress.acked, progress.total, progress.bytes_per_sec / 1024, eta))
+
+	try:
+		result = UartUploader(transport, args.window, args.chunk_size, progress=report, progress_interval=0.5).upload(args.file, name)
+	except UploadError as inst:
+		print("upload failed: {}".format(inst))
+		return 1
+	finally:
+		if not args.loopback:
+			transport.close()
+	print("{} bytes in {:.2f} s, {:.1f} kB/s, {} packets, {} resends, {} timeouts".format(
+		result.size, result.elapsed, result.bytes_per_sec / 1024, result.packets, result.resends, result.timeouts))
+	if args.loopback:
+		with open(args.file, "rb") as file:
+			if transport.files.get(name) != file.read():
+				print("loopback copy differs from the file")
+				return 1
+	return 0
+
+
+if __name__ == "__main__":
+	import sys
+
+	sys.exit(main())
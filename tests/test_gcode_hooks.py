@@ -0,0 +1,20 @@
+import pytest
+
+from octoprint_chituboard.gcode_hooks import classify_received
+
+
+@pytest.mark.parametrize("line,kind", [
+	("ok", None),
+	("ok N12", None),
+	("", None),
+	("wait", "wait"),
+	("ok V4.2.20.3_LCDM", "start"),
+	("CBD make it. Date:Nov 11 2019 Time:16:39:09", "identifier"),
+	("SD printing byte 12839/8392402", "sd_byte"),
+	("ok B:0/0 X:0.000 Y:0.000 Z:0.050 F:256/256 D:12839/8392402/0 T:0", "m4000"),
+	("ok C: X:0.000000 Y:0.000000 Z:0.050000 E:0.000000", "m114"),
+	("Error:It's not printing now!", "error"),
+])
+@pytest.mark.parametrize("ending", ["", "\n", "\r\n"])
+def test_classify_received(line, kind, ending):
+	assert classify_received(line + ending) == kind
@@ -0,0 +1,81 @@
+import dataclasses
+import struct
+
+import pytest
+
+from octoprint_chituboard.file_formats.ctb import CTBFile, CTBHeader, CTBLayerDef, CTBParam, CTBSlicer
+from octoprint_chituboard.file_formats.layers import LiftSettings
+
+BOTTOM_LAYERS, LAYERS = 4, 40
+MACHINE_NAME = b"ELEGOO MARS 2"
+
+
+def _pack(struct_cls, **values) -> bytes:
+	"""
+	Packs a LittleEndianStruct, fields not in values are 0
+	"""
+	names = [field.name for field in dataclasses.fields(struct_cls)]
+	return struct.pack(struct_cls.get_format(), *(values.pop(name, 0) for name in names))
+
+
+def _expected_print_time() -> float:
+	"""
+	The print time the slicer stores for the file from _write_ctb: per
+	layer the exposure, the light off delay, the lift and the retract,
+	speeds in mm/min
+	"""
+	bottom = 35.0 + 1.0 + 6.0 / (90 / 60) + 6.0 / (150 / 60)
+	normal = 2.5 + 1.0 + 5.0 / (60 / 60) + 5.0 / (150 / 60)
+	return BOTTOM_LAYERS * bottom + (LAYERS - BOTTOM_LAYERS) * normal
+
+
+def _write_ctb(path):
+	param_offset = CTBHeader.get_size()
+	slicer_offset = param_offset + CTBParam.get_size()
+	machine_offset = slicer_offset + CTBSlicer.get_size()
+	layer_defs_offset = machine_offset + len(MACHINE_NAME)
+	image_offset = layer_defs_offset + LAYERS * CTBLayerDef.get_size()
+	header = _pack(CTBHeader,
+		magic=0x12fd0086, version=3, layer_height_mm=0.05, layer_exposure=2.5, bottom_exposure=35.0,
+		layer_off_time=1.0, bottom_count=BOTTOM_LAYERS, resolution_x=16, resolution_y=8,
+		layer_defs_offset=layer_defs_offset, layer_count=LAYERS, print_time=round(_expected_print_time()),
+		param_offset=param_offset, param_size=CTBParam.get_size(),
+		slicer_offset=slicer_offset, slicer_size=CTBSlicer.get_size())
+	param = _pack(CTBParam,
+		bottom_lift_height=6.0, bottom_lift_speed=90.0, lift_height=5.0, lift_Speed=60.0, retract_Speed=150.0,
+		bottom_light_off_time=1.0, light_off_time=1.0, bottom_layer_count=BOTTOM_LAYERS)
+	slicer = _pack(CTBSlicer, machine_offset=machine_offset, machine_size=len(MACHINE_NAME))
+	layer_defs = b"".join(
+		_pack(CTBLayerDef,
+			layer_height_mm=0.05 * (i + 1), layer_exposure=35.0 if i < BOTTOM_LAYERS else 2.5,
+			layer_off_time=1.0, image_offset=image_offset)
+		for i in range(LAYERS))
+	path.write_bytes(header + param + slicer + MACHINE_NAME + layer_defs)
+
+
+def test_ctb_layer_durations_match_print_time(tmp_path):
+	path = tmp_path / "model.ctb"
+	_write_ctb(path)
+	model = CTBFile.read_header(path)
+	durations = model.read_layer_durations(path)
+	assert len(durations) == LAYERS
+	assert durations[0] == pytest.approx(35.0 + 1.0 + 4.0 + 2.4)
+	assert durations[-1] == pytest.approx(2.5 + 1.0 + 5.0 + 2.0)
+	assert sum(durations) == pytest.approx(model.print_time_secs, abs=1)
+
+
+def test_lift_settings_from_mm_per_min():
+	lift = LiftSettings.from_mm_per_min(3, 6.0, 90.0, 5.0, 60.0, 150.0)
+	assert lift == LiftSettings(3, 6.0, 1.5, 5.0, 1.0, 2.5)
+
+
+def test_layers_outlive_the_map(tmp_path):
+	path = tmp_path / "model.ctb"
+	_write_ctb(path)
+	with CTBFile.open(path) as model:
+		layer = model.layers[3]
+		image = model.layers.decode(3)
+		buffer = model.buffer
+	assert buffer.closed
+	assert layer.index == 3 and layer.data == b""
+	assert image.shape == (8, 16) and not image.any()
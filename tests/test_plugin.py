@@ -0,0 +1,117 @@
+from unittest import mock
+
+import pytest
+
+octoprint = pytest.importorskip("octoprint")
+
+import octoprint.plugin
+import octoprint.settings
+import serial
+from octoprint.events import Events
+from octoprint.filemanager import FileDestinations
+
+from octoprint_chituboard.uart_upload import LoopbackPrinter
+
+
+@pytest.fixture(scope="module")
+def plugin_module(tmp_path_factory):
+	"""
+	The plugin module with OctoPrint's global settings and plugin manager
+	set up, as the server does before it loads plugins
+	"""
+	octoprint.settings.settings(init=True, basedir=str(tmp_path_factory.mktemp("octoprint")))
+	octoprint.plugin.plugin_manager(init=True, plugin_folders=[], plugin_entry_points=None)
+	import octoprint_chituboard
+
+	return octoprint_chituboard
+
+
+def _components():
+	return dict(file_manager=mock.MagicMock(), analysis_queue=mock.MagicMock(), printer_profile_manager=mock.MagicMock())
+
+
+def _initialize(plugin, data_folder):
+	"""
+	Injects what OctoPrint's initialize_implementations gives a plugin
+	and calls initialize()
+	"""
+	plugin._identifier = "Chituboard"
+	plugin._data_folder = str(data_folder)
+	plugin._settings = octoprint.plugin.PluginSettings(
+		octoprint.settings.settings(), "Chituboard", defaults=plugin.get_settings_defaults())
+	plugin.initialize()
+
+
+def test_printer_factory_runs_before_initialize(plugin_module, tmp_path):
+	plugin = plugin_module.Chituboard()
+	# OctoPrint calls the printer factory hook while _settings is still None
+	printer = plugin.get_sla_printer_factory(_components())
+	assert type(printer).__name__ == "Sla_printer"
+
+	_initialize(plugin, tmp_path)
+	plugin._settings.set_boolean(["workAsFlashDrive"], False)
+	plugin._settings.set_int(["uploadWindow"], 8)
+	plugin._apply_upload_settings()
+	assert printer.uart_upload and printer.upload_window == 8
+
+
+class _SerialLoopback(LoopbackPrinter):
+	def __init__(self, *args, **kwargs):
+		super().__init__()
+
+	def __enter__(self):
+		return self
+
+	def __exit__(self, *args):
+		return False
+
+
+def test_uart_upload_callbacks(plugin_module, tmp_path, monkeypatch):
+	plugin = plugin_module.Chituboard()
+	printer = plugin.get_sla_printer_factory(_components())
+	path = tmp_path / "model.ctb"
+	path.write_bytes(bytes(range(256)) * 20)
+
+	calls = []
+	monkeypatch.setattr(serial, "Serial", _SerialLoopback)
+	monkeypatch.setattr(Events, "PLUGIN_CHITUBOARD_UPLOAD_PROGRESS", "plugin_chituboard_upload_progress", raising=False)
+	monkeypatch.setattr(printer, "connect", lambda **kwargs: calls.append("connect"))
+
+	printer._run_sla_upload("model.ctb", str(path), "model.ctb", "/dev/ttyS0", 115200, None,
+		lambda *args: calls.append(("success",) + args), lambda *args: calls.append(("failure",) + args))
+	# the printer is connected again before select and print run in the callback
+	assert calls == ["connect", ("success", "model.ctb", "model.ctb", FileDestinations.SDCARD)]
+
+
+def test_analysis_cache_reaches_queue_and_printer(plugin_module, tmp_path):
+	plugin = plugin_module.Chituboard()
+	# both factory hooks run before initialize() creates the cache
+	queue = plugin.get_sla_analysis_factory()["sla_bin"](lambda *args: None)
+	printer = plugin.get_sla_printer_factory(_components())
+	_initialize(plugin, tmp_path)
+
+	cache = plugin._analysis_cache
+	assert cache is not None
+	assert queue._cache() is cache
+	with mock.patch.object(cache, "get", return_value=None) as get:
+		assert printer._read_sliced_model(str(tmp_path / "model.ctb"), cache_only=True) is None
+	get.assert_called_once_with(str(tmp_path / "model.ctb"))
+
+
+def test_thumbnail_cache_reaches_queue(plugin_module, tmp_path):
+	plugin = plugin_module.Chituboard()
+	queue = plugin.get_sla_analysis_factory()["sla_bin"](lambda *args: None)
+	_initialize(plugin, tmp_path)
+
+	thumbnails = plugin._thumbnail_cache
+	assert thumbnails is not None
+	assert queue._thumbnails() is thumbnails
+	path = str(tmp_path / "model.ctb")
+	analysis = dict(print_time_secs=0, printing_area={}, dimensions={}, volume=0, layer_count=0,
+		layer_height_mm=0, printer_name="", path=path)
+	queue._current = mock.MagicMock(analysis=None, absolute_path=path)
+	with mock.patch.object(plugin._analysis_cache, "get", return_value=analysis), \
+			mock.patch.object(thumbnails, "schedule") as schedule:
+		assert queue._do_analysis()["path"] == path
+	# the preview is extracted ahead of the first request to the thumbnail route
+	schedule.assert_called_once_with(path)
@@ -0,0 +1,210 @@
+import json
+import pathlib
+import random
+
+import numpy as np
+import pytest
+
+from octoprint_chituboard.file_formats import rle
+
+WIDTH, HEIGHT = 61, 23
+SIZE = WIDTH * HEIGHT
+SEEDS = range(40)
+
+# leading bits and payload mask of the 1-4 byte RLE7 run lengths
+RLE7_PREFIXES = ((0x00, 0x7f), (0x80, 0x3f), (0xC0, 0x1f), (0xE0, 0x0f))
+
+# small RLE7 layers with the pixels the decoder had before it was
+# vectorized (read_rle7array of 872d2dd) gave for them
+RLE7_GOLDEN = json.loads((pathlib.Path(__file__).parent / "data" / "rle7_golden.json").read_text())
+
+
+def _reference(array) -> np.ndarray:
+	"""
+	Pure python decoder output as a (HEIGHT, WIDTH) uint8 array
+	"""
+	return np.array(array, dtype=np.uint8).reshape(HEIGHT, WIDTH)
+
+
+def _split(total: int, longest: int, rng: random.Random):
+	"""
+	Random run lengths between 1 and longest adding up to total
+	"""
+	lengths = []
+	while total:
+		lengths.append(min(rng.randint(1, longest), total))
+		total -= lengths[-1]
+	return lengths
+
+
+def _rle7_length(length: int, extra: int) -> bytes:
+	prefix, mask = RLE7_PREFIXES[extra]
+	return bytes([prefix | (length >> 8 * extra) & mask]) + length.to_bytes(4, "big")[4 - extra:]
+
+
+def _rle7_stream(rng: random.Random, pixels: int) -> bytes:
+	"""
+	RLE7 stream of single pixels and runs using every run length width,
+	including lengths stored wider than needed
+	"""
+	data = bytearray()
+	while pixels > 0:
+		code = rng.choice((0, rng.randrange(128)))
+		if rng.random() < 0.3:
+			data.append(code)
+			pixels -= 1
+			continue
+		extra = rng.randrange(4)
+		length = rng.randint(0, min(pixels + 40, RLE7_PREFIXES[extra][1] << 8 * extra | (1 << 8 * extra) - 1))
+		data.append(0x80 | code)
+		data += _rle7_length(length, extra)
+		pixels -= length
+	return bytes(data)
+
+
+def _rle1_stream(rng: random.Random) -> bytes:
+	return bytes(
+		rng.randrange(2) << 7 | (0 if length == 1 and rng.random() < 0.5 else length)
+		for length in _split(SIZE, 0x7f, rng))
+
+
+def _rle4_stream(rng: random.Random) -> bytes:
+	data = bytearray()
+	for length in _split(SIZE, 0x200, rng):
+		if length == 1 and rng.random() < 0.5:
+			data.append(rng.randint(1, 0xe) << 4)
+		else:
+			colour = rng.choice((0x0, 0xf))
+			data += bytes((colour << 4 | length >> 8, length & 0xff))
+	return bytes(data)
+
+
+def _gray_stream(rng: random.Random) -> bytes:
+	data = bytearray()
+	for length in _split(SIZE, 0x7f, rng):
+		if rng.random() < 0.5:
+			data.append(0x80 | rng.randrange(128))
+			length -= 1
+		if length:
+			data.append(length)
+	return bytes(data)
+
+
+@pytest.mark.parametrize("seed", SEEDS)
+def test_rle7_matches_reference(seed):
+	rng = random.Random(seed)
+	data = _rle7_stream(rng, SIZE + rng.randint(-SIZE // 2, 200))
+	expected = _reference(rle._read_rle7list(WIDTH, HEIGHT, data))
+	np.testing.assert_array_equal(rle.read_rle7array(WIDTH, HEIGHT, data), expected)
+
+
+@pytest.mark.parametrize("case", RLE7_GOLDEN, ids=[case["name"] for case in RLE7_GOLDEN])
+def test_rle7_golden(case):
+	width, height = case["width"], case["height"]
+	data = bytes.fromhex(case["data"])
+	expected = np.frombuffer(bytes.fromhex(case["pixels"]), dtype=np.uint8).reshape(height, width)
+	np.testing.assert_array_equal(rle.read_rle7array(width, height, data), expected)
+	np.testing.assert_array_equal(np.array(rle._read_rle7list(width, height, data), dtype=np.uint8), expected)
+
+
+@pytest.mark.parametrize("extra", range(4))
+def test_rle7_run_length_widths(extra):
+	data = bytes([0x80 | 0x40]) + _rle7_length(100, extra) + bytes([0x80 | 0x7f]) + _rle7_length(5, extra)
+	expected = _reference(rle._read_rle7list(WIDTH, HEIGHT, data))
+	decoded = rle.read_rle7array(WIDTH, HEIGHT, data)
+	np.testing.assert_array_equal(decoded, expected)
+	assert (decoded.reshape(-1)[:100] == 0x81).all()
+	assert (decoded.reshape(-1)[100:105] == 0xff).all()
+
+
+@pytest.mark.parametrize("seed", SEEDS)
+def test_rle7_truncated(seed):
+	rng = random.Random(seed)
+	data = _rle7_stream(rng, SIZE)
+	data = data[:rng.randrange(len(data))]
+	expected = _reference(rle._read_rle7list(WIDTH, HEIGHT, data))
+	np.testing.assert_array_equal(rle.read_rle7array(WIDTH, HEIGHT, data), expected)
+
+
+@pytest.mark.parametrize("seed", SEEDS)
+def test_rle7_invalid_prefix(seed):
+	rng = random.Random(seed)
+	head, tail = _rle7_stream(rng, SIZE // 2), _rle7_stream(rng, SIZE // 2)
+	# 1111xxxx is no valid run length, decoding stops at it
+	data = head + bytes((0x80 | rng.randrange(128), rng.randint(0xF0, 0xFF))) + tail
+	expected = _reference(rle._read_rle7list(WIDTH, HEIGHT, data))
+	np.testing.assert_array_equal(rle.read_rle7array(WIDTH, HEIGHT, data), expected)
+	np.testing.assert_array_equal(
+		rle.read_rle7array(WIDTH, HEIGHT, data),
+		rle.read_rle7array(WIDTH, HEIGHT, head))
+
+
+@pytest.mark.parametrize("seed", SEEDS)
+def test_rle1_matches_reference(seed):
+	data = _rle1_stream(random.Random(seed))
+	expected = _reference(rle._read_rle1list(WIDTH, HEIGHT, data))
+	np.testing.assert_array_equal(rle.read_rle1array(WIDTH, HEIGHT, data), expected)
+
+
+@pytest.mark.parametrize("seed", SEEDS)
+def test_rle1_packed(seed):
+	data = _rle1_stream(random.Random(seed))
+	expected = _reference(rle._read_rle1list(WIDTH, HEIGHT, data))
+	packed = rle.read_rle1array(WIDTH, HEIGHT, data, packed=True)
+	np.testing.assert_array_equal(packed, np.packbits(expected, axis=1))
+	np.testing.assert_array_equal(rle.unpack_rle1array(WIDTH, packed), expected)
+
+
+@pytest.mark.parametrize("seed", SEEDS)
+def test_rle4_matches_reference(seed):
+	rng = random.Random(seed)
+	data = _rle4_stream(rng)
+	antialias = rng.choice((0xff, 0xf0, 0xcc))
+	expected = _reference(rle._read_rle4list(WIDTH, HEIGHT, antialias, data))
+	np.testing.assert_array_equal(rle.read_rle4array(WIDTH, HEIGHT, antialias, data), expected)
+
+
+@pytest.mark.parametrize("seed", SEEDS)
+def test_gray_matches_reference(seed):
+	data = _gray_stream(random.Random(seed))
+	expected = _reference(rle._read_graylist(WIDTH, HEIGHT, data))
+	np.testing.assert_array_equal(rle.read_grayarray(WIDTH, HEIGHT, data), expected)
+
+
+@pytest.mark.parametrize("seed", SEEDS[:10])
+def test_grayplanes_sum_planes(seed):
+	rng = random.Random(seed)
+	# planes of any length, each is clipped or padded on its own
+	planes = [_gray_stream(rng)[:rng.randrange(1, 400)] for _ in range(rng.randint(1, 8))]
+	expected = sum(rle.read_grayarray(WIDTH, HEIGHT, plane).astype(np.uint16) for plane in planes)
+	summed = rle.read_grayplanes(WIDTH, HEIGHT, planes)
+	assert summed.dtype == np.uint16
+	np.testing.assert_array_equal(summed, expected)
+
+
+@pytest.mark.parametrize("seed", SEEDS[:10])
+@pytest.mark.parametrize("decode,stream", [
+	(rle.read_rle7array, lambda rng: _rle7_stream(rng, SIZE - 300)),
+	(rle.read_rle1array, _rle1_stream),
+	(lambda width, height, data, out=None: rle.read_rle4array(width, height, 0xff, data, out=out), _rle4_stream),
+	(rle.read_grayarray, _gray_stream),
+])
+def test_decode_into_out(seed, decode, stream):
+	rng = random.Random(seed)
+	data = stream(rng)
+	expected = decode(WIDTH, HEIGHT, data)
+	out = np.full((HEIGHT, WIDTH), 0x55, dtype=np.uint8)
+	result = decode(WIDTH, HEIGHT, data, out=out)
+	np.testing.assert_array_equal(result, expected)
+	assert np.shares_memory(result, out)
+	# a flat memoryview works as well
+	flat = bytearray(b"\xaa" * SIZE)
+	decode(WIDTH, HEIGHT, data, out=memoryview(flat))
+	np.testing.assert_array_equal(np.frombuffer(flat, dtype=np.uint8).reshape(HEIGHT, WIDTH), expected)
+
+
+def test_out_is_checked():
+	with pytest.raises(ValueError):
+		rle.read_rle7array(WIDTH, HEIGHT, b"", out=np.empty(SIZE - 1, dtype=np.uint8))
+	with pytest.raises(ValueError):
+		rle.read_rle7array(WIDTH, HEIGHT, b"", out=np.empty(SIZE, dtype=np.uint16))